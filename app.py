@@ -1,57 +1,292 @@
+import csv
+import io
+import json
+import logging
+import multiprocessing
 import os
-import requests
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import click
 
 # from flask_migrate import Migrate
 
 
-from flask import Flask, g, render_template, request, flash, redirect, session, abort
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    g,
+    has_app_context,
+    render_template,
+    request,
+    flash,
+    redirect,
+    session,
+    abort,
+    stream_with_context,
+)
+from sqlalchemy import event, or_, update
 from sqlalchemy.exc import IntegrityError
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+
+from models import (
+    db,
+    connect_db,
+    bulk_upsert,
+    User,
+    City,
+    State,
+    Location,
+    Favorite,
+    Job,
+    ZipRentalStat,
+    advisory_lock,
+)
+from cache import (
+    TTLCache,
+    GeocodeCache,
+    ZipRentalCache,
+    ReferenceCache,
+    normalize_address,
+)
+from upstream import SingleFlight, UpstreamClient, UpstreamError
+from quota import QuotaBudget
+from passwords import PasswordHasher, HasherBusy, LoginThrottle
+from config import configs, load_secret
+import compression
+import geo
+import jobs
+import metrics
+import prewarm
+import seed
+from forms import UserAddForm, LoginForm, FavoriteForm, AddressForm
 
 
-from models import db, connect_db, User, City, State, Location, Favorite
-from forms import UserAddForm, LoginForm, FavoriteForm, AddressForm
-from secret import MQ_SECRET_KEY, RM_SECRET_KEY
+CURR_USER_KEY = "curr_user"
 
+logger = logging.getLogger("movein")
 
-MQ_API_BASE_URL = "https://www.mapquestapi.com/geocoding/v1"
-RM_API_BASE_URL = "https://realty-mole-property-api.p.rapidapi.com/zipCodes"
-key_mq = MQ_SECRET_KEY
-key_rm = RM_SECRET_KEY
+bp = Blueprint("movein", __name__, cli_group=None)
 
-CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
-app.app_context().push()
+def extension(name):
+    """Stand-in for the current app's `name` extension."""
+    return LocalProxy(lambda: current_app.extensions[name])
 
 
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
-    "DATABASE_URL", "postgresql:///moveIn"
-)
+# Clients and caches are built per app by create_app() and kept in
+# app.extensions; these names resolve to the current app's.
+mapquest_budget = extension("mapquest_budget")
+realty_mole_budget = extension("realty_mole_budget")
+mapquest = extension("mapquest")
+realty_mole = extension("realty_mole")
+# Coalesces identical concurrent lookups; see SingleFlight.
+upstream_flights = extension("upstream_flights")
+geocode_cache = extension("geocode_cache")
+rental_cache = extension("rental_cache")
+reference_cache = extension("reference_cache")
+login_throttle = extension("login_throttle")
+# Column values of recently seen users, keyed by the user id in the session.
+# False marks a session whose user no longer exists.
+user_cache = extension("user_cache")
+
+
+def create_app(config=None, **settings):
+    """Build the MoveIn app.
+
+    config is a profile name from config.configs ("development", "testing"
+    or "production"), defaulting to $MOVEIN_CONFIG or "development". Extra
+    keyword arguments override individual settings. Run in production with
+    e.g. `gunicorn --preload "app:create_app('production')"`.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(configs[config or os.environ.get("MOVEIN_CONFIG", "development")])
+    app.config.update(settings)
+    app.config.setdefault("MQ_SECRET_KEY", load_secret("MQ_SECRET_KEY"))
+    app.config.setdefault("RM_SECRET_KEY", load_secret("RM_SECRET_KEY"))
+    if app.config["PROXY_FIX_X_FOR"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_FIX_X_FOR"])
+
+    # after_request hooks run last-registered first, so compressing is
+    # registered before anything that rewrites response bodies.
+    compression.init_app(app)
+    if app.config["DEBUG_TB_ENABLED"]:
+        from flask_debugtoolbar import DebugToolbarExtension
+
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    with app.app_context():
+        metrics.init_app(app, db.engine)
+        init_upstream(app, db.engine)
+    PasswordHasher(app)
+    init_caches(app)
+
+    # ThreadPoolExecutor only starts threads on first submit.
+    app.extensions["upstream_executor"] = ThreadPoolExecutor(
+        max_workers=app.config["UPSTREAM_WORKERS"], thread_name_prefix="upstream"
+    )
+
+    app.register_blueprint(bp)
+    return app
 
 
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
-app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = True
-app.config["SQLALCHEMY_ECHO"] = False
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "this is wildly unpredictable")
-toolbar = DebugToolbarExtension(app)
+def init_upstream(app, engine):
+    """Build the app's MapQuest and Realty Mole clients and their call budgets."""
+    config = app.config
+    upstream_options = dict(
+        pool_size=config["UPSTREAM_POOL_SIZE"],
+        connect_timeout=config["UPSTREAM_CONNECT_TIMEOUT"],
+        read_timeout=config["UPSTREAM_READ_TIMEOUT"],
+        retries=config["UPSTREAM_RETRIES"],
+        max_retry_after=config["UPSTREAM_MAX_RETRY_AFTER"],
+    )
+    budget_options = dict(
+        burst=config["UPSTREAM_RATE_BURST"],
+        reserve=config["UPSTREAM_BUDGET_RESERVE"],
+        max_wait=config["UPSTREAM_RATE_MAX_WAIT"],
+    )
+    mq_budget = QuotaBudget(
+        "mapquest",
+        engine,
+        quota=config["MQ_MONTHLY_QUOTA"],
+        rate=config["MQ_RATE_PER_SECOND"],
+        **budget_options,
+    )
+    rm_budget = QuotaBudget(
+        "realty_mole",
+        engine,
+        quota=config["RM_MONTHLY_QUOTA"],
+        rate=config["RM_RATE_PER_SECOND"],
+        **budget_options,
+    )
+    app.extensions.update(
+        mapquest_budget=mq_budget,
+        realty_mole_budget=rm_budget,
+        mapquest=UpstreamClient(
+            "mapquest",
+            config["MQ_API_BASE_URL"],
+            params={"key": config["MQ_SECRET_KEY"]},
+            budget=mq_budget,
+            **upstream_options,
+        ),
+        realty_mole=UpstreamClient(
+            "realty_mole",
+            config["RM_API_BASE_URL"],
+            headers={
+                "X-RapidAPI-Key": config["RM_SECRET_KEY"],
+                "X-RapidAPI-Host": "realty-mole-property-api.p.rapidapi.com",
+                "Content-Type": "application/json",
+            },
+            budget=rm_budget,
+            **upstream_options,
+        ),
+        upstream_flights=SingleFlight(
+            lock=(lambda key: advisory_lock(":".join(key)))
+            if config["UPSTREAM_COALESCE_DB_LOCK"]
+            else None
+        ),
+    )
+
+
+def init_caches(app):
+    """Build the app's caches. Nothing is read from the database yet."""
+    config = app.config
+    geocodes = GeocodeCache()
+    geocodes.init_app(app)
+    rentals = ZipRentalCache(fetch_realty_data, flights=app.extensions["upstream_flights"])
+    rentals.init_app(app)
+    rentals.prefer_stale = app.extensions["realty_mole_budget"].low
+    rentals.schedule_refresh = queue_rental_refresh if config["JOBS_ASYNC"] else None
+    references = ReferenceCache()
+    references.init_app(app)
+    app.extensions.update(
+        geocode_cache=geocodes,
+        rental_cache=rentals,
+        reference_cache=references,
+        user_cache=TTLCache(maxsize=config["USER_CACHE_SIZE"], ttl=config["USER_CACHE_TTL"]),
+        login_throttle=LoginThrottle(max_attempts=config["LOGIN_ATTEMPTS_PER_MINUTE"]),
+    )
 
-connect_db(app)
+
+@event.listens_for(db.metadata, "after_drop")
+def clear_id_caches(*args, **kwargs):
+    """Dropped tables take their ids with them."""
+    if not has_app_context():
+        return
+    reference_cache.invalidate()
+    user_cache.clear()
 
 
 #########################################################################################################################
 # User signup/login/logout
 
 
-@app.before_request
+class CurrentUser:
+    """Lazy stand-in for the logged in User.
+
+    `id` comes straight from the session. Other columns are read from
+    `user_cache`, and the DB is only queried when the cache has no entry.
+    Falsy if the user has been deleted. `instance` returns the real row for
+    code that needs a session-bound User.
+    """
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self._fields = None
+
+    def _load(self):
+        if self._fields is None:
+            fields = user_cache.get(self.id)
+            if fields is None:
+                user = db.session.get(User, self.id)
+                fields = False
+                if user is not None:
+                    fields = {
+                        column.name: getattr(user, column.name)
+                        for column in User.__table__.columns
+                        if column.name != "password"
+                    }
+                user_cache.set(self.id, fields)
+            self._fields = fields
+        return self._fields
+
+    @property
+    def instance(self):
+        return db.session.get(User, self.id)
+
+    def __bool__(self):
+        return bool(self._load())
+
+    def __getattr__(self, name):
+        fields = self._load()
+        if not fields:
+            raise AttributeError(name)
+        if name in fields:
+            return fields[name]
+        return getattr(self.instance, name)
+
+
+@bp.before_app_request
+def warm_reference_cache():
+    reference_cache.warm_once()
+
+
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add a lazy curr user to Flask global."""
 
     maybe_user_id = session.get(CURR_USER_KEY)
     if maybe_user_id is not None:
-        g.user = db.session.get(User, maybe_user_id)
-    # if CURR_USER_KEY in session:
-    #     g.user = db.session.get(User, CURR_USER_KEY)
+        g.user = CurrentUser(maybe_user_id)
     else:
         g.user = None
 
@@ -60,16 +295,18 @@ def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    user_cache.delete(user.id)
 
 
 def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
+        user_cache.delete(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
 
 
-@app.route("/signup", methods=["GET", "POST"])
+@bp.route("/signup", methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -84,6 +321,9 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        if not login_throttle.allow(request.remote_addr):
+            flash("Too many attempts. Please wait a minute and try again.", "danger")
+            return render_template("users/signup.html", form=form), 429
         try:
             user = User.signup(
                 username=form.username.data,
@@ -97,6 +337,9 @@ def signup():
         except IntegrityError:
             flash("Username already taken", "danger")
             return render_template("users/signup.html", form=form)
+        except HasherBusy:
+            flash("We're busy right now. Please try again shortly.", "danger")
+            return render_template("users/signup.html", form=form), 503
 
         do_login(user)
 
@@ -106,14 +349,21 @@ def signup():
         return render_template("users/signup.html", form=form)
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data, form.password.data)
+        if not login_throttle.allow(request.remote_addr):
+            flash("Too many attempts. Please wait a minute and try again.", "danger")
+            return render_template("users/login.html", form=form), 429
+        try:
+            user = User.authenticate(form.username.data, form.password.data)
+        except HasherBusy:
+            flash("We're busy right now. Please try again shortly.", "danger")
+            return render_template("users/login.html", form=form), 503
 
         if user:
             do_login(user)
@@ -125,7 +375,7 @@ def login():
     return render_template("users/login.html", form=form)
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     """Handle logout of user."""
     do_logout()
@@ -134,9 +384,8 @@ def logout():
     return redirect("/login")
 
 
-@app.route("/users/<int:user_id>")
+@bp.route("/users/<int:user_id>")
 def get_user_data(user_id):
-    print(user_id)
     if user_id == g.user.id:
         user = g.user
         favorites = Favorite.query.filter_by(user_id=user.id)
@@ -153,17 +402,108 @@ def get_user_data(user_id):
 
 
 def get_coords(address):
-    """Get coordinates from address search."""
-    res = requests.get(
-        f"{MQ_API_BASE_URL}/address", params={"key": key_mq, "location": address}
-    )
+    """Get coordinates from address search, checking the geocode cache first.
+
+    Concurrent lookups of the same address share one MapQuest call. Expired
+    cache entries are used while the MapQuest budget is low.
+    """
+    coords = geocode_cache.get(address, any_age=mapquest_budget.low())
+    if coords is not None:
+        return coords
+    return upstream_flights.do(("mapquest", normalize_address(address)), geocode_address, address)
+
+
+def geocode_address(address):
+    """Geocode one address with MapQuest and cache the result."""
+    # Another worker may have stored it while we waited for the lock.
+    coords = geocode_cache.get(address)
+    if coords is not None:
+        return coords
+
+    res = mapquest.get("/address", params={"location": address})
     data = res.json()
     lat = data["results"][0]["locations"][0]["latLng"]["lat"]
     lng = data["results"][0]["locations"][0]["latLng"]["lng"]
     coords = {"lat": lat, "lng": lng}
+    geocode_cache.set(address, coords)
     return coords
 
 
+# MapQuest accepts at most 100 locations per batch request.
+MQ_BATCH_SIZE = 100
+
+
+def geocode_chunk(addresses):
+    """Geocode up to MQ_BATCH_SIZE addresses with one MapQuest batch call.
+
+    Returns {address: coords}; addresses MapQuest could not place are left out.
+    The addresses go in a POST body: a hundred of them would overrun URL
+    length limits as query parameters.
+    """
+    res = mapquest.post("/batch", json={"locations": addresses})
+    data = res.json()
+    found = {}
+    for address, result in zip(addresses, data.get("results", [])):
+        if result.get("locations"):
+            lat_lng = result["locations"][0]["latLng"]
+            found[address] = {"lat": lat_lng["lat"], "lng": lat_lng["lng"]}
+    return found
+
+
+def batch_geocode(addresses, refresh=False):
+    """Geocode many addresses, only sending cache misses to MapQuest.
+
+    Addresses are deduplicated on their normalized form, misses are split
+    into MQ_BATCH_SIZE chunks and the chunks are sent concurrently on the
+    upstream pool. Returns (coords by input index, failed addresses); an
+    address that failed maps to None. Raises UpstreamError only if there were
+    misses and every chunk failed. With refresh, every address is sent.
+    """
+    cached = {} if refresh else geocode_cache.get_many(addresses)
+
+    misses = {}
+    for address in addresses:
+        key = normalize_address(address)
+        if key not in cached:
+            misses.setdefault(key, address)
+
+    failed_chunks = []
+    if misses:
+        pending = list(misses.values())
+        chunks = [
+            pending[i : i + MQ_BATCH_SIZE] for i in range(0, len(pending), MQ_BATCH_SIZE)
+        ]
+        executor = current_app.extensions["upstream_executor"]
+        app = current_app._get_current_object()
+        futures = [
+            executor.submit(in_app_context, app, geocode_chunk, chunk) for chunk in chunks
+        ]
+        fetched = {}
+        error = None
+        for chunk, future in zip(chunks, futures):
+            try:
+                fetched.update(future.result())
+            except UpstreamError as exc:
+                failed_chunks.append(chunk)
+                error = exc
+        if error is not None and len(failed_chunks) == len(chunks):
+            raise error
+        if fetched:
+            geocode_cache.set_many(fetched)
+        for address, coords in fetched.items():
+            cached[normalize_address(address)] = coords
+
+    positions = {}
+    failed = []
+    for i, address in enumerate(addresses):
+        positions[i] = cached.get(normalize_address(address))
+        if positions[i] is None:
+            failed.append(address)
+    if failed:
+        logger.warning("Could not geocode %d of %d addresses.", len(failed), len(addresses))
+    return positions, failed
+
+
 def get_batch_coords(addresses):
     """Return nested dictionary of coordinates like:
     {
@@ -175,43 +515,96 @@ def get_batch_coords(addresses):
             title: "Airport Mesa",
         }
             }
+
+    Addresses that could not be geocoded map to None.
     """
 
-    params = {"key": key_mq}
-    params["location"] = addresses
-    print(params)
-    res = requests.get(f"{MQ_API_BASE_URL}/batch", params=params)
+    return batch_geocode(addresses)[0]
+
+
+def fetch_realty_data(zip_code):
+    """Call Realty Mole for a zip code; return the JSON response or None.
+
+    The figures are also upserted into zip_rental_stats; the rental cache
+    commits them along with the cached response.
+    """
+    try:
+        res = realty_mole.get(f"/{zip_code}")
+    except UpstreamError:
+        return None
+    if not res.ok:
+        return None
     data = res.json()
-    position_dict = {}
-    for i in range(len(data["results"])):
-        lat_lng_dict = {}
-        position_dict[i] = lat_lng_dict
-        # {position: [value]}
-        for j in range(len(position_dict)):
-            lat_lng_dict["lat"] = data["results"][i]["locations"][0]["latLng"]["lat"]
-            lat_lng_dict["lng"] = data["results"][i]["locations"][0]["latLng"]["lng"]
-            # print(f"Position dictionary in get_batch_coords: {position_dict}")
-    return position_dict
+    try:
+        ZipRentalStat.save_response(data)
+    except (KeyError, TypeError, ValueError):
+        logger.warning("Unexpected Realty Mole response for %s", zip_code)
+    return data
 
 
-def get_realty_data(zip_code):
-    res = requests.get(
-        f"{RM_API_BASE_URL}/{zip_code}",
-        headers={
-            "X-RapidAPI-Key": key_rm,
-            "X-RapidAPI-Host": "realty-mole-property-api.p.rapidapi.com",
-            "Content-Type": "application/json",
-        },
-    )
-    print(res)
-    if res.ok:
-        print("OK!")
-        data = res.json()
-        return data
+def local_rental_data(zip_code):
+    """Build a Realty Mole-shaped response from zip_rental_stats, or return None.
+
+    Only stats dated within RENTAL_STATS_MAX_AGE_DAYS are used, unless the
+    Realty Mole budget is low. The `detailed` list is indexed by bedroom
+    count, like the upstream one.
+    """
+    if realty_mole_budget.low():
+        fresh_after = date.min
     else:
+        max_age = current_app.config.get("RENTAL_STATS_MAX_AGE_DAYS", 30)
+        fresh_after = date.today() - timedelta(days=max_age)
+    rows = ZipRentalStat.latest(zip_code, fresh_after)
+    if not rows:
+        return None
+    detailed = [None] * (rows[-1].bedrooms + 1)
+    for row in rows:
+        detailed[row.bedrooms] = {
+            "bedrooms": row.bedrooms,
+            "averageRent": row.average_rent,
+            "minRent": row.min_rent,
+            "maxRent": row.max_rent,
+            "totalRentals": row.total_rentals,
+        }
+    return {
+        "id": str(zip_code),
+        "rentalData": {"detailed": detailed},
+        "asOf": rows[0].as_of.isoformat(),
+        "source": "local",
+    }
+
+
+def lookup_rental_data(zip_code, fetch=True):
+    """Return rental data from the rental cache, then local stats, then Realty Mole.
+
+    Cached responses are served under the rental cache's TTL and refresh
+    policy (see ZipRentalCache). On a miss, fresh local stats, e.g. imported
+    ones, are served before Realty Mole is called. With fetch=False, return
+    None rather than call it.
+    """
+    data = rental_cache.get(zip_code, fetch=False) or local_rental_data(zip_code)
+    if data is None and fetch:
+        data = rental_cache.refresh(str(zip_code))
+    return data
+
+
+def queue_rental_refresh(zip_code):
+    """Refresh a stale rental cache entry on a job worker."""
+    jobs.enqueue(
+        "rental-refresh",
+        {"zip_code": zip_code},
+        priority=jobs.REFRESH,
+        key=f"rental-refresh:{zip_code}",
+    )
+
+
+def get_realty_data(zip_code):
+    """Get rental data for a zip code; see lookup_rental_data."""
+    data = lookup_rental_data(zip_code)
+    if data is None:
         error_message = flash("Unable to find rental data for that location.", "danger")
-        print("Boo!")
         return error_message
+    return data
 
     # ENDPOINTS
 
@@ -219,12 +612,34 @@ def get_realty_data(zip_code):
 # ***************************************************************************
 
 
-@app.route("/")
+@metrics.register_collector
+def collect_cache_stats():
+    if not has_app_context():
+        return
+    caches = {
+        "geocode": geocode_cache.stats(),
+        "rental": rental_cache.stats(),
+        "user": user_cache.stats(),
+        "state": reference_cache.states.stats(),
+        "city": reference_cache.cities.stats(),
+    }
+    for name, stats in caches.items():
+        for event_name, value in stats.items():
+            metrics.cache_events.set(value, cache=name, event=event_name)
+
+
+@bp.route("/metrics")
+def show_metrics():
+    """Expose request, upstream, SQL and cache metrics to Prometheus."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/")
 def initiate():
     return redirect("/search")
 
 
-@app.route("/search")
+@bp.route("/search")
 def show_mapping():
     if not g.user:
         flash("Access unauthorized. Please log in.", "danger")
@@ -234,118 +649,969 @@ def show_mapping():
     return render_template("address_form.html", form=form)
 
 
-@app.route("/api/geocode", methods=["GET", "POST"])
+@bp.route("/api/geocode", methods=["GET", "POST"])
 def locate_on_map():
     data = request.json
-    print(f"this is /api/geocode data: {data}")
+    logger.debug("/api/geocode data: %s", data)
     full_address = (
         f"{data['address']}, {data['city']}, {data['state']}, {data['zipcode']}"
     )
-    coords = get_coords(full_address)
-    print(coords)
+    try:
+        coords = get_coords(full_address)
+    except UpstreamError:
+        return {"error": "Geocoding is temporarily unavailable."}, 503
+    store_location_coords(data["address"], coords)
     return coords
 
 
-@app.route("/api/rental-data", methods=["POST"])
+def store_location_coords(street_address, coords, provider="mapquest"):
+    """Save geocoded coordinates on the saved location with this street address."""
+    Location.query.filter_by(street_address=street_address).update(
+        {
+            "latitude": coords["lat"],
+            "longitude": coords["lng"],
+            "geohash": geo.encode(coords["lat"], coords["lng"]),
+            "geocode_provider": provider,
+            "geocoded_at": datetime.utcnow(),
+        }
+    )
+    db.session.commit()
+
+
+RENTAL_HISTORY_MAX_MONTHS = 24
+
+
+def rental_summary(data, bedrooms=None, history=0):
+    """Project a rental data response down to what the pages display.
+
+    With `bedrooms`, returns that bedroom count's figures (averageRent is
+    None when there are none). Without it, returns the average rent for
+    every bedroom count. `history` adds up to that many recent months of
+    average rents, oldest first.
+    """
+    detailed = (data.get("rentalData") or {}).get("detailed") or []
+    by_bedrooms = {entry["bedrooms"]: entry for entry in detailed if entry}
+    summary = {"zipcode": data.get("id"), "bedrooms": bedrooms}
+    if bedrooms is None:
+        summary["averages"] = {
+            str(count): entry.get("averageRent") for count, entry in sorted(by_bedrooms.items())
+        }
+    else:
+        entry = by_bedrooms.get(bedrooms, {})
+        for key in ("averageRent", "minRent", "maxRent"):
+            summary[key] = entry.get(key)
+    if history:
+        summary["history"] = rental_history(data, bedrooms, history)
+    return summary
+
+
+def rental_history(data, bedrooms, months):
+    """Return [{"month", "averageRent"}] for the most recent `months` months."""
+    if data.get("source") == "local":
+        rows = ZipRentalStat.history(data["id"], bedrooms, months)
+        return [
+            {"month": row.as_of.strftime("%Y-%m"), "averageRent": row.average_rent}
+            for row in rows
+        ]
+
+    series = (data.get("rentalData") or {}).get("history") or {}
+    result = []
+    for month in sorted(series)[-months:]:
+        if bedrooms is None:
+            average = series[month].get("averageRent")
+        else:
+            entry = next(
+                (d for d in series[month].get("detailed") or [] if d.get("bedrooms") == bedrooms),
+                {},
+            )
+            average = entry.get("averageRent")
+        result.append({"month": month, "averageRent": average})
+    return result
+
+
+@bp.route("/api/rental-data", methods=["GET", "POST"])
 def get_rental_data():
-    print(request)
-    data = request.json
-    print(f"This is /api/rental-data data: {data}")
-    zip_code = data["zipcode"]
-    print(zip_code)
+    """Return a compact summary of a zip code's rental data.
+
+    Takes `zipcode`, and optionally `bedrooms` and `history` (months), as
+    JSON (POST) or in the query string (GET). GET responses carry an ETag
+    and answer a matching If-None-Match with 304 Not Modified. Missing or
+    non-numeric values get a 400.
+    """
+    data = request.json if request.method == "POST" else request.args
+    logger.debug("/api/rental-data data: %s", data)
+    try:
+        zip_code = data["zipcode"]
+        bedrooms = data.get("bedrooms")
+        bedrooms = int(bedrooms) if bedrooms not in (None, "") else None
+        history = min(int(data.get("history") or 0), RENTAL_HISTORY_MAX_MONTHS)
+    except (KeyError, TypeError, ValueError):
+        return {"error": "Pass a zipcode, and whole numbers for bedrooms and history."}, 400
     rental_data = get_realty_data(zip_code)
     if rental_data is None:
         return "error"
-    else:
-        return rental_data
+
+    summary = rental_summary(rental_data, bedrooms, history)
+    response = current_app.json.response(summary)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
-@app.route("/adddata", methods=["GET", "POST"])
+@bp.route("/adddata", methods=["GET", "POST"])
 def save_search_to_db():
     data = request.json
-    print(data)
+    return save_location(data)
 
+
+def save_location(data):
+    """Save the state, city and location of an address search to the DB."""
     state = data["state"].capitalize()
-    print(state)
     city = data["city"].capitalize()
     address = data["address"]
     zipcode = data["zipcode"]
     bedrooms = data["bedrooms"]
 
-    # add form value for state to DB
-    # state_exists = db.session.query(State.name).filter_by(name=state).first()
-    state_exists = State.query.filter_by(name=state).first()
-    new_state = ""
-    if state_exists is None:
-        new_state = State(name=state)
-        db.session.add(new_state)
-        db.session.commit()
-        print(f" This is {new_state.name}")
+    # upsert the state -> city -> location hierarchy in one transaction,
+    # skipping the state and city statements when their ids are cached
+    try:
+        save_location_rows(state, city, address, zipcode, bedrooms)
+    except IntegrityError:
+        # A cached id may point at a row another worker deleted.
+        db.session.rollback()
+        reference_cache.invalidate()
+        save_location_rows(state, city, address, zipcode, bedrooms)
+    return data
+
+
+def reference_ids(pairs):
+    """Return {(state, city): city_id}, upserting states and cities that are not cached.
+
+    Newly created ids are only cached once the caller's transaction has
+    committed; call the returned function after committing.
+    """
+    city_ids = {}
+    new_states = {}
+    new_cities = {}
+    for state, city in pairs:
+        state_id = reference_cache.get_state(state)
+        if state_id is None:
+            state_id = new_states.get(state) or State.upsert(state)
+            new_states[state] = state_id
+        city_id = reference_cache.get_city(city, state_id)
+        if city_id is None:
+            city_id = City.upsert(city, state_id)
+            new_cities[(city, state_id)] = city_id
+        city_ids[(state, city)] = city_id
+
+    def remember():
+        for state, state_id in new_states.items():
+            reference_cache.set_state(state, state_id)
+        for (city, state_id), city_id in new_cities.items():
+            reference_cache.set_city(city, state_id, city_id)
+
+    return city_ids, remember
+
+
+def save_location_rows(state, city, address, zipcode, bedrooms):
+    city_ids, remember = reference_ids([(state, city)])
+    Location.upsert(address, zipcode, city_ids[(state, city)], bedrooms, g.user.id)
+    db.session.commit()
+    remember()
+
+
+def in_app_context(app, func, *args):
+    """Run func(*args) inside an app context, for use on worker threads."""
+    with app.app_context():
+        return func(*args)
+
+
+@bp.route("/api/search", methods=["POST"])
+def search():
+    """Save a search and look up its coordinates and rental data in one call.
+
+    The MapQuest and Realty Mole lookups run concurrently on the upstream
+    pool while the location is written to the DB.
+    """
+    data = request.json
+    full_address = (
+        f"{data['address']}, {data['city']}, {data['state']}, {data['zipcode']}"
+    )
+    if current_app.config["JOBS_ASYNC"]:
+        return search_later(data, full_address)
+
+    app = current_app._get_current_object()
+    executor = app.extensions["upstream_executor"]
+    coords_future = executor.submit(in_app_context, app, get_coords, full_address)
+    rental_future = executor.submit(
+        in_app_context, app, lookup_rental_data, data["zipcode"]
+    )
+
+    location = save_location(data)
+
+    result = {"location": location, "coords": None, "rental_data": None}
+    try:
+        result["coords"] = coords_future.result()
+    except UpstreamError:
+        result["error"] = "Geocoding is temporarily unavailable."
     else:
-        # state = state_exists
-        print("State already exists in the database.")
-    print(new_state)
-
-    # add form value for city to DB
-    city_exists = City.query.filter_by(name=city).first()
-    new_city = ""
-    if city_exists is None:
-        if new_state == "":
-            state_obj = State.query.filter_by(name=state).first()
-        else:
-            state_obj = State.query.filter_by(name=new_state.name).first()
-        print(state_obj)
-        new_city = City(name=city, state_id=state_obj.id)
-        db.session.add(new_city)
-        db.session.commit()
+        store_location_coords(data["address"], result["coords"])
+    rental_data = rental_future.result()
+    if rental_data is None:
+        flash("Unable to find rental data for that location.", "danger")
+        result["error"] = "Unable to find rental data for that location."
     else:
-        # city = city_exists
-        print("City already exists in the database.")
-    print(new_city)
-
-    # add location to Db
-    location_exists = Location.query.filter_by(street_address=address).first()
-    new_location = ""
-    if location_exists is None:
-        if new_city == "":
-            city_obj = City.query.filter_by(name=city).first()
-        else:
-            city_obj = City.query.filter_by(name=new_city.name).first()
-        print(city_obj)
-        new_location = Location(
-            street_address=address,
-            zip_code=zipcode,
-            city_id=city_obj.id,
-            bedrooms=bedrooms,
+        result["rental_data"] = rental_summary(rental_data, int(data["bedrooms"]))
+    return result
+
+
+def search_later(data, full_address):
+    """Answer a search from the caches, queueing jobs for whatever they lack.
+
+    Responds 202 with the ids of those jobs under `jobs`, keyed by the
+    field they will fill in; the page polls /api/jobs/<id> for each. A
+    repeated search by the same user gets the jobs already queued.
+    """
+    location = save_location(data)
+    bedrooms = int(data["bedrooms"])
+    result = {"location": location, "coords": None, "rental_data": None, "jobs": {}}
+
+    coords = geocode_cache.get(full_address, any_age=mapquest_budget.low())
+    if coords is None:
+        job = jobs.enqueue(
+            "geocode-address",
+            {"address": full_address, "street_address": data["address"]},
+            priority=jobs.INTERACTIVE,
+            key=f"geocode-address:{g.user.id}:{normalize_address(full_address)}",
             user_id=g.user.id,
         )
-        db.session.add(new_location)
-        db.session.commit()
+        result["jobs"]["coords"] = job.id
     else:
-        # location = location_exists
-        print("Location already exists in database.")
-    return data
+        store_location_coords(data["address"], coords)
+        result["coords"] = coords
+
+    rental_data = lookup_rental_data(data["zipcode"], fetch=False)
+    if rental_data is None:
+        job = jobs.enqueue(
+            "rental-data",
+            {"zip_code": str(data["zipcode"]), "bedrooms": bedrooms},
+            priority=jobs.INTERACTIVE,
+            key=f"rental-data:{g.user.id}:{data['zipcode']}:{bedrooms}",
+            user_id=g.user.id,
+        )
+        result["jobs"]["rental_data"] = job.id
+    else:
+        result["rental_data"] = rental_summary(rental_data, bedrooms)
+    return result, 202 if result["jobs"] else 200
+
+
+FAVORITES_PER_PAGE = 100
+FAVORITES_MAX_PER_PAGE = 500
+
+
+def favorite_locations(user_id):
+    """Return one row per location user_id favorited, in the order it was favorited.
+
+    Favorites, their locations and cities are read with a single joined
+    query and deduplicated on (street address, zip code). Pass `page` (and
+    optionally `per_page`) in the query string to read one page at a time.
+    """
+    query = (
+        db.session.query(
+            Favorite.rent_average,
+            Location.id,
+            Location.street_address,
+            Location.zip_code,
+            Location.bedrooms,
+            Location.latitude,
+            Location.longitude,
+            City.name.label("city"),
+        )
+        .join(Location, Favorite.location_id == Location.id)
+        .outerjoin(City, Location.city_id == City.id)
+        .filter(Favorite.user_id == user_id)
+        .order_by(Favorite.id)
+    )
+
+    page = request.args.get("page", type=int)
+    if page:
+        per_page = min(
+            request.args.get("per_page", FAVORITES_PER_PAGE, type=int),
+            FAVORITES_MAX_PER_PAGE,
+        )
+        query = query.limit(per_page).offset((page - 1) * per_page)
+
+    rows = {}
+    for row in query:
+        rows.setdefault((row.street_address, row.zip_code), row)
+    return list(rows.values())
 
 
-@app.route("/api/batchgeocode", methods=["GET", "POST"])
+@bp.route("/api/batchgeocode", methods=["GET", "POST"])
 def get_favorites_coords():
-    addresses = []
-    favorites = Favorite.query.all()
-    for favorite in favorites:
-        location = Location.query.filter_by(id=favorite.location_id).first()
-        print(f"This is /api/batchgeocode location matching: {location.id}")
-        # location_id = db.session.query(Location.id).filter_by(
-        #     id=favorite.location_id).first()
-        # location = Location.query.get(location_id)
-        address = f"{location.street_address} {location.zip_code}"
-        if address not in addresses:
-            addresses.append(address)
-    print(f"This is the list of addresses in /api/batchgeocode: {addresses}")
-    coords = get_batch_coords(addresses)
+    if not g.user:
+        return {"error": "Access unauthorized. Please log in."}, 401
+
+    rows = favorite_locations(g.user.id)
+    coords = {}
+    missing = []
+    for i, row in enumerate(rows):
+        if row.latitude is not None:
+            coords[i] = {"lat": row.latitude, "lng": row.longitude}
+        else:
+            missing.append(i)
+
+    failed = []
+    if missing and current_app.config["JOBS_ASYNC"]:
+        job = jobs.enqueue(
+            "geocode-locations",
+            {"location_ids": [rows[i].id for i in missing]},
+            priority=jobs.INTERACTIVE,
+            key=f"geocode-locations:{g.user.id}",
+            user_id=g.user.id,
+        )
+        # The page fetches the rest again once the job has finished.
+        return dict(sorted(coords.items())), 202, {"X-Geocode-Job": str(job.id)}
+    if missing:
+        # Only locations saved before coordinates were stored reach MapQuest.
+        try:
+            found, failed = geocode_locations([rows[i] for i in missing])
+        except UpstreamError:
+            return {"error": "Geocoding is temporarily unavailable."}, 503
+        for i, position in zip(missing, found):
+            coords[i] = position
+    return dict(sorted(coords.items())), 200, {"X-Geocode-Failed": str(len(failed))}
+
+
+def location_address(row):
+    zip_code = str(row.zip_code).zfill(5)
+    if row.city:
+        return f"{row.street_address}, {row.city} {zip_code}"
+    return f"{row.street_address} {zip_code}"
+
+
+def geocode_locations(rows):
+    """Geocode location rows (with id, street_address, zip_code, city) and store the results.
+
+    Returns (coords in row order, failed addresses).
+    """
+    positions, failed = batch_geocode([location_address(row) for row in rows])
+    now = datetime.utcnow()
+    updates = [
+        {
+            "id": row.id,
+            "latitude": positions[i]["lat"],
+            "longitude": positions[i]["lng"],
+            "geohash": geo.encode(positions[i]["lat"], positions[i]["lng"]),
+            "geocode_provider": "mapquest",
+            "geocoded_at": now,
+        }
+        for i, row in enumerate(rows)
+        if positions[i] is not None
+    ]
+    if updates:
+        db.session.execute(update(Location), updates)
+        db.session.commit()
+    return [positions[i] for i in range(len(rows))], failed
+
+
+@bp.route("/api/jobs/<int:job_id>")
+def job_status(job_id):
+    """Report a background job's status, and its result once done.
+
+    Pass `wait` (seconds, at most JOBS_LONG_POLL_MAX) to hold the request
+    until the job has finished.
+    """
+    if not g.user:
+        return {"error": "Access unauthorized. Please log in."}, 401
+
+    job = db.session.get(Job, job_id)
+    if job is None or job.user_id != g.user.id:
+        return {"error": "No such job."}, 404
+    wait = min(request.args.get("wait", 0, type=float), current_app.config["JOBS_LONG_POLL_MAX"])
+    if wait > 0 and job.status not in jobs.FINISHED:
+        job = jobs.wait_for(job_id, wait)
+    return jobs.status(job), 200, {"Cache-Control": "no-store"}
+
+
+@jobs.handler("geocode-address")
+def geocode_address_job(address, street_address=None):
+    """Geocode a searched address and store it on the saved location."""
+    coords = get_coords(address)
+    if street_address is not None:
+        store_location_coords(street_address, coords)
     return coords
 
 
-@app.route("/favorites")
+@jobs.handler("rental-data")
+def rental_data_job(zip_code, bedrooms=None):
+    """Look up a zip code's rental data and summarize it for the search page."""
+    data = lookup_rental_data(zip_code)
+    if data is None:
+        return None
+    return rental_summary(data, bedrooms)
+
+
+@jobs.handler("rental-refresh")
+def rental_refresh_job(zip_code):
+    """Fetch a zip code's rental data into the cache, unless it is fresh already."""
+    return rental_cache.refresh(zip_code) is not None
+
+
+@jobs.handler("geocode-locations")
+def geocode_locations_job(location_ids):
+    """Geocode saved locations that still have no coordinates."""
+    rows = (
+        db.session.query(
+            Location.id, Location.street_address, Location.zip_code, City.name.label("city")
+        )
+        .outerjoin(City, Location.city_id == City.id)
+        .filter(Location.id.in_(location_ids), Location.latitude.is_(None))
+        .order_by(Location.id)
+        .all()
+    )
+    if not rows:
+        return {"geocoded": 0, "failed": 0}
+    _, failed = geocode_locations(rows)
+    return {"geocoded": len(rows) - len(failed), "failed": len(failed)}
+
+
+@jobs.handler("warm-cache")
+def warm_cache_job(zip_codes=(), addresses=(), within=0):
+    """Load rental data and coordinates into the caches ahead of searches.
+
+    Entries that will still be fresh `within` seconds from now are left alone.
+    """
+    max_age = max(rental_cache.ttl - within, 0)
+    refreshed = sum(
+        rental_cache.refresh(str(zip_code), max_age=max_age) is not None
+        for zip_code in zip_codes
+    )
+    geocoded = 0
+    addresses = geocode_cache.expiring(list(addresses), within)
+    if addresses:
+        _, failed = batch_geocode(addresses, refresh=True)
+        geocoded = len(addresses) - len(failed)
+    return {"zip_codes": refreshed, "addresses": geocoded}
+
+
+# Zip codes refreshed per warm-cache job.
+PREWARM_ZIPS_PER_JOB = 25
+
+
+def plan_prewarm():
+    """Queue warm-cache jobs for the hottest entries that expire before the next run.
+
+    At most PREWARM_RENTAL_CALLS zip codes and PREWARM_GEOCODE_CALLS
+    MapQuest batches of favorited addresses are queued, and none for a
+    provider whose call budget is low. Returns how many of each were queued.
+    """
+    config = current_app.config
+    within = config["PREWARM_HORIZON_HOURS"] * 3600
+    rental_calls = 0 if realty_mole_budget.low() else config["PREWARM_RENTAL_CALLS"]
+    geocode_calls = 0 if mapquest_budget.low() else config["PREWARM_GEOCODE_CALLS"]
+
+    zip_codes = prewarm.collect(
+        prewarm.hot_zip_codes(), lambda batch: rental_cache.expiring(batch, within), rental_calls
+    )
+    addresses = prewarm.collect(
+        prewarm.favorite_addresses(),
+        lambda batch: geocode_cache.expiring(batch, within),
+        geocode_calls * MQ_BATCH_SIZE,
+    )
+    for field, items, size in (
+        ("zip_codes", zip_codes, PREWARM_ZIPS_PER_JOB),
+        ("addresses", addresses, MQ_BATCH_SIZE),
+    ):
+        for i in range(0, len(items), size):
+            jobs.enqueue(
+                "warm-cache", {field: items[i : i + size], "within": within}, priority=jobs.WARM
+            )
+    return {"zip_codes": len(zip_codes), "addresses": len(addresses)}
+
+
+def schedule_prewarm(now=None, soonest=False):
+    """Queue the next prewarm run for the start of PREWARM_WINDOW.
+
+    With soonest, run at once if the window is open now.
+    """
+    now = now or datetime.utcnow()
+    window = prewarm.parse_window(current_app.config["PREWARM_WINDOW"])
+    if soonest and prewarm.in_window(now, window):
+        start = now
+    else:
+        start = prewarm.next_window_start(now, window)
+    return jobs.enqueue(
+        "prewarm", priority=jobs.WARM, key="prewarm", delay=(start - now).total_seconds()
+    )
+
+
+@jobs.handler("prewarm")
+def prewarm_job(repeat=True):
+    """Warm the caches if the off-peak window is open, then book the next run."""
+    now = datetime.utcnow()
+    window = prewarm.parse_window(current_app.config["PREWARM_WINDOW"])
+    queued = {"zip_codes": 0, "addresses": 0}
+    if prewarm.in_window(now, window):
+        geocode_cache.purge_expired()
+        queued = plan_prewarm()
+    if repeat:
+        schedule_prewarm(now)
+    return queued
+
+
+def run_worker(app, kinds, burst):
+    """Run jobs until SIGINT or SIGTERM; the job in hand is finished first."""
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+    with app.app_context():
+        return jobs.work(kinds, burst=burst, stop=stop)
+
+
+@bp.cli.command("run-jobs")
+@click.option("--processes", default=1, help="Worker processes to start.")
+@click.option("--kind", "kinds", multiple=True, help="Only run jobs of this kind; repeatable.")
+@click.option("--burst", is_flag=True, help="Exit once the queue is empty.")
+def run_jobs(processes, kinds, burst):
+    """Run background jobs (geocoding, rental refreshes, cache warming)."""
+    app = current_app._get_current_object()
+    if processes <= 1:
+        count = run_worker(app, kinds, burst)
+        click.echo(f"Ran {count} jobs.")
+        return
+
+    # Children must open their own connections rather than share the pool's.
+    db.engine.dispose()
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=run_worker, args=(app, kinds, burst)) for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            try:
+                worker.join()
+            except KeyboardInterrupt:
+                # The workers got the signal too and stop after their current job.
+                pass
+
+
+@bp.cli.command("prewarm")
+@click.option(
+    "--schedule", is_flag=True, help="Warm every day in PREWARM_WINDOW instead of now."
+)
+def prewarm_command(schedule):
+    """Queue cache warming for hot zip codes and favorited addresses."""
+    if schedule:
+        job = schedule_prewarm(soonest=True)
+        click.echo(f"Prewarming scheduled from {job.run_at:%Y-%m-%d %H:%M} UTC.")
+        return
+    queued = plan_prewarm()
+    click.echo(
+        f"Queued {queued['zip_codes']} zip codes and {queued['addresses']} addresses "
+        "for warming."
+    )
+
+
+@bp.cli.command("purge-geocodes")
+def purge_geocodes():
+    """Delete cached geocodes older than GEOCODE_DB_TTL."""
+    click.echo(f"Removed {geocode_cache.purge_expired()} expired geocodes.")
+
+
+@bp.cli.command("backfill-coords")
+@click.option("--batch-size", default=500, help="Locations geocoded per round.")
+def backfill_coords(batch_size):
+    """Geocode saved locations that have no stored coordinates."""
+    # Locations geocoded before geohashes were stored only need the hash.
+    for row in db.session.query(Location.id, Location.latitude, Location.longitude).filter(
+        Location.latitude.isnot(None), Location.geohash.is_(None)
+    ):
+        db.session.execute(
+            update(Location),
+            [{"id": row.id, "geohash": geo.encode(row.latitude, row.longitude)}],
+        )
+    db.session.commit()
+
+    last_id = 0
+    done = failed = 0
+    while True:
+        rows = (
+            db.session.query(
+                Location.id, Location.street_address, Location.zip_code, City.name.label("city")
+            )
+            .outerjoin(City, Location.city_id == City.id)
+            .filter(Location.latitude.is_(None), Location.id > last_id)
+            .order_by(Location.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        _, batch_failed = geocode_locations(rows)
+        done += len(rows) - len(batch_failed)
+        failed += len(batch_failed)
+        click.echo(f"Geocoded {done} locations, {failed} failed.")
+
+
+def rental_stat_rows(path):
+    """Yield zip_rental_stats rows from a CSV, JSON or JSON Lines file.
+
+    CSV files need a header naming ZipRentalStat.COLUMNS. JSON files hold
+    one Realty Mole /zipCodes response or a list of them; JSON Lines files
+    hold one response per line. CSV and JSON Lines are streamed.
+    """
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            for record in csv.DictReader(f):
+                row = {column: record[column] or None for column in ZipRentalStat.COLUMNS}
+                row["bedrooms"] = int(row["bedrooms"])
+                row["as_of"] = date.fromisoformat(row["as_of"])
+                for column in ("average_rent", "min_rent", "max_rent"):
+                    if row[column] is not None:
+                        row[column] = float(row[column])
+                if row["total_rentals"] is not None:
+                    row["total_rentals"] = int(row["total_rentals"])
+                yield row
+        elif path.endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    yield from ZipRentalStat.rows_from_response(json.loads(line))
+        else:
+            responses = json.load(f)
+            if isinstance(responses, dict):
+                responses = [responses]
+            for response in responses:
+                yield from ZipRentalStat.rows_from_response(response)
+
+
+@bp.cli.command("import-rental-stats")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=500, help="Rows upserted per statement.")
+def import_rental_stats(paths, batch_size):
+    """Load Realty Mole rental figures into zip_rental_stats.
+
+    Each batch is upserted on (zip code, bedrooms, date) and committed, so
+    re-running an import is safe.
+    """
+    total = 0
+    for path in paths:
+        batch = []
+        for row in rental_stat_rows(path):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                bulk_upsert(ZipRentalStat, ["zip_code", "bedrooms", "as_of"], batch)
+                db.session.commit()
+                total += len(batch)
+                batch = []
+                click.echo(f"Imported {total} rows.")
+        if batch:
+            bulk_upsert(ZipRentalStat, ["zip_code", "bedrooms", "as_of"], batch)
+            db.session.commit()
+            total += len(batch)
+        click.echo(f"Imported {total} rows ({path} done).")
+
+
+@bp.cli.command("seed-data")
+@click.option("--users", default=1000, show_default=True)
+@click.option("--locations-per-user", default=5, show_default=True, help="Mean saved searches per user.")
+@click.option("--favorites-per-user", default=3, show_default=True, help="Mean favorites per user.")
+@click.option("--cities", default=500, show_default=True)
+@click.option("--zip-codes", default=2000, show_default=True, help="Distinct zip codes.")
+@click.option("--zip-skew", default=1.0, show_default=True,
+              help="Zipf exponent for zip code and city popularity; 0 is uniform.")
+@click.option("--geocoded", default=0.8, show_default=True,
+              help="Fraction of locations with stored coordinates.")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows per insert and commit.")
+@click.option("--seed", "seed_value", default=0, show_default=True, help="Random seed.")
+@click.option("--password", default="password", show_default=True, help="Password for every user.")
+def seed_data(seed_value, **options):
+    """Bulk-insert synthetic users, locations and favorites."""
+    started = time.perf_counter()
+    counts = seed.seed_database(db.engine, seed=seed_value, progress=click.echo, **options)
+    click.echo(
+        f"Seeded {counts['users']} users, {counts['locations']} locations and "
+        f"{counts['favorites']} favorites in {time.perf_counter() - started:.1f}s."
+    )
+
+
+ADDRESS_IMPORT_CHUNK = 500
+# Accepted spellings of each column in an address CSV header.
+ADDRESS_CSV_COLUMNS = {
+    "address": ("address", "street", "street_address"),
+    "city": ("city",),
+    "state": ("state",),
+    "zipcode": ("zipcode", "zip", "zip_code"),
+    "bedrooms": ("bedrooms", "beds"),
+}
+
+
+def read_address_csv(lines):
+    """Yield (line number, row dict or None) for each data row of an address CSV.
+
+    Values are normalized the way the search form saves them; None marks a
+    row that is missing a value or has a malformed zip code or bedroom
+    count. Reads one line at a time.
+    """
+    reader = csv.reader(lines)
+    header = [name.strip().lower() for name in next(reader, [])]
+    positions = {}
+    for field, names in ADDRESS_CSV_COLUMNS.items():
+        matches = [header.index(name) for name in names if name in header]
+        if not matches:
+            raise ValueError(f"CSV header has no {field} column.")
+        positions[field] = matches[0]
+
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        try:
+            raw = {field: values[i].strip() for field, i in positions.items()}
+            row = {
+                "address": " ".join(raw["address"].split()),
+                "city": raw["city"].capitalize(),
+                "state": raw["state"].capitalize(),
+                "zipcode": raw["zipcode"].zfill(5),
+                "bedrooms": int(raw["bedrooms"]),
+            }
+        except (IndexError, ValueError):
+            row = None
+        if row and not (
+            row["address"] and row["city"] and row["state"]
+            and len(row["zipcode"]) == 5 and row["zipcode"].isdigit()
+            and 0 <= row["bedrooms"] <= 10
+        ):
+            row = None
+        yield reader.line_num, row
+
+
+def import_address_chunk(rows, user_id):
+    """Geocode, price and save one chunk of normalized address rows for a user.
+
+    Returns counts of rows saved, favorited (rental data found), and not
+    geocoded. Existing locations keep their owner; any stored coordinates
+    are kept too.
+    """
+    rows = list({row["address"]: row for row in rows}.values())
+    # Rental lookups for the chunk's zip codes run while it is geocoded.
+    app = current_app._get_current_object()
+    executor = app.extensions["upstream_executor"]
+    rental_futures = {
+        zip_code: executor.submit(in_app_context, app, lookup_rental_data, zip_code)
+        for zip_code in {row["zipcode"] for row in rows}
+    }
+    full_addresses = [
+        f"{row['address']}, {row['city']}, {row['state']}, {row['zipcode']}" for row in rows
+    ]
+    try:
+        positions, failed = batch_geocode(full_addresses)
+    except UpstreamError:
+        positions, failed = {i: None for i in range(len(rows))}, full_addresses
+    averages = {zip_code: future.result() for zip_code, future in rental_futures.items()}
+
+    city_ids, remember = reference_ids({(row["state"], row["city"]) for row in rows})
+    bulk_upsert(
+        Location,
+        ["street_address"],
+        [
+            {
+                "street_address": row["address"],
+                "zip_code": row["zipcode"],
+                "city_id": city_ids[(row["state"], row["city"])],
+                "bedrooms": row["bedrooms"],
+                "user_id": user_id,
+            }
+            for row in rows
+        ],
+        update_columns=[],
+    )
+    saved = {
+        location.street_address: location
+        for location in db.session.query(Location.id, Location.street_address, Location.latitude)
+        .filter(Location.street_address.in_([row["address"] for row in rows]))
+    }
+
+    now = datetime.utcnow()
+    coordinates = []
+    favorites = []
+    for i, row in enumerate(rows):
+        location = saved[row["address"]]
+        if positions[i] is not None and location.latitude is None:
+            coordinates.append({
+                "id": location.id,
+                "latitude": positions[i]["lat"],
+                "longitude": positions[i]["lng"],
+                "geohash": geo.encode(positions[i]["lat"], positions[i]["lng"]),
+                "geocode_provider": "mapquest",
+                "geocoded_at": now,
+            })
+        rental_data = averages[row["zipcode"]]
+        average = rental_data and rental_summary(rental_data, row["bedrooms"])["averageRent"]
+        if average is not None:
+            favorites.append(
+                {"user_id": user_id, "location_id": location.id, "rent_average": round(average)}
+            )
+    if coordinates:
+        db.session.execute(update(Location), coordinates)
+    bulk_upsert(Favorite, ["user_id", "location_id"], favorites)
+    db.session.commit()
+    remember()
+    return {"saved": len(rows), "favorited": len(favorites), "not_geocoded": len(failed)}
+
+
+def import_addresses(lines, user_id, chunk_size=ADDRESS_IMPORT_CHUNK):
+    """Import an address CSV for a user, yielding running totals after each chunk.
+
+    Rows are read, geocoded and saved chunk_size at a time, so memory use
+    does not grow with the file. Invalid rows are counted and skipped.
+    """
+    totals = {"rows": 0, "saved": 0, "favorited": 0, "not_geocoded": 0, "invalid": 0}
+    chunk = []
+
+    def run(chunk):
+        try:
+            counts = import_address_chunk(chunk, user_id)
+        except IntegrityError:
+            # A cached id may point at a row another worker deleted.
+            db.session.rollback()
+            reference_cache.invalidate()
+            counts = import_address_chunk(chunk, user_id)
+        for key, value in counts.items():
+            totals[key] += value
+
+    for _, row in read_address_csv(lines):
+        totals["rows"] += 1
+        if row is None:
+            totals["invalid"] += 1
+            continue
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            run(chunk)
+            chunk = []
+            yield dict(totals)
+    if chunk:
+        run(chunk)
+    yield dict(totals)
+
+
+@bp.cli.command("import-addresses")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--user", "username", required=True, help="Username to save the locations for.")
+@click.option("--chunk-size", default=ADDRESS_IMPORT_CHUNK, show_default=True)
+def import_addresses_command(path, username, chunk_size):
+    """Import a CSV of address, city, state, zipcode and bedrooms as favorites."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter(f"No user named {username}.", param_hint="--user")
+    with open(path, newline="") as f:
+        for totals in import_addresses(f, user.id, chunk_size):
+            click.echo(
+                f"{totals['rows']} rows: {totals['saved']} saved, {totals['favorited']} "
+                f"favorited, {totals['not_geocoded']} not geocoded, {totals['invalid']} invalid."
+            )
+
+
+@bp.route("/api/import", methods=["POST"])
+def import_addresses_upload():
+    """Import an uploaded address CSV (`file`) into the user's favorites.
+
+    Streams one JSON line of running totals per chunk, so large files
+    report progress as they go; the last line is the final result.
+    """
+    if not g.user:
+        return {"error": "Access unauthorized. Please log in."}, 401
+    upload = request.files.get("file")
+    if upload is None:
+        return {"error": "Attach a CSV file as 'file'."}, 400
+
+    lines = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+    progress = import_addresses(lines, g.user.id)
+    try:
+        first = next(progress)
+    except ValueError as exc:
+        return {"error": str(exc)}, 400
+
+    def generate():
+        yield json.dumps(first) + "\n"
+        for totals in progress:
+            yield json.dumps(totals) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+SPATIAL_MAX_RESULTS = 500
+
+
+@bp.route("/api/locations/within")
+def locations_within():
+    """Return the user's saved locations or favorites inside a map area.
+
+    Query string takes either `bbox=south,west,north,east` or
+    `lat`, `lng` and `radius` (miles). `scope` is "favorites" (default) or
+    "locations"; `limit` caps the number of results. Radius results are
+    sorted nearest first.
+    """
+    if not g.user:
+        return {"error": "Access unauthorized. Please log in."}, 401
+
+    center = None
+    try:
+        if "bbox" in request.args:
+            south, west, north, east = (float(v) for v in request.args["bbox"].split(","))
+        else:
+            lat = float(request.args["lat"])
+            lng = float(request.args["lng"])
+            radius = float(request.args["radius"])
+            center = (lat, lng, radius)
+            south, west, north, east = geo.radius_bbox(lat, lng, radius)
+    except (KeyError, ValueError):
+        return {"error": "Pass bbox=south,west,north,east or lat, lng and radius."}, 400
+    limit = min(request.args.get("limit", SPATIAL_MAX_RESULTS, type=int), SPATIAL_MAX_RESULTS)
+
+    columns = [
+        Location.id,
+        Location.street_address,
+        Location.zip_code,
+        Location.bedrooms,
+        Location.latitude,
+        Location.longitude,
+    ]
+    if request.args.get("scope", "favorites") == "locations":
+        query = db.session.query(*columns).filter(Location.user_id == g.user.id)
+    else:
+        query = (
+            db.session.query(*columns, Favorite.rent_average)
+            .join(Favorite, Favorite.location_id == Location.id)
+            .filter(Favorite.user_id == g.user.id)
+        )
+
+    cells = geo.cover(south, west, north, east)
+    query = query.filter(
+        or_(*[Location.geohash.between(cell, cell + "~") for cell in cells]),
+        Location.latitude.between(south, north),
+        Location.longitude.between(west, east),
+    )
+
+    results = []
+    for row in query.limit(None if center else limit):
+        item = dict(row._mapping)
+        if center:
+            item["distance"] = geo.distance_miles(
+                center[0], center[1], row.latitude, row.longitude
+            )
+            if item["distance"] > center[2]:
+                continue
+        results.append(item)
+    if center:
+        results = sorted(results, key=lambda item: item["distance"])[:limit]
+    return results
+
+
+@bp.route("/favorites")
 def display_favorites():
     if not g.user:
         flash("Access unauthorized. Please log in.", "danger")
@@ -354,45 +1620,39 @@ def display_favorites():
     return render_template("favs_map.html")
 
 
-@app.route("/favorites/add", methods=["GET", "POST"])
+@bp.route("/favorites/add", methods=["GET", "POST"])
 def add_favorites():
     data = request.json
-    print(data)
+    logger.debug("/favorites/add data: %s", data)
 
     average = data["average"]
     address = data["address"]
 
     location = Location.query.filter_by(street_address=address).first()
-    print(f"The location ID for {location.street_address} is {location.id}")
-    # IF location_id.id IN favorites.location_id
-    favorite_location_id_exists = Favorite.query.filter_by(
-        location_id=location.id
+    favorite_exists = Favorite.query.filter_by(
+        user_id=g.user.id, location_id=location.id
     ).first()
-    if favorite_location_id_exists is None:
-        location_obj = Location.query.filter_by(street_address=address).first()
-        print(location_obj)
+    if favorite_exists is None:
         new_favorite = Favorite(
-            rent_average=average, user_id=g.user.id, location_id=location_obj.id
+            rent_average=average, user_id=g.user.id, location_id=location.id
         )
         db.session.add(new_favorite)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent request saved the same favorite first.
+            db.session.rollback()
     else:
-        print("Already a favorite.")
+        logger.debug("Location %s is already a favorite.", location.id)
     return render_template("favs_map.html", average=average)
 
 
-@app.route("/favorites/data")
+@bp.route("/favorites/data")
 def get_favorites_data():
-    favorites = Favorite.query.all()
-    addresses = []
-    for favorite in favorites:
-        print(favorite)
-        location_id = (
-            db.session.query(Location.id).filter_by(id=favorite.location_id).first()
-        )
-        location = Location.query.get(location_id)
-        rent = favorite.rent_average
-        address = f"{location.street_address} {location.zip_code} Bedrooms: {location.bedrooms} Rent: {rent}"
-        if address not in addresses:
-            addresses.append(address)
-    return addresses
+    if not g.user:
+        return {"error": "Access unauthorized. Please log in."}, 401
+
+    return [
+        f"{row.street_address} {row.zip_code} Bedrooms: {row.bedrooms} Rent: {row.rent_average}"
+        for row in favorite_locations(g.user.id)
+    ]
@@ -0,0 +1,395 @@
+"""Offline load benchmark for MoveIn.
+
+Starts local stand-ins for the MapQuest geocoding and Realty Mole zip code
+APIs, seeds a database, serves the app on a local port and drives its
+endpoints from a pool of client threads. For each endpoint it reports
+throughput, p50/p95/p99 latency and SQL statements per request, and can
+compare the run against a saved baseline:
+
+    python benchmark.py --users 500 --concurrency 16 --output bench_out/main.json
+    python benchmark.py --users 500 --concurrency 16 --baseline bench_out/main.json
+
+Use --database-url to benchmark against Postgres; the default is a
+throwaway SQLite file, which serializes writes.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import click
+import requests
+from werkzeug.serving import make_server
+
+import metrics
+import seed
+
+ENDPOINTS = {
+    "adddata": "/adddata",
+    "geocode": "/api/geocode",
+    "rental-data": "/api/rental-data",
+    "favorites-data": "/favorites/data",
+    "batchgeocode": "/api/batchgeocode",
+}
+
+STREETS = ["Main St", "Oak Ave", "Pine St", "Maple Ave", "Cedar Ln", "Elm St", "Park Blvd",
+           "Lake Dr", "Hill Rd", "Curtis Ave"]
+
+
+# Upstream stand-ins
+# ***************************************************************************
+
+
+def fake_coords(address):
+    """Deterministic coordinates inside the continental U.S. for an address."""
+
+    digest = hashlib.blake2b(address.lower().encode(), digest_size=8).digest()
+    lat = 25 + digest[0] / 255 * 23 + digest[1] / 255 / 100
+    lng = -124 + digest[2] / 255 * 57 + digest[3] / 255 / 100
+    return {"lat": round(lat, 6), "lng": round(lng, 6)}
+
+
+def fake_rental_data(zip_code):
+    """A Realty Mole /zipCodes/{zip} response with a year of history."""
+
+    base = 800 + int(zip_code) % 1000
+
+    def detailed(offset):
+        return [
+            {
+                "bedrooms": bedrooms,
+                "averageRent": base + bedrooms * 250 + offset,
+                "minRent": base + bedrooms * 250 + offset - 300,
+                "maxRent": base + bedrooms * 250 + offset + 400,
+                "totalRentals": 20 + bedrooms,
+            }
+            for bedrooms in range(6)
+        ]
+
+    history = {
+        f"2023-{month:02}": {"averageRent": base + month * 5, "detailed": detailed(month * 5)}
+        for month in range(1, 13)
+    }
+    return {
+        "id": str(zip_code),
+        "averageRent": base,
+        "rentalData": {"detailed": detailed(0), "history": history},
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer MapQuest and Realty Mole requests with canned, realistic payloads."""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def delay_or_fail(self):
+        """Sleep for the simulated latency; return True if this request should fail."""
+
+        # Jitter of +-50% around the configured latency.
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        return random.random() < self.error_rate
+
+    def send_results(self, locations):
+        results = [
+            {"providedLocation": {"location": location},
+             "locations": [{"latLng": fake_coords(location)}]}
+            for location in locations
+        ]
+        return self.send_json(200, {"results": results})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        if self.delay_or_fail():
+            return self.send_json(503, {"message": "stub failure"})
+        if url.path == "/geocoding/v1/batch":
+            return self.send_results(body.get("locations", []))
+        return self.send_json(404, {"message": "not found"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if self.delay_or_fail():
+            return self.send_json(503, {"message": "stub failure"})
+
+        if url.path == "/geocoding/v1/address":
+            locations = params.get("location", [""])[:1]
+        elif url.path.startswith("/zipCodes/"):
+            zip_code = url.path.rsplit("/", 1)[-1]
+            if not zip_code.isdigit():
+                return self.send_json(404, {"message": "not found"})
+            return self.send_json(200, fake_rental_data(zip_code), [
+                ("X-RateLimit-Requests-Limit", "1000000"),
+                ("X-RateLimit-Requests-Remaining", "999999"),
+            ])
+        else:
+            return self.send_json(404, {"message": "not found"})
+        return self.send_results(locations)
+
+
+def start_stub_server(latency, error_rate):
+    handler = type("Handler", (StubHandler,), {"latency": latency, "error_rate": error_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Database and app
+# ***************************************************************************
+
+
+def fake_address(rng):
+    return f"{rng.randint(1, 99999)} {rng.choice(STREETS)}"
+
+
+def session_cookie(app, user_id):
+    """A signed Flask session cookie logging in user_id."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({CURR_USER_KEY: user_id})
+
+
+# Load generation and reporting
+# ***************************************************************************
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def query_totals(route):
+    """Return (statements, requests) recorded so far for a route."""
+
+    statements = requests_seen = 0
+    for key, (_, total, observed) in list(metrics.db_queries.values.items()):
+        if dict(key).get("route") == route:
+            statements += total
+            requests_seen += observed
+    return statements, requests_seen
+
+
+def make_request(name, client, base_url, rng, zip_codes):
+    url = base_url + ENDPOINTS[name]
+    if name == "adddata":
+        return client.post(url, json={
+            "address": fake_address(rng), "city": rng.choice(seed.CITY_STEMS) + "ville",
+            "state": rng.choice(seed.STATES), "zipcode": rng.choice(zip_codes),
+            "bedrooms": rng.randint(0, 5)})
+    if name == "geocode":
+        return client.post(url, json={
+            "address": fake_address(rng), "city": rng.choice(seed.CITY_STEMS) + "ville",
+            "state": rng.choice(seed.STATES), "zipcode": rng.choice(zip_codes)})
+    if name == "rental-data":
+        return client.get(url, params={"zipcode": rng.choice(zip_codes),
+                                       "bedrooms": rng.randint(0, 5)})
+    return client.get(url)
+
+
+def run_scenario(name, base_url, cookies, requests_per_scenario, concurrency, zip_codes, seed_value):
+    """Send requests_per_scenario requests to one endpoint; return its stats."""
+
+    route = ENDPOINTS[name]
+    statements_before, seen_before = query_totals(route)
+    local = threading.local()
+
+    def one(i):
+        if not hasattr(local, "client"):
+            local.client = requests.Session()
+            local.client.cookies.set("session", cookies[i % len(cookies)])
+        rng = random.Random(seed_value * 1_000_003 + i)
+        start = time.perf_counter()
+        try:
+            res = make_request(name, local.client, base_url, rng, zip_codes)
+            ok = res.status_code < 400
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests_per_scenario)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    statements_after, seen_after = query_totals(route)
+    seen = seen_after - seen_before
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "throughput": round(len(results) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "queries_per_request": round((statements_after - statements_before) / seen, 2)
+        if seen else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print each scenario against the baseline; return the names that regressed."""
+
+    regressed = []
+    for name, current in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        p95_change = (current["p95_ms"] - before["p95_ms"]) / before["p95_ms"]
+        throughput_change = (current["throughput"] - before["throughput"]) / before["throughput"]
+        flag = ""
+        if p95_change > tolerance or throughput_change < -tolerance:
+            regressed.append(name)
+            flag = "  REGRESSION"
+        click.echo(
+            f"{name:16} p95 {before['p95_ms']:>8} -> {current['p95_ms']:>8} ms ({p95_change:+.0%})"
+            f"  throughput {before['throughput']:>8} -> {current['throughput']:>8}/s"
+            f" ({throughput_change:+.0%}){flag}"
+        )
+    return regressed
+
+
+@click.command()
+@click.option("--database-url", help="Database to seed and use; default is a temporary SQLite file.")
+@click.option("--users", default=200, show_default=True, help="Users to seed.")
+@click.option("--locations-per-user", default=10, show_default=True,
+              help="Mean saved searches per user.")
+@click.option("--favorites-per-user", default=5, show_default=True,
+              help="Mean favorites per user.")
+@click.option("--zip-codes", default=50, show_default=True, help="Distinct zip codes in the data.")
+@click.option("--concurrency", default=8, show_default=True, help="Client threads.")
+@click.option("--requests", "requests_per_scenario", default=200, show_default=True,
+              help="Requests per endpoint.")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(list(ENDPOINTS)),
+              help="Endpoints to drive (repeatable); default all.")
+@click.option("--upstream-latency", default=50.0, show_default=True,
+              help="Mean stub API latency in ms.")
+@click.option("--upstream-error-rate", default=0.0, show_default=True,
+              help="Fraction of stub API calls that fail with 503.")
+@click.option("--seed", "seed_value", default=1, show_default=True, help="Random seed.")
+@click.option("--output", type=click.Path(dir_okay=False), help="Write results as JSON.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False),
+              help="Compare against a previous --output file.")
+@click.option("--tolerance", default=0.2, show_default=True,
+              help="Allowed p95/throughput change before a run counts as a regression.")
+def main(database_url, users, locations_per_user, favorites_per_user, zip_codes, concurrency, requests_per_scenario,
+         scenarios, upstream_latency, upstream_error_rate, seed_value, output, baseline, tolerance):
+    """Benchmark MoveIn's endpoints against local API stand-ins."""
+
+    from app import create_app, db
+
+    rng = random.Random(seed_value)
+    zip_pool = [str(zip_code) for zip_code in seed.zip_code_pool(zip_codes)]
+    stub = start_stub_server(upstream_latency / 1000, upstream_error_rate)
+    stub_url = f"http://127.0.0.1:{stub.server_port}"
+
+    tmp = None
+    if database_url is None:
+        tmp = tempfile.TemporaryDirectory()
+        database_url = f"sqlite:///{os.path.join(tmp.name, 'bench.db')}"
+    app = create_app(
+        "production",
+        SQLALCHEMY_DATABASE_URI=database_url,
+        MQ_API_BASE_URL=f"{stub_url}/geocoding/v1",
+        RM_API_BASE_URL=f"{stub_url}/zipCodes",
+        MQ_SECRET_KEY="bench",
+        RM_SECRET_KEY="bench",
+        MQ_RATE_PER_SECOND=0,
+        RM_RATE_PER_SECOND=0,
+        BCRYPT_LOG_ROUNDS=4,
+        LOG_LEVEL="ERROR",
+    )
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        started = time.perf_counter()
+        counts = seed.seed_database(
+            db.engine, users=users, locations_per_user=locations_per_user,
+            favorites_per_user=favorites_per_user, zip_codes=zip_codes, geocoded=0.5,
+            seed=seed_value, password="benchmark")
+        click.echo(f"Seeded {counts['users']} users, {counts['locations']} locations and "
+                   f"{counts['favorites']} favorites in {time.perf_counter() - started:.1f}s.")
+        user_ids = range(counts["first_user_id"], counts["first_user_id"] + users)
+        cookies = [session_cookie(app, user_id) for user_id in rng.sample(
+            user_ids, min(len(user_ids), concurrency * 4))]
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = {
+        "settings": {
+            "database": app.config["SQLALCHEMY_DATABASE_URI"].split(":", 1)[0],
+            "users": users, "locations_per_user": locations_per_user,
+            "favorites_per_user": favorites_per_user, "zip_codes": zip_codes,
+            "concurrency": concurrency, "requests": requests_per_scenario,
+            "upstream_latency_ms": upstream_latency, "upstream_error_rate": upstream_error_rate,
+        },
+        "scenarios": {},
+    }
+    try:
+        for name in scenarios or ENDPOINTS:
+            stats = run_scenario(name, base_url, cookies, requests_per_scenario, concurrency,
+                                 zip_pool, seed_value)
+            results["scenarios"][name] = stats
+            click.echo(
+                f"{name:16} {stats['throughput']:>8}/s  p50 {stats['p50_ms']:>8} ms"
+                f"  p95 {stats['p95_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms"
+                f"  queries/req {stats['queries_per_request']}  errors {stats['errors']}"
+            )
+    finally:
+        server.shutdown()
+        stub.shutdown()
+        if tmp is not None:
+            with app.app_context():
+                db.engine.dispose()
+            tmp.cleanup()
+
+    if output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            regressed = compare(results, json.load(f), tolerance)
+        if regressed:
+            click.echo(f"Regressed: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""Caching helpers for MoveIn upstream lookups."""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, bulk_upsert, Geocode, RentalCache, State, City
+from upstream import SingleFlight
+
+
+def normalize_address(address):
+    """Return a cache key for an address: lowercase, no commas, single spaces."""
+
+    return " ".join(str(address).lower().replace(",", " ").split())
+
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after `ttl` seconds.
+
+    Keeps hit/miss/eviction counters so callers can report cache efficiency.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return cached value for key, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store value under key, evicting the least recently used entry if full."""
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+        }
+
+
+class GeocodeCache:
+    """Two-tier geocode cache keyed on the normalized address.
+
+    Lookups check the in-process LRU first, then the `geocodes` table. Rows
+    older than `db_ttl` seconds count as misses and are refreshed on the next
+    `set`.
+    """
+
+    def __init__(self, maxsize=4096, ttl=3600, db_ttl=30 * 24 * 3600):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.db_ttl = db_ttl
+        self.db_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.memory.maxsize = app.config["GEOCODE_CACHE_SIZE"]
+        self.memory.ttl = app.config["GEOCODE_CACHE_TTL"]
+        self.db_ttl = app.config["GEOCODE_DB_TTL"]
+
+    def _fresh_after(self):
+        return datetime.utcnow() - timedelta(seconds=self.db_ttl)
+
+    def get(self, address, any_age=False):
+        """Return {"lat", "lng"} for address, or None on a miss."""
+
+        return self.get_many([address], any_age).get(normalize_address(address))
+
+    def get_many(self, addresses, any_age=False):
+        """Return {normalized address: coords} for every cached address.
+
+        With any_age, rows past the durable TTL count as hits too.
+        """
+
+        found = {}
+        pending = []
+        for key in {normalize_address(a) for a in addresses}:
+            coords = self.memory.get(key)
+            if coords is None:
+                pending.append(key)
+            else:
+                found[key] = coords
+
+        if pending:
+            query = Geocode.query.filter(Geocode.address.in_(pending))
+            if not any_age:
+                query = query.filter(Geocode.fetched_at >= self._fresh_after())
+            rows = query.all()
+            for row in rows:
+                coords = {"lat": row.lat, "lng": row.lng}
+                self.memory.set(row.address, coords)
+                found[row.address] = coords
+            self.db_hits += len(rows)
+            self.misses += len(pending) - len(rows)
+
+        return found
+
+    def expiring(self, addresses, within=0):
+        """Return the addresses with no row fresh for another `within` seconds."""
+
+        fresh_after = self._fresh_after() + timedelta(seconds=within)
+        keys = {normalize_address(a) for a in addresses}
+        fresh = set()
+        if keys:
+            fresh = set(db.session.scalars(
+                select(Geocode.address).where(
+                    Geocode.address.in_(keys), Geocode.fetched_at >= fresh_after
+                )
+            ))
+        return [a for a in addresses if normalize_address(a) not in fresh]
+
+    def set(self, address, coords):
+        self.set_many({address: coords})
+
+    def set_many(self, coords_by_address):
+        """Write coordinates through to both tiers."""
+
+        now = datetime.utcnow()
+        rows = {}
+        for address, coords in coords_by_address.items():
+            key = normalize_address(address)
+            self.memory.set(key, coords)
+            rows[key] = {"address": key, "lat": coords["lat"], "lng": coords["lng"], "fetched_at": now}
+        bulk_upsert(Geocode, ["address"], list(rows.values()))
+        db.session.commit()
+
+    def purge_expired(self):
+        """Delete rows past the durable TTL; return how many were removed."""
+
+        removed = Geocode.query.filter(Geocode.fetched_at < self._fresh_after()).delete()
+        db.session.commit()
+        return removed
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "evictions": self.memory.evictions,
+            "size": len(self.memory),
+        }
+
+
+class ZipRentalCache:
+    """Per-zip Realty Mole response cache with stale-while-revalidate.
+
+    Entries younger than `ttl` seconds are fresh. Entries up to `stale_ttl`
+    seconds old are returned immediately while the app's upstream pool
+    refreshes them. Anything older, or missing from both tiers, is fetched
+    inline with `fetch(zip_code)`, which returns the response JSON or None
+    on failure.
+    Concurrent refreshes of one zip code share a single fetch through
+    `flights`. While `prefer_stale()` is true (e.g. the upstream budget is
+    low), stale and expired entries are served without refreshing. If
+    `schedule_refresh(zip_code)` is set, stale entries are handed to it
+    (e.g. to queue a job) instead of the pool.
+    """
+
+    def __init__(
+        self, fetch, maxsize=1024, ttl=24 * 3600, stale_ttl=7 * 24 * 3600, flights=None
+    ):
+        self.fetch = fetch
+        self.flights = flights or SingleFlight()
+        self.prefer_stale = lambda: False
+        self.schedule_refresh = None
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=stale_ttl)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.db_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config["RENTAL_CACHE_TTL"]
+        self.stale_ttl = app.config["RENTAL_CACHE_STALE_TTL"]
+        self.memory.maxsize = app.config["RENTAL_CACHE_SIZE"]
+        self.memory.ttl = self.stale_ttl
+
+    def _lookup(self, zip_code, any_age=False):
+        """Return (data, fetched_at) from memory or the database, or None."""
+
+        entry = self.memory.get(zip_code)
+        if entry is not None:
+            return entry
+
+        row = db.session.get(RentalCache, zip_code)
+        if row is None:
+            return None
+        age = (datetime.utcnow() - row.fetched_at).total_seconds()
+        if age > self.stale_ttl and not any_age:
+            return None
+        self.db_hits += 1
+        entry = (row.data, row.fetched_at)
+        self.memory.set(zip_code, entry, ttl=max(self.stale_ttl - age, 60))
+        return entry
+
+    def get(self, zip_code, fetch=True):
+        """Return rental data for zip_code, or None if Realty Mole has none.
+
+        With fetch=False a miss returns None instead of calling Realty Mole.
+        """
+
+        zip_code = str(zip_code)
+        prefer_stale = self.prefer_stale()
+        entry = self._lookup(zip_code, any_age=prefer_stale)
+        if entry is None:
+            self.misses += 1
+            return self.refresh(zip_code) if fetch else None
+
+        data, fetched_at = entry
+        if (datetime.utcnow() - fetched_at).total_seconds() > self.ttl:
+            self.stale_hits += 1
+            if not prefer_stale:
+                self._refresh_in_background(zip_code)
+        return data
+
+    def expiring(self, zip_codes, within=0):
+        """Return the zip codes whose row will not be fresh `within` seconds from now."""
+
+        fresh_after = datetime.utcnow() - timedelta(seconds=self.ttl - within)
+        zip_codes = [str(z) for z in zip_codes]
+        fresh = set()
+        if zip_codes:
+            fresh = set(db.session.scalars(
+                select(RentalCache.zip_code).where(
+                    RentalCache.zip_code.in_(zip_codes), RentalCache.fetched_at >= fresh_after
+                )
+            ))
+        return [z for z in zip_codes if z not in fresh]
+
+    def refresh(self, zip_code, max_age=None):
+        """Fetch zip_code upstream and write it through to both tiers.
+
+        A row younger than max_age seconds (default `ttl`) is used instead.
+        """
+
+        max_age = self.ttl if max_age is None else max_age
+        return self.flights.do(("realty_mole", zip_code), self._refresh, zip_code, max_age)
+
+    def _refresh(self, zip_code, max_age):
+        # Another worker may have refreshed the row while we waited our turn.
+        row = db.session.get(RentalCache, zip_code, populate_existing=True)
+        if row is not None:
+            age = (datetime.utcnow() - row.fetched_at).total_seconds()
+            if age <= max_age:
+                self.memory.set(zip_code, (row.data, row.fetched_at), ttl=self.stale_ttl - age)
+                return row.data
+
+        data = self.fetch(zip_code)
+        if data is None:
+            return None
+        now = datetime.utcnow()
+        self.memory.set(zip_code, (data, now))
+        db.session.merge(RentalCache(zip_code=zip_code, data=data, fetched_at=now))
+        db.session.commit()
+        return data
+
+    def _refresh_in_background(self, zip_code):
+        if self.schedule_refresh is not None:
+            self.schedule_refresh(zip_code)
+            return
+
+        with self._lock:
+            if zip_code in self._refreshing:
+                return
+            self._refreshing.add(zip_code)
+
+        app = current_app._get_current_object()
+
+        def run():
+            try:
+                with app.app_context():
+                    self.refresh(zip_code)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(zip_code)
+
+        # The shared pool bounds how many refreshes run at once.
+        app.extensions["upstream_executor"].submit(run)
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory.hits,
+            "db_hits": self.db_hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "size": len(self.memory),
+        }
+
+
+class ReferenceCache:
+    """Process-local name -> id cache for State and City rows.
+
+    States and cities are only ever inserted, so a cached id stays valid
+    until the row is deleted. Entries expire after `ttl` seconds, which
+    bounds how long another worker's deletion can go unnoticed; callers
+    should `invalidate()` when a write using a cached id fails. Only add
+    ids after the transaction that created them has committed.
+    """
+
+    def __init__(self, max_cities=10000, ttl=3600):
+        self.states = TTLCache(maxsize=100, ttl=ttl)
+        self.cities = TTLCache(maxsize=max_cities, ttl=ttl)
+        self._warmed_pid = None
+
+    def init_app(self, app):
+        """Configure from the app. Warming waits for `warm_once()`."""
+
+        self.states.ttl = self.cities.ttl = app.config["REFERENCE_CACHE_TTL"]
+        self.cities.maxsize = app.config["REFERENCE_CACHE_CITIES"]
+
+    def warm_once(self):
+        """Warm on the first call in each process.
+
+        Warming from create_app() would leave a pooled connection behind
+        for every preforked worker to share, so each worker warms its own
+        copy when it serves its first request.
+        """
+
+        if self._warmed_pid != os.getpid():
+            self._warmed_pid = os.getpid()
+            self.warm()
+
+    def warm(self):
+        """Load every state and up to `max_cities` cities; return False if the tables are missing."""
+
+        try:
+            for state_id, name in db.session.query(State.id, State.name):
+                self.states.set(name, state_id)
+            cities = db.session.query(City.id, City.name, City.state_id).limit(
+                self.cities.maxsize
+            )
+            for city_id, name, state_id in cities:
+                self.cities.set((name, state_id), city_id)
+        except SQLAlchemyError:
+            db.session.rollback()
+            return False
+        return True
+
+    def get_state(self, name):
+        return self.states.get(name)
+
+    def set_state(self, name, state_id):
+        self.states.set(name, state_id)
+
+    def get_city(self, name, state_id):
+        return self.cities.get((name, state_id))
+
+    def set_city(self, name, state_id, city_id):
+        self.cities.set((name, state_id), city_id)
+
+    def invalidate(self, *args, **kwargs):
+        """Forget every cached id. Accepts and ignores event listener arguments."""
+
+        self.states.clear()
+        self.cities.clear()
+
+    def stats(self):
+        return {"states": self.states.stats(), "cities": self.cities.stats()}
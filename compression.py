@@ -0,0 +1,74 @@
+"""Response compression for MoveIn's JSON and text responses.
+
+Brotli is used when the `brotli` package is installed and the client
+accepts it; otherwise gzip. Responses smaller than COMPRESS_MIN_SIZE,
+streamed responses and responses that already have a Content-Encoding are
+left alone.
+"""
+
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "text/html",
+    "text/plain",
+    "text/css",
+    "text/javascript",
+    "application/javascript",
+}
+
+
+def choose_encoding(accept_encodings):
+    """Return "br", "gzip" or None for an Accept-Encoding header."""
+
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+    if accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding, level):
+    if encoding == "br":
+        # Brotli qualities run 0-11; gzip levels 1-9.
+        return brotli.compress(body, quality=min(level + 2, 11))
+    return gzip.compress(body, compresslevel=level)
+
+
+def init_app(app):
+    """Compress eligible responses according to the request's Accept-Encoding."""
+
+    min_size = app.config.get("COMPRESS_MIN_SIZE", 500)
+    level = app.config.get("COMPRESS_LEVEL", 6)
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        ):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        encoding = choose_encoding(request.accept_encodings)
+        body = response.get_data()
+        if encoding is None or len(body) < min_size:
+            return response
+
+        response.set_data(compress(body, encoding, level))
+        response.headers["Content-Encoding"] = encoding
+        # The compressed bytes differ from the identity representation.
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,152 @@
+"""Configuration profiles for MoveIn.
+
+Pick one with `create_app("production")`, or set MOVEIN_CONFIG. Every
+setting can be overridden with an environment variable of the same name.
+"""
+
+import os
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+def load_secret(name):
+    """Read an API key from the environment, falling back to secret.py."""
+
+    value = os.environ.get(name)
+    if value is None:
+        try:
+            import secret
+        except ImportError:
+            return None
+        value = getattr(secret, name, None)
+    return value
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "postgresql:///moveIn")
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get("SECRET_KEY", "this is wildly unpredictable")
+
+    # Engine and pool settings; see models.engine_options().
+    DB_POOL_SIZE = env_int("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW = env_int("DB_MAX_OVERFLOW", 10)
+    DB_POOL_TIMEOUT = env_int("DB_POOL_TIMEOUT", 30)
+    DB_POOL_RECYCLE = env_int("DB_POOL_RECYCLE", 1800)
+    DB_POOL_PRE_PING = env_bool("DB_POOL_PRE_PING", True)
+    DB_STATEMENT_TIMEOUT_MS = env_int("DB_STATEMENT_TIMEOUT_MS", 5000)
+    DB_PGBOUNCER = env_bool("DB_PGBOUNCER", False)
+
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    GEOCODE_CACHE_SIZE = env_int("GEOCODE_CACHE_SIZE", 4096)
+    GEOCODE_CACHE_TTL = env_int("GEOCODE_CACHE_TTL", 3600)
+    GEOCODE_DB_TTL = env_int("GEOCODE_DB_TTL", 30 * 24 * 3600)
+    RENTAL_CACHE_SIZE = env_int("RENTAL_CACHE_SIZE", 1024)
+    RENTAL_CACHE_TTL = env_int("RENTAL_CACHE_TTL", 24 * 3600)
+    RENTAL_CACHE_STALE_TTL = env_int("RENTAL_CACHE_STALE_TTL", 7 * 24 * 3600)
+    RENTAL_STATS_MAX_AGE_DAYS = env_int("RENTAL_STATS_MAX_AGE_DAYS", 30)
+    REFERENCE_CACHE_CITIES = env_int("REFERENCE_CACHE_CITIES", 10000)
+    REFERENCE_CACHE_TTL = env_int("REFERENCE_CACHE_TTL", 3600)
+    USER_CACHE_SIZE = env_int("USER_CACHE_SIZE", 4096)
+    USER_CACHE_TTL = env_int("USER_CACHE_TTL", 60)
+
+    BCRYPT_LOG_ROUNDS = env_int("BCRYPT_LOG_ROUNDS", 12)
+    # Per web worker; the default splits the cores between $WEB_CONCURRENCY workers.
+    BCRYPT_WORKERS = env_int(
+        "BCRYPT_WORKERS", max((os.cpu_count() or 1) // (env_int("WEB_CONCURRENCY", 1) or 1), 1)
+    )
+    BCRYPT_QUEUE_DEPTH = env_int("BCRYPT_QUEUE_DEPTH", 32)
+    # Login attempts are counted per client IP. Behind a reverse proxy, set
+    # this to the number of proxies so the address comes from
+    # X-Forwarded-For; otherwise every client shares the proxy's count.
+    PROXY_FIX_X_FOR = env_int("PROXY_FIX_X_FOR", 0)
+    LOGIN_ATTEMPTS_PER_MINUTE = env_int("LOGIN_ATTEMPTS_PER_MINUTE", 10)
+
+    COMPRESS_MIN_SIZE = env_int("COMPRESS_MIN_SIZE", 500)
+    COMPRESS_LEVEL = env_int("COMPRESS_LEVEL", 6)
+
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+    LOG_SAMPLE_RATE = env_float("LOG_SAMPLE_RATE", 1.0)
+
+    MQ_API_BASE_URL = os.environ.get(
+        "MQ_API_BASE_URL", "https://www.mapquestapi.com/geocoding/v1"
+    )
+    RM_API_BASE_URL = os.environ.get(
+        "RM_API_BASE_URL", "https://realty-mole-property-api.p.rapidapi.com/zipCodes"
+    )
+    UPSTREAM_POOL_SIZE = env_int("UPSTREAM_POOL_SIZE", 10)
+    UPSTREAM_CONNECT_TIMEOUT = env_float("UPSTREAM_CONNECT_TIMEOUT", 3.05)
+    UPSTREAM_READ_TIMEOUT = env_float("UPSTREAM_READ_TIMEOUT", 10)
+    UPSTREAM_RETRIES = env_int("UPSTREAM_RETRIES", 2)
+    # Longest Retry-After (seconds) worth waiting for on a request thread;
+    # a longer one fails the call instead.
+    UPSTREAM_MAX_RETRY_AFTER = env_float("UPSTREAM_MAX_RETRY_AFTER", 5)
+    UPSTREAM_WORKERS = env_int("UPSTREAM_WORKERS", 8)
+    # Call budgets per API key; a quota or rate of 0 means unlimited.
+    MQ_MONTHLY_QUOTA = env_int("MQ_MONTHLY_QUOTA", 0)
+    RM_MONTHLY_QUOTA = env_int("RM_MONTHLY_QUOTA", 0)
+    MQ_RATE_PER_SECOND = env_float("MQ_RATE_PER_SECOND", 10)
+    RM_RATE_PER_SECOND = env_float("RM_RATE_PER_SECOND", 5)
+    UPSTREAM_RATE_BURST = env_int("UPSTREAM_RATE_BURST", 20)
+    UPSTREAM_RATE_MAX_WAIT = env_float("UPSTREAM_RATE_MAX_WAIT", 1.0)
+    # Below this fraction of budget left, serve stale data instead of calling.
+    UPSTREAM_BUDGET_RESERVE = env_float("UPSTREAM_BUDGET_RESERVE", 0.1)
+    # Also coalesce identical lookups across workers with Postgres advisory locks.
+    UPSTREAM_COALESCE_DB_LOCK = env_bool("UPSTREAM_COALESCE_DB_LOCK", False)
+
+    # Background jobs; see jobs.py. With JOBS_ASYNC, /api/search and
+    # /api/batchgeocode queue their upstream calls for `flask run-jobs`
+    # workers instead of making them in the request.
+    JOBS_ASYNC = env_bool("JOBS_ASYNC", False)
+    JOBS_LEASE_SECONDS = env_int("JOBS_LEASE_SECONDS", 300)
+    JOBS_MAX_ATTEMPTS = env_int("JOBS_MAX_ATTEMPTS", 5)
+    JOBS_RETRY_BASE = env_float("JOBS_RETRY_BASE", 30)
+    JOBS_RETRY_MAX = env_float("JOBS_RETRY_MAX", 3600)
+    JOBS_POLL_INTERVAL = env_float("JOBS_POLL_INTERVAL", 1.0)
+    JOBS_RETENTION_HOURS = env_int("JOBS_RETENTION_HOURS", 24)
+    JOBS_LONG_POLL_MAX = env_float("JOBS_LONG_POLL_MAX", 5)
+
+    # Daily cache warming; see prewarm.py. The window is UTC, and the call
+    # limits are per run: Realty Mole zip codes and MapQuest batch calls.
+    PREWARM_WINDOW = os.environ.get("PREWARM_WINDOW", "02:00-06:00")
+    PREWARM_HORIZON_HOURS = env_float("PREWARM_HORIZON_HOURS", 24)
+    PREWARM_RENTAL_CALLS = env_int("PREWARM_RENTAL_CALLS", 200)
+    PREWARM_GEOCODE_CALLS = env_int("PREWARM_GEOCODE_CALLS", 10)
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    DEBUG_TB_ENABLED = True
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get("TEST_DATABASE_URL", "sqlite:///:memory:")
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    BCRYPT_WORKERS = 0
+
+
+class ProductionConfig(Config):
+    LOG_SAMPLE_RATE = env_float("LOG_SAMPLE_RATE", 0.01)
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING")
+
+
+configs = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
@@ -0,0 +1,113 @@
+"""Geohash helpers for bounding-box and radius queries on saved locations.
+
+Locations store a geohash of their coordinates in an ordinary indexed text
+column. A bounding box is covered by a handful of geohash cells, and each
+cell becomes a range scan (`geohash >= cell AND geohash < cell + "~"`),
+which a B-tree index serves on both Postgres and SQLite. The range relies
+on byte order ("~" sorts after every geohash character), so on Postgres
+the column uses the "C" collation; under a locale collation such as
+en_US.UTF-8 "~" sorts before letters and digits. Bounding boxes are
+assumed not to cross the antimeridian.
+"""
+
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+PRECISION = 9
+EARTH_RADIUS_MILES = 3958.8
+
+
+def encode(lat, lng, precision=PRECISION):
+    """Return the geohash of a point."""
+
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if lng >= mid:
+                bits = bits * 2 + 1
+                lng_range[0] = mid
+            else:
+                bits = bits * 2
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                bits = bits * 2 + 1
+                lat_range[0] = mid
+            else:
+                bits = bits * 2
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """Return (lat height, lng width) in degrees of a geohash cell."""
+
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / 2**lat_bits, 360.0 / 2**lng_bits
+
+
+def _steps(start, stop, step):
+    value = start
+    while value < stop:
+        yield value
+        value += step
+    yield stop
+
+
+def cover(south, west, north, east, max_cells=16):
+    """Return geohash prefixes whose cells together cover the bounding box.
+
+    Uses the finest precision that needs at most max_cells cells.
+    """
+
+    best = {""}
+    for precision in range(1, PRECISION + 1):
+        height, width = cell_size(precision)
+        rows = math.ceil((north - south) / height) + 1
+        cols = math.ceil((east - west) / width) + 1
+        if rows * cols > max_cells:
+            break
+        best = {
+            encode(lat, lng, precision)
+            for lat in _steps(south, north, height)
+            for lng in _steps(west, east, width)
+        }
+    return sorted(best)
+
+
+def radius_bbox(lat, lng, miles):
+    """Return (south, west, north, east) of a box enclosing a circle."""
+
+    lat_delta = math.degrees(miles / EARTH_RADIUS_MILES)
+    lng_delta = lat_delta / max(math.cos(math.radians(lat)), 1e-6)
+    return (
+        max(lat - lat_delta, -90.0),
+        max(lng - lng_delta, -180.0),
+        min(lat + lat_delta, 90.0),
+        min(lng + lng_delta, 180.0),
+    )
+
+
+def distance_miles(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points."""
+
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
@@ -0,0 +1,292 @@
+"""Database-backed queue for work that calls MapQuest or Realty Mole.
+
+Jobs are rows in `jobs`. A worker claims the highest-priority ready job by
+marking it running under a lease (JOBS_LEASE_SECONDS). If the worker dies,
+the lease runs out and another worker claims the job again, so every job
+runs at least once and handlers must be safe to repeat. A job whose
+handler raises one of its `retry_on` errors is retried with exponential
+backoff until it has used max_attempts; any other error fails it at once.
+Handlers are registered with `@handler("kind")` and called
+with the job's payload as keyword arguments; what they return is stored as
+the job's result. Start workers with `flask run-jobs`.
+"""
+
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+import metrics
+from models import Job, db
+from upstream import UpstreamError
+
+logger = logging.getLogger("movein")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+# Priorities: someone is waiting on the result, a cached value went stale,
+# or the work is speculative.
+INTERACTIVE = 10
+REFRESH = 5
+WARM = 0
+
+# Errors another attempt may get past: an upstream or database outage.
+# Anything else, such as an address MapQuest cannot place, would only
+# fail the same way again.
+RETRYABLE = (UpstreamError, SQLAlchemyError)
+
+handlers = {}
+retry_on = {}
+
+
+def handler(kind, retry=RETRYABLE):
+    """Register func to run jobs of this kind, retrying the `retry` errors."""
+
+    def register(func):
+        handlers[kind] = func
+        retry_on[kind] = retry
+        return func
+
+    return register
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def enqueue(kind, payload=None, priority=0, key=None, user_id=None, delay=0):
+    """Queue a job and return it; commits.
+
+    With a key, a queued job with the same key is returned instead of
+    queueing another, so repeated requests for the same refresh share one
+    job. A running job does not count, since it may have read what it
+    works on already. The check is not locked: two racing callers may
+    both queue one, which at-least-once handlers already tolerate.
+    """
+
+    if kind not in handlers:
+        raise ValueError(f"No handler for {kind} jobs")
+    if key is not None:
+        existing = (
+            Job.query.filter(Job.key == key, Job.status == QUEUED)
+            .order_by(Job.id)
+            .first()
+        )
+        if existing is not None:
+            return existing
+
+    job = Job(
+        kind=kind,
+        payload=payload or {},
+        priority=priority,
+        key=key,
+        user_id=user_id,
+        max_attempts=current_app.config["JOBS_MAX_ATTEMPTS"],
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def ready(now):
+    """Jobs that may be claimed: due, or running under an expired lease."""
+
+    return or_(
+        and_(Job.status == QUEUED, Job.run_at <= now),
+        and_(
+            Job.status == RUNNING,
+            Job.locked_until < now,
+            Job.attempts < Job.max_attempts,
+        ),
+    )
+
+
+def claim(worker, kinds=None):
+    """Lease the next ready job to worker and return it, or None.
+
+    Postgres skips rows other workers have locked; elsewhere the
+    conditional update makes losing a race harmless, and the next candidate
+    is tried.
+    """
+
+    lease = timedelta(seconds=current_app.config["JOBS_LEASE_SECONDS"])
+    postgres = db.session.get_bind().dialect.name == "postgresql"
+    for _ in range(5):
+        now = datetime.utcnow()
+        query = (
+            select(Job.id)
+            .where(ready(now))
+            .order_by(Job.priority.desc(), Job.run_at, Job.id)
+            .limit(1)
+        )
+        if kinds:
+            query = query.where(Job.kind.in_(kinds))
+        if postgres:
+            query = query.with_for_update(skip_locked=True)
+        job_id = db.session.execute(query).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, ready(now))
+            .values(
+                status=RUNNING,
+                locked_by=worker,
+                locked_until=now + lease,
+                attempts=Job.attempts + 1,
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id, populate_existing=True)
+    return None
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying after `attempts` failed attempts."""
+
+    base = current_app.config["JOBS_RETRY_BASE"]
+    delay = min(base * 2 ** (attempts - 1), current_app.config["JOBS_RETRY_MAX"])
+    return delay * random.uniform(0.75, 1.25)
+
+
+def finish(job_id, worker, **values):
+    """Store the outcome of a job, unless another worker has taken it over."""
+
+    db.session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.status == RUNNING, Job.locked_by == worker)
+        .values(locked_until=None, **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def run(job, worker):
+    """Run a claimed job's handler and record the result or schedule a retry."""
+
+    kind, job_id, attempts, max_attempts = job.kind, job.id, job.attempts, job.max_attempts
+    started = time.perf_counter()
+    try:
+        func = handlers[kind]
+        result = func(**job.payload)
+    except Exception as exc:
+        db.session.rollback()
+        error = f"{type(exc).__name__}: {exc}"
+        if attempts >= max_attempts or not isinstance(exc, retry_on.get(kind, ())):
+            logger.warning("Job %s (%s) failed: %s", job_id, kind, error, exc_info=True)
+            finish(job_id, worker, status=FAILED, error=error, finished_at=datetime.utcnow())
+            outcome = FAILED
+        else:
+            logger.info("Job %s (%s) will be retried: %s", job_id, kind, error)
+            retry_at = datetime.utcnow() + timedelta(seconds=backoff(attempts))
+            finish(job_id, worker, status=QUEUED, error=error, run_at=retry_at)
+            outcome = "retried"
+    else:
+        finish(job_id, worker, status=DONE, result=result, error=None,
+               finished_at=datetime.utcnow())
+        outcome = DONE
+    metrics.jobs_processed.inc(kind=kind, outcome=outcome)
+    metrics.job_latency.observe(time.perf_counter() - started, kind=kind)
+    return outcome
+
+
+def clean_up():
+    """Fail jobs whose last lease ran out, and drop old finished jobs."""
+
+    now = datetime.utcnow()
+    retention = timedelta(hours=current_app.config["JOBS_RETENTION_HOURS"])
+    db.session.execute(
+        update(Job)
+        .where(
+            Job.status == RUNNING,
+            Job.locked_until < now,
+            Job.attempts >= Job.max_attempts,
+        )
+        .values(status=FAILED, error="Lease expired", locked_until=None, finished_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        delete(Job)
+        .where(Job.status.in_(FINISHED), Job.finished_at < now - retention)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+# How often (seconds) a worker runs clean_up().
+CLEAN_UP_INTERVAL = 60
+
+
+def work(kinds=None, burst=False, stop=None):
+    """Claim and run jobs until stop is set; return how many were run.
+
+    With burst, return as soon as the queue is empty instead of polling
+    every JOBS_POLL_INTERVAL seconds.
+    """
+
+    worker = worker_name()
+    stop = stop or threading.Event()
+    interval = current_app.config["JOBS_POLL_INTERVAL"]
+    count = 0
+    cleaned_at = 0.0
+    while not stop.is_set():
+        if time.monotonic() - cleaned_at > CLEAN_UP_INTERVAL:
+            clean_up()
+            cleaned_at = time.monotonic()
+        job = claim(worker, kinds)
+        if job is None:
+            if burst:
+                break
+            # Hand the connection back while idle.
+            db.session.remove()
+            stop.wait(interval)
+            continue
+        run(job, worker)
+        count += 1
+    db.session.remove()
+    return count
+
+
+def status(job):
+    """The parts of a job its submitter may see."""
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "result": job.result,
+        "error": job.error if job.status == FAILED else None,
+    }
+
+
+def wait_for(job_id, timeout, interval=0.5):
+    """Return the job once it has finished or timeout seconds have passed.
+
+    The session is closed between polls, so a long poll does not hold a
+    database connection.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        job = db.session.get(Job, job_id, populate_existing=True)
+        if job is None or job.status in FINISHED or time.monotonic() >= deadline:
+            return job
+        db.session.rollback()
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
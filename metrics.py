@@ -0,0 +1,237 @@
+"""In-process metrics for MoveIn, exposed in Prometheus text format.
+
+Metrics are kept per worker process; Prometheus should scrape each worker
+(or sum across them) rather than expect a single global view.
+"""
+
+import bisect
+import logging
+import random
+import threading
+import time
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{str(value)}"' for name, value in pairs)
+    return "{" + body + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            counts, total, observed = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            self.values[key] = (counts, total + value, observed + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, observed) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _format_labels(key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{le} {observed}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {observed}")
+        return lines
+
+
+def _register(metric):
+    return _metrics.setdefault(metric.name, metric)
+
+
+def counter(name, help_text):
+    return _register(Counter(name, help_text))
+
+
+def gauge(name, help_text):
+    return _register(Gauge(name, help_text))
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help_text, buckets))
+
+
+def register_collector(func):
+    """Call func() before every scrape, e.g. to copy cache stats into gauges."""
+
+    _collectors.append(func)
+    return func
+
+
+def render():
+    """Return every metric in Prometheus text exposition format."""
+
+    for collect in _collectors:
+        collect()
+    lines = []
+    for metric in list(_metrics.values()):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+request_latency = histogram(
+    "movein_request_duration_seconds", "Flask request latency by route."
+)
+upstream_latency = histogram(
+    "movein_upstream_request_duration_seconds",
+    "Upstream API call latency by provider and status code.",
+)
+upstream_coalesced = counter(
+    "movein_upstream_coalesced_total",
+    "Lookups that waited for an identical in-flight upstream call instead of making their own.",
+)
+upstream_budget = gauge(
+    "movein_upstream_budget_remaining",
+    "Upstream calls left by provider: monthly quota, provider-reported, and rate tokens.",
+)
+jobs_processed = counter(
+    "movein_jobs_processed_total", "Background jobs run by kind and outcome."
+)
+job_latency = histogram(
+    "movein_job_duration_seconds", "Background job run time by kind."
+)
+db_queries = histogram(
+    "movein_db_queries_per_request", "SQL statements per request.", QUERY_COUNT_BUCKETS
+)
+db_time = histogram(
+    "movein_db_time_per_request_seconds", "Time spent in SQL per request."
+)
+db_pool = gauge(
+    "movein_db_pool_connections", "Connections in the SQLAlchemy pool by state."
+)
+db_pool_events = counter(
+    "movein_db_pool_events_total", "New connections and checkouts from the pool."
+)
+cache_events = gauge(
+    "movein_cache_events", "Cache hits, misses and evictions by cache and event."
+)
+
+
+class SampledFilter(logging.Filter):
+    """Pass every WARNING and above, but only `rate` of lower level records."""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def init_app(app, engine):
+    """Time every request and count the SQL it runs."""
+
+    logger = logging.getLogger("movein")
+    logger.setLevel(app.config.get("LOG_LEVEL", "INFO"))
+    for old in [f for f in logger.filters if isinstance(f, SampledFilter)]:
+        logger.removeFilter(old)
+    logger.addFilter(SampledFilter(app.config.get("LOG_SAMPLE_RATE", 1.0)))
+
+    @event.listens_for(engine.pool, "connect")
+    def count_connect(dbapi_connection, connection_record):
+        db_pool_events.inc(event="connect")
+
+    @event.listens_for(engine.pool, "checkout")
+    def count_checkout(dbapi_connection, connection_record, connection_proxy):
+        db_pool_events.inc(event="checkout")
+
+    @register_collector
+    def collect_pool_stats():
+        pool = engine.pool
+        # Only QueuePool reports these; NullPool and StaticPool do not.
+        if hasattr(pool, "checkedout"):
+            db_pool.set(pool.checkedout(), state="checked_out")
+            db_pool.set(pool.checkedin(), state="idle")
+            db_pool.set(max(pool.overflow(), 0), state="overflow")
+            db_pool.set(pool.size(), state="size")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        if has_request_context() and "db_queries" in g:
+            g.db_queries += 1
+            g.db_time += elapsed
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.db_queries = 0
+        g.db_time = 0.0
+
+    @app.after_request
+    def record_request(response):
+        if "request_start" in g:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            request_latency.observe(
+                time.perf_counter() - g.request_start,
+                route=route,
+                method=request.method,
+                status=response.status_code,
+            )
+            db_queries.observe(g.db_queries, route=route)
+            db_time.observe(g.db_time, route=route)
+        return response
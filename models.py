@@ -1,12 +1,70 @@
 """SQLAlchemy Models for MoveIn"""
 
-from flask_bcrypt import Bcrypt
+import hashlib
+from contextlib import contextmanager
+from datetime import date, datetime
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.types import Integer, TypeDecorator
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import NullPool
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from passwords import hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def upsert(model, conflict_columns, **values):
+    """Insert a row unless one with the same conflict_columns exists; return its id.
+
+    Uses a single INSERT ... ON CONFLICT ... RETURNING statement on Postgres
+    and SQLite. Other databases fall back to select-then-insert inside a
+    savepoint. Does not commit.
+    """
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(model).values(**values)
+        # A no-op update, so RETURNING also yields the id of an existing row.
+        key = conflict_columns[0]
+        stmt = stmt.on_conflict_do_update(
+            index_elements=conflict_columns,
+            set_={key: stmt.excluded[key]}
+        ).returning(model.id)
+        return db.session.execute(stmt).scalar_one()
+
+    lookup = {column: values[column] for column in conflict_columns}
+    existing = db.session.query(model.id).filter_by(**lookup).scalar()
+    if existing is not None:
+        return existing
+    try:
+        with db.session.begin_nested():
+            row = model(**values)
+            db.session.add(row)
+        return row.id
+    except IntegrityError:
+        return db.session.query(model.id).filter_by(**lookup).scalar()
+
+
+class ZipCode(TypeDecorator):
+    """A zip code stored as an integer and read back as five digits.
+
+    Zip codes like 02134 would otherwise come back as 2134.
+    """
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else str(value).zfill(5)
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -55,7 +113,7 @@ class User(db.Model):
     def signup(cls, username, first_name, last_name, email, password):
         """Sign up user. Hash password, add user to system."""
 
-        hashed_pw = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pw = hasher.hash(password)
 
         user = User(
             username=username,
@@ -74,22 +132,73 @@ class User(db.Model):
         Searches for a user whose password hash matches this password
         and return that user object.
 
-        if it can't find matching user/password is wrong, return False."""
+        if it can't find matching user/password is wrong, return False.
+
+        If the stored hash was made with an old bcrypt cost factor, it is
+        replaced with one at the current cost."""
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.verify(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
+                    db.session.commit()
                 return user
 
         return False
 
 
+def bulk_upsert(model, conflict_columns, rows, update_columns=None):
+    """Insert rows, overwriting update_columns of rows that already exist.
+
+    update_columns defaults to every column that is not a conflict column;
+    pass [] to leave existing rows alone. Of rows sharing a conflict key,
+    the last one wins; Postgres refuses to touch a row twice in one
+    statement. One INSERT ... ON CONFLICT statement on Postgres and SQLite;
+    row by row on other databases. Does not commit.
+    """
+
+    rows = list({
+        tuple(row[column] for column in conflict_columns): row for row in rows
+    }.values())
+    if not rows:
+        return
+    if update_columns is None:
+        update_columns = [column for column in rows[0] if column not in conflict_columns]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        # Executed with the rows as parameters, so the statement compiles once.
+        stmt = insert(model)
+        if update_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=conflict_columns,
+                set_={column: stmt.excluded[column] for column in update_columns}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+        db.session.execute(stmt, rows)
+        return
+
+    for row in rows:
+        lookup = {column: row[column] for column in conflict_columns}
+        existing = model.query.filter_by(**lookup).first()
+        if existing is None:
+            db.session.add(model(**row))
+        else:
+            for column in update_columns:
+                setattr(existing, column, row[column])
+
+
 class City(db.Model):
     """A U.S. city."""
 
     __tablename__ = 'cities'
+    __table_args__ = (
+        db.UniqueConstraint('name', 'state_id', name='uq_cities_name_state_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -110,14 +219,10 @@ class City(db.Model):
     state = db.relationship('State')
 
     @classmethod
-    def get_or_create(cls, name):
-        exists = db.session.query(State.name).filter_by(name=name).first()
-        if exists is None:
-            new_state = State(name=name)
-            db.session.add(new_state)
-            db.session.commit()
-        else:
-            name = exists
+    def upsert(cls, name, state_id):
+        """Return the id of the city, inserting it if needed."""
+
+        return upsert(cls, ['name', 'state_id'], name=name, state_id=state_id)
 
 
 class State(db.Model):
@@ -139,11 +244,10 @@ class State(db.Model):
     city = db.relationship('City')
 
     @classmethod
-    def get_or_create(cls, name):
-        exists: db.session.query(State.id).filter_by(name=name).scalar()
-        if exists:
-            return db.session.query(State).filter_by(name=name).first()
-        return cls(name=name)
+    def upsert(cls, name):
+        """Return the id of the state, inserting it if needed."""
+
+        return upsert(cls, ['name'], name=name)
 
 
 class Location(db.Model):
@@ -158,11 +262,12 @@ class Location(db.Model):
 
     street_address = db.Column(
         db.String(150),
-        nullable=False
+        nullable=False,
+        unique=True
     )
 
     zip_code = db.Column(
-        db.Integer,
+        ZipCode,
         nullable=False
     )
 
@@ -178,14 +283,60 @@ class Location(db.Model):
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        index=True
     )
 
+    latitude = db.Column(
+        db.Float
+    )
+
+    longitude = db.Column(
+        db.Float
+    )
+
+    geocode_provider = db.Column(
+        db.Text
+    )
+
+    geocoded_at = db.Column(
+        db.DateTime
+    )
+
+    # Geohash of (latitude, longitude), for bounding-box queries; see geo.py.
+    # The range scans need byte order, which SQLite always uses but Postgres
+    # only under the "C" collation.
+    geohash = db.Column(
+        db.String(12).with_variant(db.String(12, collation="C"), "postgresql"),
+        index=True
+    )
+
+    @classmethod
+    def upsert(cls, street_address, zip_code, city_id, bedrooms, user_id):
+        """Return the id of the location with this street address, inserting it if needed.
+
+        An existing location is left unchanged.
+        """
+
+        return upsert(
+            cls,
+            ['street_address'],
+            street_address=street_address,
+            zip_code=zip_code,
+            city_id=city_id,
+            bedrooms=bedrooms,
+            user_id=user_id,
+        )
+
 
 class Favorite(db.Model):
     """Mapping user saved seraches to locations."""
 
     __tablename__ = 'favorites'
+    __table_args__ = (
+        # Backs the "already a favorite" check and per-user favorites queries.
+        db.UniqueConstraint('user_id', 'location_id', name='uq_favorites_user_location'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -208,8 +359,390 @@ class Favorite(db.Model):
     )
 
 
+class Geocode(db.Model):
+    """Cached MapQuest coordinates for a normalized address."""
+
+    __tablename__ = 'geocodes'
+
+    address = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    lat = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    lng = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    fetched_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True
+    )
+
+
+class RentalCache(db.Model):
+    """Cached Realty Mole zip code response."""
+
+    __tablename__ = 'rental_cache'
+
+    zip_code = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    data = db.Column(
+        db.JSON,
+        nullable=False
+    )
+
+    fetched_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
+
+class UpstreamBudget(db.Model):
+    """Shared call budget for one upstream provider; see quota.QuotaBudget."""
+
+    __tablename__ = 'upstream_budgets'
+
+    provider = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    # Token bucket: tokens left and when (epoch seconds) they were counted.
+    tokens = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    updated_at = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    # Calls made in the current quota window, which starts on window_start.
+    window_start = db.Column(
+        db.Date,
+        nullable=False
+    )
+
+    calls = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    # Last rate-limit headers reported by the provider.
+    provider_limit = db.Column(
+        db.Integer
+    )
+
+    provider_remaining = db.Column(
+        db.Integer
+    )
+
+    provider_reset_at = db.Column(
+        db.Float
+    )
+
+
+class ZipRentalStat(db.Model):
+    """Realty Mole rental figures for one zip code, bedroom count and date."""
+
+    __tablename__ = 'zip_rental_stats'
+    __table_args__ = (
+        db.UniqueConstraint('zip_code', 'bedrooms', 'as_of', name='uq_zip_rental_stats'),
+        db.Index('ix_zip_rental_stats_zip_as_of', 'zip_code', 'as_of'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+
+    zip_code = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    bedrooms = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    as_of = db.Column(
+        db.Date,
+        nullable=False
+    )
+
+    average_rent = db.Column(
+        db.Float
+    )
+
+    min_rent = db.Column(
+        db.Float
+    )
+
+    max_rent = db.Column(
+        db.Float
+    )
+
+    total_rentals = db.Column(
+        db.Integer
+    )
+
+    COLUMNS = ('zip_code', 'bedrooms', 'as_of', 'average_rent', 'min_rent', 'max_rent',
+               'total_rentals')
+
+    @staticmethod
+    def _row(zip_code, as_of, detail):
+        return {
+            'zip_code': str(zip_code),
+            'bedrooms': int(detail['bedrooms']),
+            'as_of': as_of,
+            'average_rent': detail.get('averageRent'),
+            'min_rent': detail.get('minRent'),
+            'max_rent': detail.get('maxRent'),
+            'total_rentals': detail.get('totalRentals'),
+        }
+
+    @classmethod
+    def rows_from_response(cls, data, as_of=None):
+        """Turn a Realty Mole /zipCodes response into rows.
+
+        The current figures are dated as_of (default today); each month in
+        rentalData.history is dated the first of that month.
+        """
+
+        rental_data = data.get('rentalData') or {}
+        zip_code = data['id']
+        rows = [
+            cls._row(zip_code, as_of or date.today(), detail)
+            for detail in rental_data.get('detailed') or []
+        ]
+        for month, entry in (rental_data.get('history') or {}).items():
+            month_date = datetime.strptime(month, '%Y-%m').date()
+            rows.extend(
+                cls._row(zip_code, month_date, detail)
+                for detail in entry.get('detailed') or []
+            )
+        return rows
+
+    @classmethod
+    def save_response(cls, data, as_of=None):
+        """Upsert the rows of a Realty Mole response. Does not commit."""
+
+        bulk_upsert(cls, ['zip_code', 'bedrooms', 'as_of'], cls.rows_from_response(data, as_of))
+
+    @classmethod
+    def latest(cls, zip_code, fresh_after):
+        """Return the most recent rows for zip_code if dated on or after fresh_after."""
+
+        as_of = db.session.query(db.func.max(cls.as_of)).filter_by(
+            zip_code=str(zip_code)
+        ).scalar()
+        if as_of is None or as_of < fresh_after:
+            return []
+        return cls.query.filter_by(zip_code=str(zip_code), as_of=as_of).order_by(
+            cls.bedrooms
+        ).all()
+
+    @classmethod
+    def history(cls, zip_code, bedrooms, months):
+        """Return the first-of-month rows for the last `months` months, oldest first.
+
+        With bedrooms None, the rows hold the average across bedroom counts.
+        """
+
+        query = db.session.query(
+            cls.as_of,
+            db.func.avg(cls.average_rent).label('average_rent'),
+        ).filter(cls.zip_code == str(zip_code), db.func.extract('day', cls.as_of) == 1)
+        if bedrooms is not None:
+            query = query.filter(cls.bedrooms == bedrooms)
+        rows = query.group_by(cls.as_of).order_by(cls.as_of.desc()).limit(months).all()
+        return rows[::-1]
+
+
+class Job(db.Model):
+    """A unit of background work for the job queue; see jobs.py."""
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # Backs the claim query: ready jobs, highest priority first.
+        db.Index('ix_jobs_ready', 'status', 'priority', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict
+    )
+
+    # queued, running, done or failed.
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued'
+    )
+
+    priority = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5
+    )
+
+    # Not claimed before this time; pushed back after a failed attempt.
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
+    # The worker running the job, and when its lease runs out.
+    locked_by = db.Column(
+        db.Text
+    )
+
+    locked_until = db.Column(
+        db.DateTime
+    )
+
+    # At most one queued job per key; see jobs.enqueue().
+    key = db.Column(
+        db.Text,
+        index=True
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade')
+    )
+
+    result = db.Column(
+        db.JSON
+    )
+
+    error = db.Column(
+        db.Text
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
+    finished_at = db.Column(
+        db.DateTime
+    )
+
+
+def lock_key(name):
+    """Map a string to a signed 64-bit Postgres advisory lock key."""
+
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+@contextmanager
+def advisory_lock(name):
+    """Hold a Postgres advisory lock on name for the duration of the block.
+
+    The lock is transaction-level and taken on a separate connection, so it
+    works behind PgBouncer and leaves the caller's session alone. If the
+    lock cannot be had within the statement timeout, or the database is not
+    Postgres, the block runs without it.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+
+    with db.engine.connect() as conn:
+        try:
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': lock_key(name)})
+        except OperationalError:
+            conn.rollback()
+        try:
+            yield
+        finally:
+            # Ending the transaction releases the lock.
+            conn.rollback()
+
+
+def engine_options(config):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings.
+
+    In PgBouncer mode connection pooling is left to PgBouncer (NullPool),
+    and the statement timeout is set per transaction because PgBouncer
+    drops startup parameters. SQLite keeps Flask-SQLAlchemy's defaults.
+    """
+
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+    if uri.startswith("sqlite"):
+        return {}
+
+    options = {
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+    }
+    if config["DB_PGBOUNCER"]:
+        options["poolclass"] = NullPool
+    else:
+        options["pool_size"] = config["DB_POOL_SIZE"]
+        options["max_overflow"] = config["DB_MAX_OVERFLOW"]
+        options["pool_timeout"] = config["DB_POOL_TIMEOUT"]
+        timeout = config["DB_STATEMENT_TIMEOUT_MS"]
+        if timeout and uri.startswith("postgres"):
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
+
+
 def connect_db(app):
     """Connect database to Flask app. Call this in Flask app."""
 
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
     db.app = app
     db.init_app(app)
+
+    timeout = app.config.get("DB_STATEMENT_TIMEOUT_MS")
+    if app.config.get("DB_PGBOUNCER") and timeout:
+        with app.app_context():
+            engine = db.engine
+
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
@@ -0,0 +1,146 @@
+"""Password hashing for MoveIn, run off the request thread.
+
+bcrypt is deliberately slow, so hashing and verification run on a bounded
+process pool. When too many calls are already queued, new ones fail fast
+with HasherBusy instead of stalling every worker thread.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+
+class HasherBusy(RuntimeError):
+    """Too many password hashes are already queued."""
+
+
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def check_password(hashed, password):
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+def default_workers():
+    """CPUs per web worker: $WEB_CONCURRENCY workers share the machine's cores."""
+
+    web_workers = int(os.environ.get("WEB_CONCURRENCY", 1)) or 1
+    return max((os.cpu_count() or 1) // web_workers, 1)
+
+
+def pool_context():
+    """Start pool processes from a clean server process rather than forking.
+
+    The pool is created inside a threaded web worker, and forking a process
+    with other threads running can deadlock the child.
+    """
+
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def hash_rounds(hashed):
+    """Return the cost factor of a bcrypt hash like '$2b$12$...'."""
+
+    return int(hashed.split("$")[2])
+
+
+class PasswordHasher:
+    """bcrypt on a bounded process pool.
+
+    Configured from BCRYPT_LOG_ROUNDS (cost factor), BCRYPT_WORKERS (pool
+    size; 0 hashes inline on the calling thread) and BCRYPT_QUEUE_DEPTH
+    (calls allowed in flight before HasherBusy is raised).
+    """
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = default_workers()
+        self.queue_depth = 32
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(self.queue_depth)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["hasher"] = self
+        self.rounds = app.config.setdefault("BCRYPT_LOG_ROUNDS", 12)
+        self.workers = app.config.setdefault("BCRYPT_WORKERS", default_workers())
+        self.queue_depth = app.config.setdefault("BCRYPT_QUEUE_DEPTH", 32)
+        self._slots = threading.BoundedSemaphore(self.queue_depth)
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy("Too many password checks in progress.")
+        try:
+            if not self.workers:
+                return func(*args)
+            with self._lock:
+                if self._pool is None:
+                    # Created lazily so forked app workers each get their own pool.
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=pool_context()
+                    )
+            return self._pool.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Return a bcrypt hash of password at the configured cost."""
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+        return self._run(hash_password, password, self.rounds)
+
+    def verify(self, hashed, password):
+        """Return True if password matches hashed."""
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+        return self._run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """True if hashed was made with a different cost factor than configured."""
+
+        return hash_rounds(hashed) != self.rounds
+
+
+class LoginThrottle:
+    """Allow at most `max_attempts` password checks per IP per `window` seconds."""
+
+    def __init__(self, max_attempts=10, window=60, maxsize=10000):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.maxsize = maxsize
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def allow(self, ip):
+        """Record an attempt from ip; return False if it is over the limit."""
+
+        now = time.monotonic()
+        with self._lock:
+            if len(self._attempts) >= self.maxsize:
+                self._attempts = {
+                    key: times
+                    for key, times in self._attempts.items()
+                    if now - times[-1] < self.window
+                }
+            recent = [t for t in self._attempts.get(ip, []) if now - t < self.window]
+            allowed = len(recent) < self.max_attempts
+            if allowed:
+                recent.append(now)
+            self._attempts[ip] = recent
+            return allowed
+
+
+# The current app's hasher; create_app() builds one per app.
+hasher = LocalProxy(lambda: current_app.extensions["hasher"])
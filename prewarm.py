@@ -0,0 +1,117 @@
+"""Pick the zip codes and addresses to refresh before anyone searches them.
+
+Zip codes are ranked by how many saved searches (Location rows) and
+favorites they have; addresses are the favorited locations, most favorited
+first, in the form the search page sends them. Both are read in order and
+in batches, so callers can stop as soon as their call budget is used. The
+off-peak window is a "HH:MM-HH:MM" string in UTC and may wrap past
+midnight.
+"""
+
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import func
+
+from models import City, Favorite, Location, State, db
+
+BATCH_SIZE = 1000
+
+
+def parse_window(window):
+    """Return (start, end) times for a "HH:MM-HH:MM" window."""
+
+    try:
+        start, end = (time.fromisoformat(part.strip()) for part in window.split("-"))
+    except ValueError:
+        raise ValueError(f"Expected a window like 02:00-06:00, got {window!r}") from None
+    return start, end
+
+
+def in_window(now, window):
+    start, end = window
+    if start <= end:
+        return start <= now.time() < end
+    return now.time() >= start or now.time() < end
+
+
+def next_window_start(now, window):
+    """The first start of the window after now."""
+
+    start = datetime.combine(now.date(), window[0])
+    if start <= now:
+        start += timedelta(days=1)
+    return start
+
+
+def batches(query):
+    """Yield lists of up to BATCH_SIZE rows, one page at a time."""
+
+    offset = 0
+    while True:
+        rows = query.limit(BATCH_SIZE).offset(offset).all()
+        if rows:
+            yield rows
+        if len(rows) < BATCH_SIZE:
+            return
+        offset += BATCH_SIZE
+
+
+def collect(batches, keep, limit):
+    """Gather up to limit items that keep(batch) lets through, in batch order."""
+
+    picked = []
+    if limit <= 0:
+        return picked
+    for batch in batches:
+        picked.extend(keep(batch))
+        if len(picked) >= limit:
+            break
+    return picked[:limit]
+
+
+def hot_zip_codes():
+    """Yield batches of zip codes, most searched and favorited first."""
+
+    favorites = (
+        db.session.query(Location.zip_code, func.count(Favorite.id).label("n"))
+        .join(Favorite, Favorite.location_id == Location.id)
+        .group_by(Location.zip_code)
+        .subquery()
+    )
+    query = (
+        db.session.query(Location.zip_code)
+        .outerjoin(favorites, favorites.c.zip_code == Location.zip_code)
+        .group_by(Location.zip_code, favorites.c.n)
+        .order_by(
+            (func.count(Location.id) + func.coalesce(favorites.c.n, 0)).desc(),
+            Location.zip_code,
+        )
+    )
+    for rows in batches(query):
+        yield [str(row.zip_code).zfill(5) for row in rows]
+
+
+def favorite_addresses():
+    """Yield batches of favorited addresses, most favorited first.
+
+    Addresses read "street, city, state, zip", like a search for them.
+    """
+
+    query = (
+        db.session.query(
+            Location.street_address,
+            Location.zip_code,
+            City.name.label("city"),
+            State.name.label("state"),
+        )
+        .join(Favorite, Favorite.location_id == Location.id)
+        .join(City, Location.city_id == City.id)
+        .join(State, City.state_id == State.id)
+        .group_by(Location.id, City.name, State.name)
+        .order_by(func.count(Favorite.id).desc(), Location.id)
+    )
+    for rows in batches(query):
+        yield [
+            f"{row.street_address}, {row.city}, {row.state}, {str(row.zip_code).zfill(5)}"
+            for row in rows
+        ]
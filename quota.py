@@ -0,0 +1,254 @@
+"""Call budgets for the MapQuest and Realty Mole API keys.
+
+Each provider gets one row in `upstream_budgets`, shared by every worker:
+a token bucket that limits the call rate, a count of calls in the current
+calendar month checked against the plan's quota, and the last rate-limit
+headers the provider sent. Callers that can make do with cached data
+should check `low()` and skip the call when it is true.
+"""
+
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+import metrics
+from models import UpstreamBudget
+from upstream import QuotaExceededError
+
+logger = logging.getLogger("movein")
+
+# (limit, remaining, reset) header names: RapidAPI's, then the common ones.
+RATE_LIMIT_HEADERS = (
+    (
+        "X-RateLimit-Requests-Limit",
+        "X-RateLimit-Requests-Remaining",
+        "X-RateLimit-Requests-Reset",
+    ),
+    ("X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset"),
+)
+
+# How long a worker trusts its last view of the shared row in low().
+SNAPSHOT_TTL = 30
+
+
+def parse_rate_limit_headers(headers, now=None):
+    """Return (limit, remaining, reset_at epoch seconds) from a response's headers.
+
+    Missing values are None. A reset value is read as seconds from now,
+    unless it is large enough to be an epoch timestamp already.
+    """
+
+    now = time.time() if now is None else now
+    for names in RATE_LIMIT_HEADERS:
+        values = [headers.get(name) for name in names]
+        if values[1] is None:
+            continue
+        limit, remaining, reset = (
+            int(float(value)) if value not in (None, "") else None for value in values
+        )
+        if reset is not None and reset < 1_000_000_000:
+            reset += now
+        return limit, remaining, reset
+    return None, None, None
+
+
+class QuotaBudget:
+    """Rate limit and monthly quota for one provider, shared through the database.
+
+    `acquire()` takes a token before every upstream attempt, waiting up to
+    `max_wait` seconds for the bucket to refill, and raises
+    QuotaExceededError when the monthly quota or the provider's own
+    remaining count is spent. `quota` or `rate` of 0 means unlimited. If the
+    budget table cannot be read, calls are allowed and a warning logged.
+    """
+
+    def __init__(self, provider, engine=None, quota=0, rate=10.0, burst=20, reserve=0.1,
+                 max_wait=1.0):
+        self.provider = provider
+        self.engine = engine
+        self.quota = quota
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self._state = None
+        self._state_at = 0.0
+
+    def configure(self, engine, quota=0, rate=10.0, burst=20, reserve=0.1, max_wait=1.0):
+        self.engine = engine
+        self.quota = quota
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self._state = None
+
+    def _read(self, conn, lock=False):
+        table = UpstreamBudget.__table__
+        query = select(table).where(table.c.provider == self.provider)
+        if lock:
+            query = query.with_for_update()
+        row = conn.execute(query).mappings().first()
+        window = datetime.utcnow().date().replace(day=1)
+        if row is None:
+            return {
+                "provider": self.provider,
+                "tokens": float(self.burst),
+                "updated_at": time.time(),
+                "window_start": window,
+                "calls": 0,
+                "provider_limit": None,
+                "provider_remaining": None,
+                "provider_reset_at": None,
+            }, True
+        row = dict(row)
+        if row["window_start"] < window:
+            row.update(window_start=window, calls=0)
+        return row, False
+
+    def _write(self, conn, row, new):
+        table = UpstreamBudget.__table__
+        if new:
+            conn.execute(insert(table).values(**row))
+        else:
+            conn.execute(update(table).where(table.c.provider == self.provider).values(**row))
+        self._remember(row)
+
+    def _remember(self, row):
+        self._state = row
+        self._state_at = time.monotonic()
+        if self.quota:
+            metrics.upstream_budget.set(
+                max(self.quota - row["calls"], 0), provider=self.provider, kind="quota"
+            )
+        if row["provider_remaining"] is not None:
+            metrics.upstream_budget.set(
+                row["provider_remaining"], provider=self.provider, kind="provider"
+            )
+        metrics.upstream_budget.set(row["tokens"], provider=self.provider, kind="tokens")
+
+    def _take(self):
+        """Take a token; return 0, seconds until one is available, or None if spent."""
+
+        now = time.time()
+        with self.engine.begin() as conn:
+            row, new = self._read(conn, lock=True)
+            if self.quota and row["calls"] >= self.quota:
+                self._remember(row)
+                return None
+            reset_at = row["provider_reset_at"]
+            if row["provider_remaining"] == 0 and reset_at is not None and reset_at > now:
+                self._remember(row)
+                return None
+
+            tokens = float(self.burst)
+            if self.rate:
+                elapsed = max(now - row["updated_at"], 0)
+                tokens = min(self.burst, row["tokens"] + elapsed * self.rate)
+                if tokens < 1:
+                    return (1 - tokens) / self.rate
+                tokens -= 1
+
+            row.update(tokens=tokens, updated_at=now, calls=row["calls"] + 1)
+            if row["provider_remaining"]:
+                # Counted down locally until the next response reports it.
+                row["provider_remaining"] -= 1
+            self._write(conn, row, new)
+        return 0
+
+    def acquire(self):
+        """Take one call from the budget or raise QuotaExceededError."""
+
+        waited = 0.0
+        raced = False
+        while True:
+            try:
+                wait = self._take()
+            except IntegrityError:
+                if raced:
+                    raise
+                # Another worker created the row first; take from theirs.
+                raced = True
+                continue
+            except SQLAlchemyError:
+                logger.warning("Could not read the %s call budget", self.provider, exc_info=True)
+                return
+            if wait == 0:
+                return
+            if wait is None:
+                raise QuotaExceededError(f"{self.provider} quota is spent")
+            if waited + wait > self.max_wait:
+                raise QuotaExceededError(f"{self.provider} rate limit reached")
+            time.sleep(wait)
+            waited += wait
+
+    def record(self, response):
+        """Store the rate-limit state a provider reported with its response."""
+
+        now = time.time()
+        limit, remaining, reset_at = parse_rate_limit_headers(response.headers, now)
+        if remaining is None and response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "")
+            remaining = 0
+            reset_at = now + (int(retry_after) if retry_after.isdigit() else 60)
+        if remaining is None:
+            return
+
+        try:
+            with self.engine.begin() as conn:
+                row, new = self._read(conn, lock=True)
+                row.update(
+                    provider_limit=limit or row["provider_limit"],
+                    provider_remaining=remaining,
+                    provider_reset_at=reset_at,
+                )
+                self._write(conn, row, new)
+        except SQLAlchemyError:
+            logger.warning("Could not store the %s call budget", self.provider, exc_info=True)
+
+    def spent(self):
+        """True if the last state seen leaves no calls before the provider's reset.
+
+        Read from memory only, e.g. right after `record()` stored a 429.
+        """
+
+        row = self._state
+        if row is None:
+            return False
+        if self.quota and row["calls"] >= self.quota:
+            return True
+        reset_at = row["provider_reset_at"]
+        return row["provider_remaining"] == 0 and reset_at is not None and reset_at > time.time()
+
+    def remaining(self):
+        """Return the smallest fraction of budget left, or None if nothing is limited."""
+
+        if self._state is None and not self.quota:
+            # Nothing is limited until the provider reports a budget.
+            return None
+        if self._state is None or time.monotonic() - self._state_at > SNAPSHOT_TTL:
+            try:
+                with self.engine.connect() as conn:
+                    self._remember(self._read(conn)[0])
+            except SQLAlchemyError:
+                return None
+
+        row = self._state
+        fractions = []
+        if self.quota:
+            fractions.append(max(self.quota - row["calls"], 0) / self.quota)
+        reset_at = row["provider_reset_at"]
+        if row["provider_limit"] and row["provider_remaining"] is not None and (
+            reset_at is None or reset_at > time.time()
+        ):
+            fractions.append(row["provider_remaining"] / row["provider_limit"])
+        return min(fractions) if fractions else None
+
+    def low(self):
+        """True when less than `reserve` of the budget is left."""
+
+        left = self.remaining()
+        return left is not None and left < self.reserve
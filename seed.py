@@ -0,0 +1,234 @@
+"""Synthetic users, locations and favorites for scale-testing MoveIn.
+
+Rows are generated in batches and written with Core executemany inserts,
+or COPY on Postgres, never as ORM objects. Ids are assigned up front
+(continuing after the current maximum), so favorites can reference their
+locations without reading anything back, and every user shares one
+password hash. Run it with `flask seed-data`; see `--help` for sizes.
+"""
+
+import bisect
+import csv
+import io
+import random
+from datetime import datetime
+from itertools import accumulate
+
+from sqlalchemy import func, insert, select, text
+
+import geo
+from models import City, Favorite, Location, State, User
+from passwords import hasher
+
+STATES = [
+    "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", "Connecticut",
+    "Delaware", "Florida", "Georgia", "Hawaii", "Idaho", "Illinois", "Indiana", "Iowa",
+    "Kansas", "Kentucky", "Louisiana", "Maine", "Maryland", "Massachusetts", "Michigan",
+    "Minnesota", "Mississippi", "Missouri", "Montana", "Nebraska", "Nevada", "New hampshire",
+    "New jersey", "New mexico", "New york", "North carolina", "North dakota", "Ohio",
+    "Oklahoma", "Oregon", "Pennsylvania", "Rhode island", "South carolina", "South dakota",
+    "Tennessee", "Texas", "Utah", "Vermont", "Virginia", "Washington", "West virginia",
+    "Wisconsin", "Wyoming",
+]
+CITY_STEMS = ["Spring", "River", "Oak", "Green", "Fair", "Maple", "George", "Lake", "Clear",
+              "Pine", "Cedar", "Ash", "Elm", "Rock", "Sand", "Mill", "Bright", "Red", "Silver",
+              "West"]
+CITY_ENDINGS = ["field", "side", "ville", "ton", "view", "wood", "dale", "port", "burg", "ford"]
+STREETS = ["Main", "Oak", "Pine", "Maple", "Cedar", "Elm", "Park", "Lake", "Hill", "Curtis",
+           "Washington", "Lincoln", "Jefferson", "Sunset", "Highland", "Ridge", "Willow",
+           "Church", "Mill", "Spring"]
+STREET_TYPES = ["St", "Ave", "Blvd", "Rd", "Ln", "Dr", "Ct", "Way"]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Casey", "Riley", "Morgan", "Jamie", "Avery",
+               "Quinn", "Drew", "Rowan"]
+LAST_NAMES = ["Smith", "Garcia", "Nguyen", "Johnson", "Lee", "Brown", "Patel", "Miller",
+              "Davis", "Lopez", "Wilson", "Clark"]
+
+
+class ZipfChoice:
+    """Pick items with probability proportional to 1 / rank**skew (0 is uniform)."""
+
+    def __init__(self, items, skew, rng):
+        self.items = items
+        self.rng = rng
+        self.cumulative = list(accumulate(1 / (rank ** skew) for rank in range(1, len(items) + 1)))
+
+    def __call__(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return self.items[bisect.bisect_left(self.cumulative, point)]
+
+
+def zip_code_pool(count):
+    """`count` distinct five-digit zip codes, the same ones for every run."""
+
+    return [10000 + (i * 7919) % 89999 for i in range(count)]
+
+
+def next_id(conn, model):
+    return (conn.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def write_batch(conn, model, rows):
+    """Insert rows with COPY on Postgres, executemany elsewhere."""
+
+    if not rows:
+        return
+    if conn.dialect.name != "postgresql":
+        conn.execute(insert(model), rows)
+        return
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["" if row[c] is None else row[c] for c in columns])
+    buffer.seek(0)
+    cursor = conn.connection.dbapi_connection.cursor()
+    cursor.copy_expert(
+        f"COPY {model.__tablename__} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer,
+    )
+
+
+def reset_sequence(conn, model):
+    """Move a Postgres serial sequence past ids that were inserted explicitly."""
+
+    if conn.dialect.name == "postgresql":
+        table = model.__tablename__
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT COALESCE(MAX(id), 1) FROM {table}))"
+        ))
+
+
+def seed_reference_data(conn, cities, rng):
+    """Make sure every state and `cities` cities exist; return the city ids."""
+
+    existing = dict(conn.execute(select(State.name, State.id)).all())
+    missing = [{"name": name} for name in STATES if name not in existing]
+    if missing:
+        conn.execute(insert(State), missing)
+        existing = dict(conn.execute(select(State.name, State.id)).all())
+    state_ids = [existing[name] for name in STATES]
+
+    have = set(conn.execute(select(City.name, City.state_id)).all())
+    wanted = []
+    for i in range(cities):
+        name = CITY_STEMS[i % len(CITY_STEMS)] + CITY_ENDINGS[i // len(CITY_STEMS) % len(CITY_ENDINGS)]
+        state_id = state_ids[i % len(state_ids)]
+        if i >= len(CITY_STEMS) * len(CITY_ENDINGS):
+            name = f"{name} {i // (len(CITY_STEMS) * len(CITY_ENDINGS)) + 1}"
+        if (name, state_id) not in have:
+            wanted.append({"name": name, "state_id": state_id})
+    if wanted:
+        conn.execute(insert(City), wanted)
+    rows = conn.execute(select(City.id).order_by(City.id).limit(cities)).scalars().all()
+    rng.shuffle(rows)
+    return rows
+
+
+def seed_database(
+    engine,
+    users=1000,
+    locations_per_user=5,
+    favorites_per_user=3,
+    cities=500,
+    zip_codes=2000,
+    zip_skew=1.0,
+    geocoded=0.8,
+    batch_size=10000,
+    seed=0,
+    password="password",
+    progress=None,
+):
+    """Insert synthetic users, the locations they searched and their favorites.
+
+    Each user gets 0..2*locations_per_user locations (mean
+    locations_per_user), and favorites up to favorites_per_user of them on
+    average. Zip codes follow a Zipf distribution with exponent zip_skew
+    over `zip_codes` codes, and cities are reused the same way, so some
+    areas are much busier than others. A `geocoded` fraction of locations
+    get stored coordinates. Commits after every batch and returns the
+    number of rows written per table plus the first new user id.
+    """
+
+    rng = random.Random(seed)
+    report = progress or (lambda message: None)
+    password_hash = hasher.hash(password)
+    pick_zip = ZipfChoice(zip_code_pool(zip_codes), zip_skew, rng)
+    now = datetime.utcnow()
+
+    with engine.connect() as conn:
+        city_ids = seed_reference_data(conn, cities, rng)
+        pick_city = ZipfChoice(city_ids, zip_skew, rng)
+        conn.commit()
+
+        user_id = first_user_id = next_id(conn, User)
+        location_id = next_id(conn, Location)
+        favorite_id = next_id(conn, Favorite)
+        counts = {"users": 0, "locations": 0, "favorites": 0}
+        batches = {User: [], Location: [], Favorite: []}
+
+        def flush(force=False):
+            if not force and max(len(rows) for rows in batches.values()) < batch_size:
+                return
+            # Parents first, for the foreign keys.
+            for model in (User, Location, Favorite):
+                write_batch(conn, model, batches[model])
+                batches[model] = []
+            conn.commit()
+            report(f"{counts['users']} users, {counts['locations']} locations, "
+                   f"{counts['favorites']} favorites")
+
+        for _ in range(users):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            batches[User].append({
+                "id": user_id,
+                "username": f"{first.lower()}{user_id}",
+                "first_name": first,
+                "last_name": last,
+                "email": f"{first.lower()}.{last.lower()}{user_id}@example.com",
+                "location": None,
+                "password": password_hash,
+            })
+            counts["users"] += 1
+
+            searched = rng.randint(0, 2 * locations_per_user)
+            favorites = min(searched, rng.randint(0, 2 * favorites_per_user))
+            for n in range(searched):
+                lat, lng = rng.uniform(25, 49), rng.uniform(-124, -67)
+                located = rng.random() < geocoded
+                batches[Location].append({
+                    "id": location_id,
+                    "street_address": f"{rng.randint(1, 9999)} {rng.choice(STREETS)} "
+                                      f"{rng.choice(STREET_TYPES)} #{location_id}",
+                    "zip_code": pick_zip(),
+                    "city_id": pick_city(),
+                    "bedrooms": rng.choice((0, 1, 1, 2, 2, 2, 3, 3, 4, 5)),
+                    "user_id": user_id,
+                    "latitude": lat if located else None,
+                    "longitude": lng if located else None,
+                    "geohash": geo.encode(lat, lng) if located else None,
+                    "geocode_provider": "seed" if located else None,
+                    "geocoded_at": now if located else None,
+                })
+                if n < favorites:
+                    batches[Favorite].append({
+                        "id": favorite_id,
+                        "rent_average": rng.randint(600, 4500),
+                        "user_id": user_id,
+                        "location_id": location_id,
+                    })
+                    favorite_id += 1
+                    counts["favorites"] += 1
+                location_id += 1
+                counts["locations"] += 1
+            user_id += 1
+            flush()
+        flush(force=True)
+
+        for model in (User, Location, Favorite):
+            reset_sequence(conn, model)
+        conn.commit()
+
+    counts["first_user_id"] = first_user_id
+    return counts
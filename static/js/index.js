@@ -1,6 +1,9 @@
 // Initialize google map.
 let map;
 
+// Rental average from the most recent search, reused when saving a favorite.
+let searchAverage;
+
 // async function return map based on address search form response coordinates.
 async function initMap(coordinates) {
     // Coordinates of address form input
@@ -25,6 +28,21 @@ async function initMap(coordinates) {
     });
 }
 
+// Poll a background job until it finishes; resolves to its status. Each
+// poll is held for at most a couple of seconds, so a waiting page does not
+// tie up a web worker.
+async function waitForJob(jobId) {
+    while (true) {
+        const response = await axios.get(`/api/jobs/${jobId}`, {
+            params: { wait: 2 },
+        });
+        const job = response.data;
+        if (job.status === "done" || job.status === "failed") {
+            return job;
+        }
+    }
+}
+
 // Process address search form.
 async function processForm(evt) {
     evt.preventDefault();
@@ -35,18 +53,7 @@ async function processForm(evt) {
     let state = $("#state").val();
     let bedrooms = $("#bedrooms").val();
 
-    let payload = {
-        address: streetAddress,
-        zipcode: zipcode,
-        city: city,
-        state: state,
-    };
-
-    let rentalPayload = {
-        zipcode: zipcode,
-    };
-
-    let dbPayload = {
+    let searchPayload = {
         address: streetAddress,
         zipcode: zipcode,
         city: city,
@@ -54,49 +61,45 @@ async function processForm(evt) {
         bedrooms: bedrooms,
     };
 
-    // save location data to DB
-    const saveLocation = await axios.post("/adddata", dbPayload, {
-        headers: { "Content-Type": "application/json" },
-    });
-
-    // retrieve address coordinates coordinates from '/api/geocode' python endpoint.
-    const data = await axios
-        .post("/api/geocode", payload, {
+    // save location, geocode it and retrieve rental averages in one request
+    // to the '/api/search' python endpoint.
+    const search = await axios
+        .post("/api/search", searchPayload, {
             headers: { "Content-Type": "application/json" },
         })
         .then(function (response) {
-            console.log(response);
-            return response;
+            console.log(response.data);
+            return response.data;
         });
 
-    const coordinates = data.data;
+    // Values missing from the caches are looked up by background jobs.
+    const pending = Object.entries(search.jobs || {});
+    await Promise.all(
+        pending.map(async ([field, jobId]) => {
+            const job = await waitForJob(jobId);
+            search[field] = job.result;
+        })
+    );
+
+    const coordinates = search.coords;
     console.log(coordinates);
 
-    // retrieve rental averages from '/api/rental-data' python endpoint and display results
-    const realtyData = await axios
-        .post("/api/rental-data", rentalPayload, {
-            headers: { "Content-Type": "application/json" },
-        })
-        .then(function (response) {
-            console.log(response.data);
-            if (response.data == "error") {
-                window.location.replace("/search");
-            }
-            return response;
-        });
+    if (search.rental_data === null) {
+        window.location.replace("/search");
+        return;
+    }
+    // rental_data only carries the figures for the searched bedroom count.
+    const average = search.rental_data.averageRent;
 
     // check if data exists for search parameters.
-    if (!realtyData["data"]["rentalData"]["detailed"][`${bedrooms}`]) {
+    if (average === null) {
         return $("#rental-data").html(
             `<br>
             <br>
             <div class="alert alert-warning" role="alert">No data available for ${bedrooms}-bedroom rentals in ${zipcode}.</div>`
         );
     } else {
-        const average =
-            realtyData["data"]["rentalData"]["detailed"][`${bedrooms}`][
-                "averageRent"
-            ];
+        searchAverage = average;
 
         // Display results
         $("#rental-data").html(`
@@ -139,25 +142,9 @@ async function saveFavorite(evt) {
 
     let zipcode = $("#zipcode").val();
     let address = $("#address").val();
-    let bedrooms = $("#bedrooms").val();
 
-    let rentalPayload = {
-        zipcode: zipcode,
-    };
-
-    const realtyData = await axios
-        .post("/api/rental-data", rentalPayload, {
-            headers: { "Content-Type": "application/json" },
-        })
-        .then(function (response) {
-            console.log(response);
-            return response;
-        });
-
-    const average =
-        realtyData["data"]["rentalData"]["detailed"][`${bedrooms}`][
-            "averageRent"
-        ];
+    // Reuse the average from the search instead of fetching rental data again.
+    const average = searchAverage;
 
     let favPayload = {
         average: average,
@@ -222,7 +209,13 @@ async function loadFavorites() {
     // Display custom markers with rental & bedroom data for each favorite.
 
     // Get coordinates for each favorite from python endpoint.
-    const data = await axios.get("/api/batchgeocode");
+    let data = await axios.get("/api/batchgeocode");
+    // Favorites without stored coordinates are geocoded by a background job.
+    const geocodeJob = data.headers["x-geocode-job"];
+    if (geocodeJob) {
+        await waitForJob(geocodeJob);
+        data = await axios.get("/api/batchgeocode");
+    }
     console.log(data.data);
 
     // Get addresses for each favorite from python endpoint.
@@ -236,6 +229,10 @@ async function loadFavorites() {
     // Create array of dict. objects to input into initFavsMap().
     let savedFaves = [];
     for (let i = 0; i < length.length; i++) {
+        // Skip favorites that could not be geocoded.
+        if (!coordinates[i]) {
+            continue;
+        }
         let position = {};
         console.log(coordinates[i]);
         position["position"] = coordinates[i];
@@ -1,11 +1,32 @@
+import gzip
 import unittest
-from app import app, db
-from models import User
+from concurrent.futures import Executor, Future
+from unittest import mock
+
+import app as app_module
+from app import create_app, db
+from models import User, Location
+
+app = create_app("testing")
+
+
+class InlineExecutor(Executor):
+    """Run submitted work at once; threads can't share an in-memory SQLite connection."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
 
 
 class APITestCase(unittest.TestCase):
     def setUp(self):
         """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.app = app.test_client()
@@ -15,6 +36,7 @@ class APITestCase(unittest.TestCase):
         """Clean up after each test."""
         db.session.remove()
         db.drop_all()
+        self.ctx.pop()
 
     def test_api_geocode(self):
         """Test the /api/geocode route."""
@@ -48,7 +70,7 @@ class APITestCase(unittest.TestCase):
         # Assert that the response status code is 200 (OK)
         self.assertEqual(response.status_code, 200)
         # Assert that the response is returning the applicable data
-        self.assertIn(b'{"id":"90210","rentalData"', response.data)
+        self.assertIn(b'"zipcode":"90210"', response.data)
 
     def test_api_rental_data_invalid_zipcode(self):
         """Test the /api/rental-data route with an invalid zipcode."""
@@ -65,6 +87,93 @@ class APITestCase(unittest.TestCase):
         # For example, if the error message is returned as JSON, you can do something like:
         # self.assertIn(b'"error": "Invalid zipcode"', response.data)
 
+    def test_api_search(self):
+        """Test the combined /api/search route."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+
+        data = {'address': '630 S Curtis Ave', 'city': 'Tucson', 'state': 'AZ',
+                'zipcode': '85719', 'bedrooms': 2}
+        rental = {'id': '85719', 'rentalData': {'detailed': [
+            {'bedrooms': 2, 'averageRent': 1200, 'minRent': 900, 'maxRent': 1500}]}}
+        with mock.patch('app.get_coords', return_value={'lat': 32.2, 'lng': -110.9}), \
+                mock.patch.object(app_module.rental_cache, 'fetch', return_value=rental), \
+                mock.patch.dict(app.extensions, {'upstream_executor': InlineExecutor()}):
+            response = self.app.post('/api/search', json=data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['coords'], {'lat': 32.2, 'lng': -110.9})
+        self.assertEqual(response.json['rental_data'],
+                         {'zipcode': '85719', 'bedrooms': 2, 'averageRent': 1200,
+                          'minRent': 900, 'maxRent': 1500})
+        self.assertEqual(response.json['location']['address'], '630 S Curtis Ave')
+        location = Location.query.filter_by(street_address='630 S Curtis Ave').first()
+        self.assertEqual((location.latitude, location.longitude), (32.2, -110.9))
+        self.assertEqual(location.geocode_provider, 'mapquest')
+
+
+    def test_rental_data_projection(self):
+        """Test that /api/rental-data returns a compact summary with an ETag."""
+        rental = {'id': '85701', 'rentalData': {
+            'detailed': [{'bedrooms': 1, 'averageRent': 900}, {'bedrooms': 2, 'averageRent': 1200}],
+            'history': {
+                '2023-01': {'detailed': [{'bedrooms': 2, 'averageRent': 1100}]},
+                '2023-02': {'detailed': [{'bedrooms': 2, 'averageRent': 1150}]},
+                '2023-03': {'detailed': [{'bedrooms': 1, 'averageRent': 850}]},
+            }}}
+        with mock.patch.object(app_module.rental_cache, 'fetch', return_value=rental):
+            response = self.app.get('/api/rental-data?zipcode=85701&bedrooms=2&history=2')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['averageRent'], 1200)
+            self.assertEqual(response.json['history'], [
+                {'month': '2023-02', 'averageRent': 1150},
+                {'month': '2023-03', 'averageRent': None},
+            ])
+            self.assertNotIn('rentalData', response.json)
+
+            etag = response.headers['ETag']
+            repeat = self.app.get('/api/rental-data?zipcode=85701&bedrooms=2&history=2',
+                                  headers={'If-None-Match': etag})
+            self.assertEqual(repeat.status_code, 304)
+            self.assertEqual(repeat.data, b'')
+
+            summary = self.app.post('/api/rental-data', json={'zipcode': '85701'})
+            self.assertEqual(summary.json['averages'], {'1': 900, '2': 1200})
+
+    def test_rental_data_bad_numbers(self):
+        """Test that /api/rental-data rejects non-numeric input with a 400."""
+        with mock.patch.object(app_module.rental_cache, 'fetch') as fetch:
+            for response in [
+                self.app.get('/api/rental-data?zipcode=85702&bedrooms=abc'),
+                self.app.get('/api/rental-data?zipcode=85702&history=two'),
+                self.app.get('/api/rental-data?bedrooms=2'),
+                self.app.post('/api/rental-data', json={'zipcode': '85702', 'bedrooms': [2]}),
+            ]:
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json)
+        fetch.assert_not_called()
+
+    def test_response_compression(self):
+        """Test that large responses are gzipped when the client accepts it."""
+        detailed = [{'bedrooms': n, 'averageRent': 1000 + n} for n in range(6)]
+        history = {f'2022-{m:02}': {'detailed': detailed} for m in range(1, 13)}
+        rental = {'id': '85702', 'rentalData': {'detailed': detailed, 'history': history}}
+        app.config['COMPRESS_MIN_SIZE'] = 0
+        with mock.patch.object(app_module.rental_cache, 'fetch', return_value=rental):
+            plain = self.app.get('/api/rental-data?zipcode=85702&history=12')
+            zipped = self.app.get('/api/rental-data?zipcode=85702&history=12',
+                                  headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', zipped.headers['Vary'])
+        self.assertTrue(zipped.headers['ETag'].startswith('W/'))
+        self.assertEqual(gzip.decompress(zipped.data), plain.data)
+
 
 if __name__ == '__main__':
     unittest.main()
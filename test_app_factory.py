@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import app as app_module
+from app import create_app, db
+from models import State
+
+
+class CreateAppTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.app = create_app('testing', SQLALCHEMY_DATABASE_URI=f'sqlite:///{self.path}',
+                              MQ_API_BASE_URL='http://mq.test')
+
+    def tearDown(self):
+        """Clean up after each test."""
+        with self.app.app_context():
+            db.engine.dispose()
+        os.remove(self.path)
+
+    def test_no_connection_left_for_forks(self):
+        """Preforked workers must not inherit a pooled connection."""
+        with self.app.app_context():
+            self.assertEqual(db.engine.pool.checkedin(), 0)
+            db.create_all()
+            db.session.add(State(name='Arizona'))
+            db.session.commit()
+            db.session.remove()
+
+        self.app.test_client().get('/')
+        with self.app.app_context():
+            self.assertIsNotNone(app_module.reference_cache.get_state('Arizona'))
+
+    def test_proxy_fix(self):
+        """Behind a proxy, logins are throttled per forwarded client address."""
+        app = create_app('testing', PROXY_FIX_X_FOR=1)
+        with app.app_context(), mock.patch.object(app_module.login_throttle, 'allow',
+                                                  return_value=False) as allow:
+            app.test_client().post(
+                '/login', data={'username': 'someone', 'password': 'password'},
+                headers={'X-Forwarded-For': '203.0.113.7'},
+                environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        allow.assert_called_once_with('203.0.113.7')
+
+    def test_clients_are_per_app(self):
+        other = create_app('testing', MQ_API_BASE_URL='http://other.test')
+        with self.app.app_context():
+            self.assertEqual(app_module.mapquest.base_url, 'http://mq.test')
+        with other.app_context():
+            self.assertEqual(app_module.mapquest.base_url, 'http://other.test')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import app as app_module
+import benchmark
+from app import create_app, db
+
+stub = benchmark.start_stub_server(latency=0, error_rate=0)
+stub_url = f"http://127.0.0.1:{stub.server_port}"
+app = create_app("testing", MQ_API_BASE_URL=f"{stub_url}/geocoding/v1",
+                 RM_API_BASE_URL=f"{stub_url}/zipCodes", MQ_RATE_PER_SECOND=0,
+                 RM_RATE_PER_SECOND=0)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_stub_matches_upstream_shapes(self):
+        """The app parses the stand-in responses like the real ones."""
+        address = '630 S Curtis Ave, Tucson, AZ, 85719'
+        self.assertEqual(app_module.get_coords(address), benchmark.fake_coords(address))
+        found = app_module.geocode_chunk(['1 Main St 85701', '2 Oak Ave 85702'])
+        self.assertEqual(found['2 Oak Ave 85702'], benchmark.fake_coords('2 Oak Ave 85702'))
+        rental = app_module.fetch_realty_data('85719')
+        self.assertEqual(app_module.rental_summary(rental, 2)['averageRent'],
+                         benchmark.fake_rental_data('85719')['rentalData']['detailed'][2]['averageRent'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 0.5), 50)
+        self.assertEqual(benchmark.percentile(values, 0.99), 99)
+        self.assertIsNone(benchmark.percentile([], 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import app as app_module
+from app import create_app, db, get_coords, get_batch_coords
+from cache import TTLCache, GeocodeCache, ZipRentalCache, ReferenceCache, normalize_address
+from models import Geocode, RentalCache, State, City
+
+app = create_app("testing")
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def test_hit_and_miss_counters(self):
+        """Counters track lookups."""
+        cache = TTLCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted when full."""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        """Entries past their TTL are treated as misses."""
+        cache = TTLCache(maxsize=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address(' 630 S Curtis Ave,  Tucson, AZ '),
+                         '630 s curtis ave tucson az')
+
+
+class GeocodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['TESTING'] = True
+        db.create_all()
+        self.cache = GeocodeCache(maxsize=8, ttl=60)
+        patcher = mock.patch.object(app_module, 'geocode_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_durable_tier(self):
+        """A fresh cache instance reads coordinates back from the database."""
+        self.cache.set('630 S Curtis Ave, Tucson', {'lat': 32.2, 'lng': -110.9})
+        self.assertIsNotNone(db.session.get(Geocode, '630 s curtis ave tucson'))
+
+        fresh = GeocodeCache(maxsize=8, ttl=60)
+        self.assertEqual(fresh.get('630 s curtis ave, TUCSON'),
+                         {'lat': 32.2, 'lng': -110.9})
+        self.assertEqual(fresh.stats()['db_hits'], 1)
+
+    def test_purge_expired(self):
+        """`flask purge-geocodes` deletes rows past the durable TTL."""
+        old = datetime.utcnow() - timedelta(seconds=self.cache.db_ttl + 60)
+        db.session.add_all([Geocode(address='old', lat=1, lng=2, fetched_at=old),
+                            Geocode(address='new', lat=1, lng=2)])
+        db.session.commit()
+        result = app.test_cli_runner().invoke(args=['purge-geocodes'])
+        self.assertIn('Removed 1 expired geocodes', result.output)
+        self.assertEqual([row.address for row in Geocode.query.all()], ['new'])
+
+    def test_get_coords_skips_network_on_hit(self):
+        """Repeat geocodes are served from the cache."""
+        payload = {'results': [{'locations': [{'latLng': {'lat': 1.0, 'lng': 2.0}}]}]}
+        with mock.patch.object(app_module.mapquest, 'get') as fake_get:
+            fake_get.return_value.json.return_value = payload
+            self.assertEqual(get_coords('1 Main St'), {'lat': 1.0, 'lng': 2.0})
+            self.assertEqual(get_coords('1 main st'), {'lat': 1.0, 'lng': 2.0})
+        self.assertEqual(fake_get.call_count, 1)
+
+    def test_batch_only_fetches_misses(self):
+        """Batch geocoding sends only uncached addresses upstream."""
+        self.cache.set('1 Main St', {'lat': 1.0, 'lng': 2.0})
+        payload = {'results': [{'locations': [{'latLng': {'lat': 3.0, 'lng': 4.0}}]}]}
+        with mock.patch.object(app_module.mapquest, 'post') as fake_post:
+            fake_post.return_value.json.return_value = payload
+            coords = get_batch_coords(['1 Main St', '2 Main St'])
+        self.assertEqual(fake_post.call_args.kwargs['json'], {'locations': ['2 Main St']})
+        self.assertEqual(coords, {0: {'lat': 1.0, 'lng': 2.0}, 1: {'lat': 3.0, 'lng': 4.0}})
+
+    def test_batch_chunks_and_partial_failure(self):
+        """Misses are deduplicated and chunked; a failed chunk only fails its addresses."""
+        def batch(path, json):
+            if json['locations'] == ['3 Main St']:
+                raise app_module.UpstreamError('boom')
+            res = mock.Mock()
+            res.json.return_value = {'results': [
+                {'locations': [{'latLng': {'lat': float(n), 'lng': 0.0}}]}
+                for n, _ in enumerate(json['locations'])]}
+            return res
+
+        addresses = ['1 Main St', '2 Main St', '1 MAIN ST', '3 Main St']
+        with mock.patch.object(app_module, 'MQ_BATCH_SIZE', 2), \
+                mock.patch.object(app_module.mapquest, 'post', side_effect=batch) as fake_post:
+            coords, failed = app_module.batch_geocode(addresses)
+
+        self.assertEqual(fake_post.call_count, 2)
+        self.assertEqual(coords[0], coords[2])
+        self.assertIsNotNone(coords[1])
+        self.assertIsNone(coords[3])
+        self.assertEqual(failed, ['3 Main St'])
+
+
+class ZipRentalCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['TESTING'] = True
+        db.create_all()
+        self.fetch = mock.Mock(return_value={'id': '90210', 'rentalData': {}})
+        self.cache = ZipRentalCache(self.fetch, maxsize=8, ttl=60, stale_ttl=600)
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_one_upstream_call_within_ttl(self):
+        """Repeat lookups, including from a second worker, reuse the first fetch."""
+        self.assertEqual(self.cache.get(90210)['id'], '90210')
+        self.cache.get('90210')
+        other_worker = ZipRentalCache(self.fetch, maxsize=8, ttl=60, stale_ttl=600)
+        other_worker.get('90210')
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_failures_are_not_cached(self):
+        self.fetch.return_value = None
+        self.assertIsNone(self.cache.get('00000'))
+        self.assertIsNone(db.session.get(RentalCache, '00000'))
+
+    def test_stale_entry_served_while_refreshing(self):
+        """Stale rows are returned at once and refreshed in the background."""
+        old = datetime.utcnow() - timedelta(seconds=120)
+        db.session.add(RentalCache(zip_code='90210', data={'id': 'old'}, fetched_at=old))
+        db.session.commit()
+
+        with mock.patch.object(self.cache, '_refresh_in_background') as refresh:
+            self.assertEqual(self.cache.get('90210'), {'id': 'old'})
+        refresh.assert_called_once_with('90210')
+        self.assertEqual(self.cache.stats()['stale_hits'], 1)
+
+    def test_background_refresh_uses_upstream_pool(self):
+        """Stale refreshes are queued on the bounded upstream executor, once per zip."""
+        executor = mock.Mock()
+        with mock.patch.dict(app.extensions, {'upstream_executor': executor}):
+            self.cache._refresh_in_background('90210')
+            self.cache._refresh_in_background('90210')
+        executor.submit.assert_called_once()
+
+
+class ReferenceCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['TESTING'] = True
+        db.create_all()
+        state = State(name='Arizona')
+        db.session.add(state)
+        db.session.commit()
+        db.session.add(City(name='Tucson', state_id=state.id))
+        db.session.commit()
+        self.state_id = state.id
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_warm(self):
+        """Warming loads existing states and cities."""
+        cache = ReferenceCache()
+        self.assertTrue(cache.warm())
+        self.assertEqual(cache.get_state('Arizona'), self.state_id)
+        self.assertIsNotNone(cache.get_city('Tucson', self.state_id))
+        self.assertIsNone(cache.get_city('Tucson', self.state_id + 1))
+
+    def test_invalidated_when_tables_dropped(self):
+        app_module.reference_cache.warm()
+        db.drop_all()
+        self.assertIsNone(app_module.reference_cache.get_state('Arizona'))
+        db.create_all()
+
+
+if __name__ == '__main__':
+    unittest.main()
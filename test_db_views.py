@@ -1,11 +1,23 @@
+import io
+import json
+import os
+import tempfile
 import unittest
-from app import app, db
-from models import User, Location, City, State, Favorite
+from datetime import date
+from unittest import mock
+
+import app as app_module
+from app import create_app, db
+from models import User, Location, City, State, Favorite, ZipRentalStat, bulk_upsert
+
+app = create_app("testing")
 
 
 class FavoritesAPITestCase(unittest.TestCase):
     def setUp(self):
         """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.app = app.test_client()
@@ -15,6 +27,7 @@ class FavoritesAPITestCase(unittest.TestCase):
         """Clean up after each test."""
         db.session.remove()
         db.drop_all()
+        self.ctx.pop()
 
     def test_adddata_route(self):
         """Test the /adddata route."""
@@ -54,6 +67,26 @@ class FavoritesAPITestCase(unittest.TestCase):
         self.assertIn(b'"zipcode":"12345"', response.data)
         self.assertIn(b'"bedrooms":2', response.data)
 
+    def test_adddata_reuses_existing_rows(self):
+        """Test that repeat searches upsert instead of duplicating rows."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+
+        data = {'state': 'arizona', 'city': 'tucson', 'address': '123 Test St',
+                'zipcode': '85719', 'bedrooms': 2}
+        self.app.post('/adddata', json=data)
+        self.app.post('/adddata', json=data)
+        self.app.post('/adddata', json=dict(data, state='nevada', address='9 Other St'))
+
+        self.assertEqual(State.query.count(), 2)
+        # Same city name in a different state is a different city.
+        self.assertEqual(City.query.filter_by(name='Tucson').count(), 2)
+        self.assertEqual(Location.query.count(), 2)
+
     def test_favorites_route_authenticated_user(self):
         """Test the /favorites route for an authenticated user."""
         # Create a test user and add to the database
@@ -170,6 +203,242 @@ class FavoritesAPITestCase(unittest.TestCase):
         self.assertIn(b'456 Test St 67890 Bedrooms: 3', response.data)
         self.assertIn(b'789 Test St 12345 Bedrooms: 2', response.data)
 
+    def test_favorites_data_pagination(self):
+        """Test paging through /favorites/data."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+
+        state = State(name='Test State')
+        db.session.add(state)
+        db.session.commit()
+        city = City(name='Test City', state_id=state.id)
+        db.session.add(city)
+        db.session.commit()
+        locations = [Location(street_address=f'{n} Test St', zip_code='67890', city_id=city.id,
+                              bedrooms=2, user_id=user.id) for n in range(3)]
+        db.session.add_all(locations)
+        db.session.commit()
+        db.session.add_all([Favorite(rent_average=1000, user_id=user.id, location_id=loc.id)
+                            for loc in locations])
+        db.session.commit()
+
+        response = self.app.get('/favorites/data?page=2&per_page=2')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, ['2 Test St 67890 Bedrooms: 2 Rent: 1000'])
+
+    def test_favorites_data_scoped_to_user(self):
+        """Test that /favorites/data only returns the logged in user's favorites."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        other = User.signup(username='otheruser', first_name='Other', last_name='User',
+                            email='other@example.com', password='testpassword')
+        db.session.commit()
+
+        location1 = Location(street_address='456 Test St', zip_code='67890', bedrooms=3,
+                             user_id=user.id)
+        location2 = Location(street_address='789 Test St', zip_code='12345', bedrooms=2,
+                             user_id=other.id)
+        db.session.add_all([location1, location2])
+        db.session.commit()
+        db.session.add_all([
+            Favorite(rent_average=2000, user_id=user.id, location_id=location1.id),
+            Favorite(rent_average=3000, user_id=other.id, location_id=location2.id)])
+        db.session.commit()
+
+        response = self.app.get('/favorites/data')
+        self.assertEqual(response.status_code, 401)
+
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+
+        response = self.app.get('/favorites/data')
+        self.assertEqual(response.json, ['456 Test St 67890 Bedrooms: 3 Rent: 2000'])
+
+    def test_batchgeocode_uses_stored_coords(self):
+        """Test that /api/batchgeocode reads stored coordinates and backfills the rest."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+
+        stored = Location(street_address='456 Test St', zip_code='67890', bedrooms=3,
+                          user_id=user.id, latitude=1.5, longitude=2.5)
+        missing = Location(street_address='789 Test St', zip_code='12345', bedrooms=2,
+                           user_id=user.id)
+        db.session.add_all([stored, missing])
+        db.session.commit()
+        db.session.add_all([
+            Favorite(rent_average=2000, user_id=user.id, location_id=stored.id),
+            Favorite(rent_average=3000, user_id=user.id, location_id=missing.id)])
+        db.session.commit()
+
+        batch = mock.Mock(return_value=({0: {'lat': 3.5, 'lng': 4.5}}, []))
+        with mock.patch.object(app_module, 'batch_geocode', batch):
+            response = self.app.get('/api/batchgeocode')
+            self.assertEqual(response.json, {'0': {'lat': 1.5, 'lng': 2.5},
+                                             '1': {'lat': 3.5, 'lng': 4.5}})
+            batch.assert_called_once_with(['789 Test St 12345'])
+
+            # The second load is a pure database read.
+            self.app.get('/api/batchgeocode')
+            self.assertEqual(batch.call_count, 1)
+
+    def test_backfill_coords_command(self):
+        """Test the backfill-coords CLI command."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+        db.session.add(Location(street_address='789 Test St', zip_code='12345',
+                                bedrooms=2, user_id=user.id))
+        db.session.commit()
+
+        batch = mock.Mock(return_value=({0: {'lat': 3.5, 'lng': 4.5}}, []))
+        with mock.patch.object(app_module, 'batch_geocode', batch):
+            result = app.test_cli_runner().invoke(args=['backfill-coords'])
+
+        self.assertIn('Geocoded 1 locations, 0 failed.', result.output)
+        self.assertEqual(Location.query.one().latitude, 3.5)
+
+    def test_import_rental_stats_command(self):
+        """Test the import-rental-stats CLI command with CSV and JSON files."""
+        today = date.today().isoformat()
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, 'stats.csv')
+            with open(csv_path, 'w') as f:
+                f.write('zip_code,bedrooms,as_of,average_rent,min_rent,max_rent,total_rentals\n')
+                f.write(f'12345,1,{today},1000,800,1200,10\n')
+                f.write(f'12345,2,{today},1500,,,\n')
+            json_path = os.path.join(tmp, 'stats.json')
+            with open(json_path, 'w') as f:
+                json.dump({'id': '54321', 'rentalData': {
+                    'detailed': [{'bedrooms': 0, 'averageRent': 700}],
+                    'history': {'2023-01': {'detailed': [{'bedrooms': 0, 'averageRent': 650}]}},
+                }}, f)
+
+            runner = app.test_cli_runner()
+            result = runner.invoke(args=['import-rental-stats', csv_path, json_path])
+            # Re-importing updates rows instead of duplicating them.
+            runner.invoke(args=['import-rental-stats', csv_path])
+
+        self.assertIn('Imported 4 rows', result.output)
+        self.assertEqual(ZipRentalStat.query.count(), 4)
+        self.assertEqual(ZipRentalStat.query.filter_by(zip_code='54321', as_of=date(2023, 1, 1))
+                         .one().average_rent, 650)
+
+        # Fresh local stats are served without calling Realty Mole.
+        with mock.patch.object(app_module.realty_mole, 'get') as upstream:
+            data = app_module.lookup_rental_data('12345')
+        upstream.assert_not_called()
+        self.assertEqual(data['source'], 'local')
+        self.assertIsNone(data['rentalData']['detailed'][0])
+        self.assertEqual(data['rentalData']['detailed'][1]['averageRent'], 1000)
+        self.assertIsNone(data['rentalData']['detailed'][2]['minRent'])
+
+    def test_bulk_upsert_repeated_key(self):
+        """Rows repeating a conflict key in one batch keep the last one."""
+        rows = [dict(zip_code='12345', bedrooms=1, as_of=date(2023, 1, 1), average_rent=rent)
+                for rent in (900, 950)]
+        bulk_upsert(ZipRentalStat, ['zip_code', 'bedrooms', 'as_of'], rows)
+        db.session.commit()
+        self.assertEqual(ZipRentalStat.query.one().average_rent, 950)
+
+    def test_stale_rental_stats_fall_back_to_upstream(self):
+        """Test that stats older than RENTAL_STATS_MAX_AGE_DAYS are not served."""
+        db.session.add(ZipRentalStat(zip_code='12345', bedrooms=1, as_of=date(2020, 1, 1),
+                                     average_rent=900))
+        db.session.commit()
+        with mock.patch.object(app_module.realty_mole, 'get',
+                               side_effect=app_module.UpstreamError('down')):
+            self.assertIsNone(app_module.lookup_rental_data('12345'))
+
+        response = mock.Mock(ok=True)
+        response.json.return_value = {'id': '12345', 'rentalData': {
+            'detailed': [{'bedrooms': 1, 'averageRent': 1100}]}}
+        with mock.patch.object(app_module.realty_mole, 'get', return_value=response):
+            data = app_module.lookup_rental_data('12345')
+        self.assertEqual(data['rentalData']['detailed'][0]['averageRent'], 1100)
+
+        # The response is cached under the rental cache's TTL, not the stats'.
+        with mock.patch.object(app_module.realty_mole, 'get') as upstream:
+            data = app_module.lookup_rental_data('12345')
+        upstream.assert_not_called()
+        self.assertNotIn('source', data)
+
+
+    def import_mocks(self):
+        def geocode(addresses):
+            positions = {i: {'lat': 32.0 + i, 'lng': -110.0} for i in range(len(addresses))}
+            positions[0] = None
+            return positions, addresses[:1]
+
+        def rental(zip_code):
+            if zip_code == '99999':
+                return None
+            return {'id': zip_code, 'rentalData': {'detailed': [
+                {'bedrooms': n, 'averageRent': 1000 + n * 100} for n in range(4)]}}
+
+        return (mock.patch.object(app_module, 'batch_geocode', side_effect=geocode),
+                mock.patch.object(app_module, 'lookup_rental_data', side_effect=rental))
+
+    def test_import_addresses_command(self):
+        """Test the import-addresses CLI command."""
+        User.signup(username='testuser', first_name='Test', last_name='User',
+                    email='test@example.com', password='testpassword')
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'addresses.csv')
+            with open(path, 'w') as f:
+                f.write('Street,City,State,Zip,Bedrooms\n')
+                f.write('1 Main St,tucson,arizona,85701,2\n')
+                f.write('2  Oak Ave,Tucson,Arizona,85701,3\n')
+                f.write('3 Pine St,Phoenix,Arizona,99999,1\n')
+                f.write('4 Elm St,Phoenix,Arizona,not-a-zip,1\n')
+                f.write('5 Ash St,Phoenix,Arizona,2134,2\n')
+            geocode, rental = self.import_mocks()
+            with geocode as batch, rental:
+                result = app.test_cli_runner().invoke(
+                    args=['import-addresses', path, '--user', 'testuser', '--chunk-size', '2'])
+
+        self.assertIn('5 rows: 4 saved, 3 favorited, 2 not geocoded, 1 invalid.', result.output)
+        self.assertEqual(batch.call_count, 2)
+        self.assertEqual(State.query.count(), 1)
+        self.assertEqual(City.query.count(), 2)
+        oak = Location.query.filter_by(street_address='2 Oak Ave').one()
+        self.assertEqual((oak.latitude, oak.bedrooms), (33.0, 3))
+        self.assertEqual(Favorite.query.filter_by(location_id=oak.id).one().rent_average, 1300)
+        self.assertIsNone(Location.query.filter_by(street_address='1 Main St').one().latitude)
+        # Leading zeros survive the integer column.
+        self.assertEqual(Location.query.filter_by(street_address='5 Ash St').one().zip_code,
+                         '02134')
+
+    def test_import_addresses_upload(self):
+        """Test the /api/import upload endpoint."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+
+        csv_data = b'address,city,state,zipcode,bedrooms\n1 Main St,Tucson,Arizona,85701,2\n'
+        geocode, rental = self.import_mocks()
+        with geocode, rental:
+            response = self.app.post('/api/import', data={
+                'file': (io.BytesIO(csv_data), 'addresses.csv')})
+            lines = [json.loads(line) for line in response.data.splitlines()]
+            bad = self.app.post('/api/import', data={
+                'file': (io.BytesIO(b'name,zip\nx,1\n'), 'addresses.csv')})
+
+        self.assertEqual(lines[-1]['favorited'], 1)
+        self.assertEqual(Favorite.query.filter_by(user_id=user.id).count(), 1)
+        self.assertEqual(bad.status_code, 400)
+
 
 if __name__ == '__main__':
     unittest.main()
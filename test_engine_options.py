@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+from app import create_app
+from models import engine_options
+
+app = create_app("testing")
+
+
+class EngineOptionsTestCase(TestCase):
+    """Test engine and pool configuration."""
+
+    def config(self, **overrides):
+        config = dict(app.config, SQLALCHEMY_DATABASE_URI="postgresql:///movein")
+        config.update(overrides)
+        return config
+
+    def test_pooled(self):
+        options = engine_options(self.config(DB_POOL_SIZE=7, DB_STATEMENT_TIMEOUT_MS=2000))
+        self.assertEqual(options["pool_size"], 7)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"],
+                         {"options": "-c statement_timeout=2000"})
+
+    def test_pgbouncer(self):
+        options = engine_options(self.config(DB_PGBOUNCER=True))
+        self.assertNotIn("pool_size", options)
+        self.assertNotIn("connect_args", options)
+
+    def test_sqlite_untouched(self):
+        self.assertEqual(engine_options(self.config(SQLALCHEMY_DATABASE_URI="sqlite://")), {})
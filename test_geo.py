@@ -0,0 +1,87 @@
+import unittest
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+import geo
+from app import create_app, db
+from models import User, Location, Favorite
+
+app = create_app("testing")
+
+
+class GeohashTestCase(unittest.TestCase):
+    def test_encode(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+
+    def test_cover_contains_points(self):
+        """Every point inside the box falls in one of the covering cells."""
+        cells = geo.cover(32.1, -111.0, 32.3, -110.8)
+        self.assertLessEqual(len(cells), 16)
+        for lat, lng in [(32.1, -111.0), (32.3, -110.8), (32.2, -110.9)]:
+            point = geo.encode(lat, lng)
+            self.assertTrue(any(point.startswith(cell) for cell in cells))
+
+    def test_postgres_geohash_collation(self):
+        """Postgres compares geohashes bytewise, as the "~" range bound needs."""
+        ddl = str(CreateTable(Location.__table__).compile(dialect=postgresql.dialect()))
+        self.assertIn('geohash VARCHAR(12) COLLATE "C"', ddl)
+
+    def test_distance(self):
+        self.assertAlmostEqual(geo.distance_miles(32.2, -110.9, 32.2, -110.9), 0)
+        # One degree of latitude is about 69 miles.
+        self.assertAlmostEqual(geo.distance_miles(32, -110, 33, -110), 69.1, places=0)
+
+
+class LocationsWithinTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.app = app.test_client()
+        db.create_all()
+
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+        points = {'Tucson': (32.22, -110.97), 'Phoenix': (33.45, -112.07),
+                  'Oro Valley': (32.39, -110.97)}
+        for name, (lat, lng) in points.items():
+            location = Location(street_address=f'1 {name} St', zip_code=85700, bedrooms=2,
+                                user_id=user.id, latitude=lat, longitude=lng,
+                                geohash=geo.encode(lat, lng))
+            db.session.add(location)
+            db.session.commit()
+            db.session.add(Favorite(rent_average=1000, user_id=user.id,
+                                    location_id=location.id))
+        db.session.commit()
+
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_bbox(self):
+        response = self.app.get('/api/locations/within?bbox=32,-111.2,32.5,-110.8')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({item['street_address'] for item in response.json},
+                         {'1 Tucson St', '1 Oro Valley St'})
+
+    def test_radius(self):
+        """Radius results are filtered by distance and sorted nearest first."""
+        response = self.app.get('/api/locations/within?lat=32.22&lng=-110.97&radius=15'
+                                '&scope=locations')
+        self.assertEqual([item['street_address'] for item in response.json],
+                         ['1 Tucson St', '1 Oro Valley St'])
+
+    def test_bad_request(self):
+        response = self.app.get('/api/locations/within?lat=32')
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
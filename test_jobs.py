@@ -0,0 +1,222 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import app as app_module
+import jobs
+from app import create_app, db
+from models import City, Favorite, Job, Location, State, User
+from upstream import UpstreamError
+
+app = create_app("testing")
+
+calls = []
+
+
+@jobs.handler("test-record")
+def record_job(value):
+    calls.append(value)
+    return {"value": value}
+
+
+@jobs.handler("test-fail")
+def failing_job():
+    raise UpstreamError("upstream down")
+
+
+@jobs.handler("test-bug")
+def broken_job():
+    raise IndexError("list index out of range")
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+        calls.clear()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_priority_order(self):
+        jobs.enqueue("test-record", {"value": "low"})
+        jobs.enqueue("test-record", {"value": "high"}, priority=jobs.INTERACTIVE)
+        jobs.enqueue("test-record", {"value": "later"}, priority=20, delay=60)
+
+        self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(calls, ["high", "low"])
+        job = Job.query.filter_by(status=jobs.DONE).first()
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_result_stored(self):
+        job_id = jobs.enqueue("test-record", {"value": 3}).id
+        jobs.work(burst=True)
+        job = db.session.get(Job, job_id, populate_existing=True)
+        self.assertEqual(jobs.status(job), {
+            "id": job_id, "kind": "test-record", "status": "done", "attempts": 1,
+            "result": {"value": 3}, "error": None,
+        })
+
+    def test_retry_then_fail(self):
+        """Failures are retried after a backoff until max_attempts."""
+        job_id = jobs.enqueue("test-fail").id
+        job = db.session.get(Job, job_id)
+        job.max_attempts = 2
+        db.session.commit()
+
+        self.assertEqual(jobs.run(jobs.claim("w1"), "w1"), "retried")
+        job = db.session.get(Job, job_id, populate_existing=True)
+        self.assertEqual(job.status, jobs.QUEUED)
+        self.assertGreater(job.run_at, datetime.utcnow() + timedelta(seconds=15))
+        self.assertIsNone(jobs.claim("w1"))
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(jobs.run(jobs.claim("w1"), "w1"), "failed")
+        job = db.session.get(Job, job_id, populate_existing=True)
+        self.assertEqual(job.status, jobs.FAILED)
+        self.assertEqual(job.error, "UpstreamError: upstream down")
+
+    def test_non_retryable_error_fails_at_once(self):
+        job_id = jobs.enqueue("test-bug").id
+        self.assertEqual(jobs.run(jobs.claim("w1"), "w1"), "failed")
+        job = db.session.get(Job, job_id, populate_existing=True)
+        self.assertEqual((job.status, job.attempts), (jobs.FAILED, 1))
+
+    def test_expired_lease_is_redelivered(self):
+        """A job whose worker died is claimed again once its lease runs out."""
+        job_id = jobs.enqueue("test-record", {"value": 1}).id
+        self.assertEqual(jobs.claim("dead").id, job_id)
+        self.assertIsNone(jobs.claim("w2"))
+
+        job = db.session.get(Job, job_id)
+        job.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        job = jobs.claim("w2")
+        self.assertEqual((job.id, job.attempts), (job_id, 2))
+
+        # The dead worker's late result does not overwrite the new lease.
+        jobs.finish(job_id, "dead", status=jobs.DONE)
+        self.assertEqual(db.session.get(Job, job_id, populate_existing=True).status,
+                         jobs.RUNNING)
+        self.assertEqual(jobs.run(job, "w2"), jobs.DONE)
+
+    def test_enqueue_with_key(self):
+        first = jobs.enqueue("test-record", {"value": 1}, key="zip:1").id
+        self.assertEqual(jobs.enqueue("test-record", {"value": 1}, key="zip:1").id, first)
+        jobs.work(burst=True)
+        self.assertNotEqual(jobs.enqueue("test-record", {"value": 1}, key="zip:1").id, first)
+
+        with self.assertRaises(ValueError):
+            jobs.enqueue("no-such-kind")
+
+    def test_clean_up(self):
+        old = datetime.utcnow() - timedelta(days=2)
+        db.session.add_all([
+            Job(kind="test-record", status=jobs.DONE, finished_at=old),
+            Job(kind="test-record", status=jobs.RUNNING, attempts=5, max_attempts=5,
+                locked_until=old),
+        ])
+        db.session.commit()
+        jobs.clean_up()
+        self.assertEqual([job.status for job in Job.query.all()], [jobs.FAILED])
+
+
+class AsyncEndpointsTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config["JOBS_ASYNC"] = True
+        self.client = app.test_client()
+        db.create_all()
+        self.user = User.signup(username="testuser", first_name="Test", last_name="User",
+                                email="test@example.com", password="testpassword")
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess["curr_user"] = self.user.id
+
+    def tearDown(self):
+        """Clean up after each test."""
+        app.config["JOBS_ASYNC"] = False
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_search_queues_lookups(self):
+        """A search with cold caches returns at once and its jobs fill in the rest."""
+        data = {"address": "12 Jobs Ave", "city": "Tucson", "state": "AZ",
+                "zipcode": "85799", "bedrooms": 2}
+        rental = {"id": "85799", "rentalData": {"detailed": [
+            {"bedrooms": 2, "averageRent": 1300}]}}
+        with mock.patch("app.get_coords") as get_coords, \
+                mock.patch.object(app_module.rental_cache, "fetch") as fetch:
+            response = self.client.post("/api/search", json=data)
+            get_coords.assert_not_called()
+            fetch.assert_not_called()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertIsNone(response.json["coords"])
+        pending = response.json["jobs"]
+        self.assertEqual(set(pending), {"coords", "rental_data"})
+        # Submitting again reuses the queued jobs.
+        with mock.patch.object(app_module.rental_cache, "fetch"):
+            repeat = self.client.post("/api/search", json=data)
+        self.assertEqual(repeat.json["jobs"], pending)
+        status = self.client.get(f"/api/jobs/{pending['coords']}").json
+        self.assertEqual(status["status"], "queued")
+
+        with mock.patch("app.get_coords", return_value={"lat": 32.2, "lng": -110.9}), \
+                mock.patch.object(app_module.rental_cache, "fetch", return_value=rental):
+            self.assertEqual(jobs.work(burst=True), 2)
+
+        status = self.client.get(f"/api/jobs/{pending['coords']}?wait=5").json
+        self.assertEqual(status["result"], {"lat": 32.2, "lng": -110.9})
+        status = self.client.get(f"/api/jobs/{pending['rental_data']}?wait=5").json
+        self.assertEqual(status["result"]["averageRent"], 1300)
+        location = Location.query.filter_by(street_address="12 Jobs Ave").one()
+        self.assertEqual(location.latitude, 32.2)
+
+    def test_job_status_is_private(self):
+        other = jobs.enqueue("rental-refresh", {"zip_code": "1"}, user_id=None)
+        self.assertEqual(self.client.get(f"/api/jobs/{other.id}").status_code, 404)
+        self.assertEqual(self.client.get("/api/jobs/999").status_code, 404)
+
+    def test_batchgeocode_queues_missing(self):
+        state = State(name="Arizona")
+        db.session.add(state)
+        db.session.flush()
+        city = City(name="Tucson", state_id=state.id)
+        db.session.add(city)
+        db.session.flush()
+        location = Location(street_address="1 Queue St", zip_code=85701, city_id=city.id,
+                            bedrooms=1, user_id=self.user.id)
+        db.session.add(location)
+        db.session.flush()
+        db.session.add(Favorite(rent_average=1000, user_id=self.user.id,
+                                location_id=location.id))
+        db.session.commit()
+
+        response = self.client.get("/api/batchgeocode")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json, {})
+        job_id = int(response.headers["X-Geocode-Job"])
+
+        with mock.patch("app.batch_geocode",
+                        return_value=({0: {"lat": 32.1, "lng": -110.9}}, [])):
+            jobs.work(burst=True)
+        self.assertEqual(self.client.get(f"/api/jobs/{job_id}").json["result"],
+                         {"geocoded": 1, "failed": 0})
+        response = self.client.get("/api/batchgeocode")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"0": {"lat": 32.1, "lng": -110.9}})
+
+
+if __name__ == '__main__':
+    unittest.main()
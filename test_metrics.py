@@ -0,0 +1,57 @@
+import logging
+import unittest
+
+import metrics
+from app import create_app, db
+
+app = create_app("testing")
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_metrics_endpoint(self):
+        """Requests are timed and exposed in Prometheus format."""
+        self.app.get('/search')
+        response = self.app.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE movein_request_duration_seconds histogram', response.data)
+        self.assertIn(b'movein_request_duration_seconds_count{method="GET",route="/search",status="302"}',
+                      response.data)
+        self.assertIn(b'movein_cache_events{cache="geocode",event="misses"}', response.data)
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count 3', lines)
+
+    def test_sampled_logging(self):
+        """Warnings always pass; lower levels are sampled."""
+        log_filter = metrics.SampledFilter(rate=0)
+        debug = logging.LogRecord('movein', logging.DEBUG, '', 0, 'msg', None, None)
+        warning = logging.LogRecord('movein', logging.WARNING, '', 0, 'msg', None, None)
+        self.assertFalse(log_filter.filter(debug))
+        self.assertTrue(log_filter.filter(warning))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+from app import create_app, db
+from models import User
+from passwords import (
+    PasswordHasher, HasherBusy, LoginThrottle, default_workers, hash_rounds, hasher)
+
+app = create_app("testing")
+
+
+def make_hasher(**config):
+    flask_app = Flask(__name__)
+    flask_app.config.update({'BCRYPT_LOG_ROUNDS': 4, 'BCRYPT_WORKERS': 0, **config})
+    return PasswordHasher(flask_app)
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+    def test_hash_and_verify(self):
+        h = make_hasher()
+        hashed = h.hash('password')
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(h.verify(hashed, 'password'))
+        self.assertFalse(h.verify(hashed, 'wrong'))
+
+    def test_process_pool(self):
+        """Hashing on worker processes gives the same results."""
+        h = make_hasher(BCRYPT_WORKERS=1)
+        self.assertTrue(h.verify(h.hash('password'), 'password'))
+
+    def test_pool_does_not_fork_the_web_worker(self):
+        h = make_hasher(BCRYPT_WORKERS=1)
+        h.hash('password')
+        self.assertNotEqual(h._pool._mp_context.get_start_method(), 'fork')
+
+    def test_default_workers_shared_between_web_workers(self):
+        with mock.patch('os.cpu_count', return_value=8), \
+                mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}):
+            self.assertEqual(default_workers(), 2)
+        with mock.patch('os.cpu_count', return_value=2), \
+                mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}):
+            self.assertEqual(default_workers(), 1)
+
+    def test_empty_password(self):
+        with self.assertRaises(ValueError):
+            make_hasher().hash('')
+
+    def test_queue_full(self):
+        """Calls beyond the queue depth fail fast."""
+        with self.assertRaises(HasherBusy):
+            make_hasher(BCRYPT_QUEUE_DEPTH=0).hash('password')
+
+    def test_needs_rehash(self):
+        old = make_hasher().hash('password')
+        self.assertFalse(make_hasher().needs_rehash(old))
+        self.assertTrue(make_hasher(BCRYPT_LOG_ROUNDS=5).needs_rehash(old))
+
+
+class LoginThrottleTestCase(unittest.TestCase):
+    def test_limit_per_ip(self):
+        throttle = LoginThrottle(max_attempts=2, window=60)
+        self.assertTrue(throttle.allow('1.1.1.1'))
+        self.assertTrue(throttle.allow('1.1.1.1'))
+        self.assertFalse(throttle.allow('1.1.1.1'))
+        self.assertTrue(throttle.allow('2.2.2.2'))
+
+
+class RehashOnLoginTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['TESTING'] = True
+        db.create_all()
+        self.rounds = hasher.rounds
+
+    def tearDown(self):
+        """Clean up after each test."""
+        hasher.rounds = self.rounds
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_rehash_on_login(self):
+        """A hash made at an old cost factor is upgraded on login."""
+        hasher.rounds = 4
+        User.signup(username='testuser', first_name='Test', last_name='User',
+                    email='test@example.com', password='testpassword')
+        db.session.commit()
+
+        hasher.rounds = 5
+        user = User.authenticate('testuser', 'testpassword')
+        self.assertEqual(hash_rounds(user.password), 5)
+        self.assertTrue(User.authenticate('testuser', 'testpassword'))
+
+
+if __name__ == '__main__':
+    unittest.main()
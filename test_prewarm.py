@@ -0,0 +1,137 @@
+import unittest
+from datetime import datetime, time, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import app as app_module
+import jobs
+import prewarm
+from app import create_app, db, plan_prewarm, prewarm_job, warm_cache_job
+from models import City, Favorite, Geocode, Job, Location, RentalCache, State, User
+
+app = create_app("testing")
+
+
+class PrewarmWindowTestCase(unittest.TestCase):
+    def test_window(self):
+        night = prewarm.parse_window("22:00-04:00")
+        self.assertEqual(night, (time(22), time(4)))
+        self.assertTrue(prewarm.in_window(datetime(2024, 1, 1, 23, 30), night))
+        self.assertTrue(prewarm.in_window(datetime(2024, 1, 1, 1, 0), night))
+        self.assertFalse(prewarm.in_window(datetime(2024, 1, 1, 12, 0), night))
+        self.assertEqual(prewarm.next_window_start(datetime(2024, 1, 1, 23, 30), night),
+                         datetime(2024, 1, 2, 22, 0))
+        self.assertEqual(prewarm.next_window_start(datetime(2024, 1, 1, 12, 0), night),
+                         datetime(2024, 1, 1, 22, 0))
+        with self.assertRaises(ValueError):
+            prewarm.parse_window("nightly")
+
+    def test_collect(self):
+        batches = iter([[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual(prewarm.collect(batches, lambda b: [n for n in b if n % 2], 2), [1, 3])
+        self.assertEqual(prewarm.collect(iter([[1]]), list, 0), [])
+
+
+class PrewarmTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.saved_config = dict(app.config)
+        app.config.update(PREWARM_HORIZON_HOURS=24, PREWARM_RENTAL_CALLS=200,
+                          PREWARM_GEOCODE_CALLS=10)
+
+        user = User.signup(username="testuser", first_name="Test", last_name="User",
+                           email="test@example.com", password="testpassword")
+        state = State(name="Az")
+        db.session.add(state)
+        db.session.flush()
+        city = City(name="Tucson", state_id=state.id)
+        db.session.add(city)
+        db.session.flush()
+        # 85719: two searches and a favorite; 85701: two searches; 85705: one.
+        for n, zip_code in enumerate([85719, 85719, 85701, 85701, 85705]):
+            location = Location(street_address=f"{n} Main St", zip_code=zip_code,
+                                city_id=city.id, bedrooms=2, user_id=user.id)
+            db.session.add(location)
+            db.session.flush()
+            if n == 0:
+                db.session.add(Favorite(rent_average=1000, user_id=user.id,
+                                        location_id=location.id))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        app.config.clear()
+        app.config.update(self.saved_config)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_ranking(self):
+        self.assertEqual(list(prewarm.hot_zip_codes()), [["85719", "85701", "85705"]])
+        self.assertEqual(list(prewarm.favorite_addresses()),
+                         [["0 Main St, Tucson, Az, 85719"]])
+
+    def test_leading_zeros_kept(self):
+        location = Location.query.filter_by(street_address="0 Main St").one()
+        location.zip_code = "02134"
+        db.session.commit()
+        self.assertIn("02134", list(prewarm.hot_zip_codes())[0])
+        self.assertEqual(list(prewarm.favorite_addresses()),
+                         [["0 Main St, Tucson, Az, 02134"]])
+        row = SimpleNamespace(street_address="1 Elm St", city="Boston", zip_code=2134)
+        self.assertEqual(app_module.location_address(row), "1 Elm St, Boston 02134")
+
+    def test_plan_skips_fresh_entries_and_respects_budget(self):
+        now = datetime.utcnow()
+        db.session.add_all([
+            RentalCache(zip_code="85719", data={}, fetched_at=now),
+            # Still fresh, but not for another hour.
+            RentalCache(zip_code="85701", data={}, fetched_at=now - timedelta(hours=23.5)),
+        ])
+        db.session.commit()
+        app.config.update(PREWARM_HORIZON_HOURS=1, PREWARM_RENTAL_CALLS=1)
+
+        self.assertEqual(plan_prewarm(), {"zip_codes": 1, "addresses": 1})
+        payloads = sorted((job.payload for job in Job.query.all()), key=len)
+        self.assertEqual(payloads, [
+            {"zip_codes": ["85701"], "within": 3600},
+            {"addresses": ["0 Main St, Tucson, Az, 85719"], "within": 3600},
+        ])
+
+        Job.query.delete()
+        with mock.patch.object(app_module.realty_mole_budget, "low", return_value=True):
+            self.assertEqual(plan_prewarm()["zip_codes"], 0)
+
+    def test_warm_cache_job(self):
+        fetch = mock.Mock(return_value={"id": "85701"})
+        db.session.add(Geocode(address="1 main st", lat=1, lng=2,
+                               fetched_at=datetime.utcnow()))
+        db.session.commit()
+        with mock.patch.object(app_module.rental_cache, "fetch", fetch), \
+                mock.patch("app.batch_geocode", return_value=({0: {"lat": 1, "lng": 2}}, [])) \
+                as batch_geocode:
+            result = warm_cache_job(zip_codes=["85701"], addresses=["1 Main St", "2 Main St"],
+                                    within=3600)
+        self.assertEqual(result, {"zip_codes": 1, "addresses": 1})
+        fetch.assert_called_once_with("85701")
+        batch_geocode.assert_called_once_with(["2 Main St"], refresh=True)
+
+    def test_prewarm_job_books_next_run(self):
+        app.config["PREWARM_WINDOW"] = "00:00-00:00"
+        self.assertEqual(prewarm_job(), {"zip_codes": 0, "addresses": 0})
+        job = Job.query.filter_by(kind="prewarm").one()
+        self.assertEqual(job.status, jobs.QUEUED)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # Scheduling again reuses the queued run.
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["prewarm", "--schedule"])
+        self.assertIn("Prewarming scheduled", result.output)
+        self.assertEqual(Job.query.filter_by(kind="prewarm").count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
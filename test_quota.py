@@ -0,0 +1,118 @@
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import metrics
+from app import create_app, db
+from cache import ZipRentalCache
+from models import RentalCache, UpstreamBudget
+from quota import QuotaBudget, parse_rate_limit_headers
+from upstream import UpstreamClient, QuotaExceededError
+
+app = create_app("testing")
+
+
+class QuotaBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def budget(self, **options):
+        options.setdefault("max_wait", 0)
+        return QuotaBudget("test", db.engine, **options)
+
+    def test_token_bucket(self):
+        """Calls beyond the burst are refused until tokens refill."""
+        budget = self.budget(rate=1, burst=2)
+        budget.acquire()
+        budget.acquire()
+        with self.assertRaises(QuotaExceededError):
+            budget.acquire()
+
+    def test_monthly_quota_shared_between_workers(self):
+        budget = self.budget(quota=3, rate=0)
+        budget.acquire()
+        other_worker = self.budget(quota=3, rate=0)
+        other_worker.acquire()
+        self.assertFalse(other_worker.low())
+        other_worker.acquire()
+        with self.assertRaises(QuotaExceededError):
+            budget.acquire()
+        self.assertEqual(budget.remaining(), 0)
+        self.assertTrue(budget.low())
+
+        # A new month starts a new window.
+        row = db.session.get(UpstreamBudget, "test")
+        row.window_start = date(2020, 1, 1)
+        db.session.commit()
+        budget.acquire()
+
+    def test_provider_headers(self):
+        """Rate-limit headers are stored, exported and counted against."""
+        budget = self.budget(rate=0)
+        response = mock.Mock(status_code=200, headers={
+            "X-RateLimit-Requests-Limit": "100",
+            "X-RateLimit-Requests-Remaining": "5",
+            "X-RateLimit-Requests-Reset": "3600",
+        })
+        budget.record(response)
+        self.assertAlmostEqual(budget.remaining(), 0.05)
+        self.assertTrue(budget.low())
+        self.assertIn('movein_upstream_budget_remaining{kind="provider",provider="test"} 5',
+                      metrics.render())
+
+        budget.record(mock.Mock(status_code=429, headers={"Retry-After": "30"}))
+        with self.assertRaises(QuotaExceededError):
+            budget.acquire()
+
+    def test_parse_rate_limit_headers(self):
+        self.assertEqual(parse_rate_limit_headers({}), (None, None, None))
+        self.assertEqual(
+            parse_rate_limit_headers({"X-RateLimit-Remaining": "7", "X-RateLimit-Reset": "10"},
+                                     now=1000),
+            (None, 7, 1010))
+
+    def test_client_does_not_call_when_spent(self):
+        budget = self.budget(quota=1, rate=0)
+        client = UpstreamClient("test", "https://example.test", budget=budget)
+        with mock.patch.object(client.session, "request",
+                               return_value=mock.Mock(status_code=200, headers={})) as get:
+            client.get("/x")
+            with self.assertRaises(QuotaExceededError):
+                client.get("/x")
+        self.assertEqual(get.call_count, 1)
+
+    def test_client_stops_retrying_after_429(self):
+        """A 429 spends the budget, so the client gives up instead of sleeping."""
+        client = UpstreamClient("test", "https://example.test", budget=self.budget(rate=0))
+        response = mock.Mock(status_code=429, headers={"Retry-After": "30"})
+        with mock.patch.object(client.session, "request", return_value=response) as request, \
+                mock.patch("upstream.time.sleep") as sleep:
+            with self.assertRaises(QuotaExceededError):
+                client.get("/x")
+        self.assertEqual(request.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_rental_cache_prefers_stale_when_low(self):
+        """Expired rows are served, and not refreshed, while the budget is low."""
+        old = datetime.utcnow() - timedelta(days=30)
+        db.session.add(RentalCache(zip_code="90210", data={"id": "old"}, fetched_at=old))
+        db.session.commit()
+        fetch = mock.Mock(return_value={"id": "new"})
+        cache = ZipRentalCache(fetch, ttl=60, stale_ttl=600)
+        cache.prefer_stale = lambda: True
+
+        self.assertEqual(cache.get("90210"), {"id": "old"})
+        fetch.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,13 +3,20 @@
 #    FLASK_ENV=production python -m unittest test_search_views.py
 
 import unittest
-from app import app, db
+
+from sqlalchemy import event
+
+from app import create_app, db, user_cache
 from models import User
 
+app = create_app("testing")
+
 
 class SearchViewTestCase(unittest.TestCase):
     def setUp(self):
         """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.app = app.test_client()
@@ -19,6 +26,7 @@ class SearchViewTestCase(unittest.TestCase):
         """Clean up after each test."""
         db.session.remove()
         db.drop_all()
+        self.ctx.pop()
 
     def test_search_view_authenticated_user(self):
         """Test if the search view is accessible for an authenticated user."""
@@ -65,6 +73,34 @@ class SearchViewTestCase(unittest.TestCase):
         self.assertIn(
             b'<button class="btn btn-primary btn-block btn-lg">Log in</button>', response.data)
 
+    def test_current_user_is_cached(self):
+        """Test that repeat requests read the logged in user from the user cache."""
+        user = User.signup(username='testuser', first_name='Test', last_name='User',
+                           email='test@example.com', password='testpassword')
+        db.session.commit()
+
+        with self.app.session_transaction() as sess:
+            sess['curr_user'] = user.id
+        user_id = user.id
+        db.session.expunge_all()
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.app.get('/search')
+            self.app.get('/search')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        user_queries = [sql for sql in statements if 'FROM users' in sql]
+        self.assertEqual(len(user_queries), 1)
+        self.assertEqual(user_cache.get(user_id)['username'], 'testuser')
+        self.assertNotIn('password', user_cache.get(user_id))
+
 
 if __name__ == '__main__':
     unittest.main()
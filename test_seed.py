@@ -0,0 +1,61 @@
+import random
+import unittest
+from unittest import mock
+
+import seed
+from app import create_app, db
+from models import City, Favorite, Location, State, User
+from passwords import hasher
+
+app = create_app("testing")
+
+
+class SeedTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_seed_database(self):
+        """Rows are linked, unique and can be seeded twice into one database."""
+        with mock.patch.object(hasher, 'hash', wraps=hasher.hash) as hash_password:
+            first = seed.seed_database(db.engine, users=20, locations_per_user=4,
+                                       favorites_per_user=2, cities=30, zip_codes=10,
+                                       batch_size=7, seed=1)
+        hash_password.assert_called_once_with('password')
+        second = seed.seed_database(db.engine, users=5, cities=30, seed=2)
+
+        self.assertEqual(User.query.count(), 25)
+        self.assertEqual(second['first_user_id'], first['first_user_id'] + 20)
+        self.assertEqual(State.query.count(), len(seed.STATES))
+        self.assertEqual(City.query.count(), 30)
+        self.assertEqual(Location.query.count(), first['locations'] + second['locations'])
+        self.assertEqual(Favorite.query.count(), first['favorites'] + second['favorites'])
+        for favorite in Favorite.query.limit(20):
+            self.assertEqual(db.session.get(Location, favorite.location_id).user_id,
+                             favorite.user_id)
+        user = User.query.first()
+        self.assertTrue(User.authenticate(user.username, 'password'))
+
+    def test_seed_data_command(self):
+        result = app.test_cli_runner().invoke(args=['seed-data', '--users', '3', '--cities', '5'])
+        self.assertIn('Seeded 3 users', result.output)
+
+    def test_zipf_choice(self):
+        """Low ranks are picked far more often than high ones."""
+        pick = seed.ZipfChoice(list(range(100)), 1.0, random.Random(0))
+        picks = [pick() for _ in range(2000)]
+        self.assertGreater(picks.count(0), picks.count(99) * 10)
+        uniform = seed.ZipfChoice(['a', 'b'], 0, random.Random(0))
+        self.assertEqual({uniform() for _ in range(50)}, {'a', 'b'})
+
+
+if __name__ == '__main__':
+    unittest.main()
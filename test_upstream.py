@@ -0,0 +1,133 @@
+import contextlib
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+
+from upstream import (
+    UpstreamClient, UpstreamError, CircuitOpenError, CircuitBreaker, SingleFlight)
+
+
+def fake_response(status):
+    res = mock.Mock(status_code=status, headers={})
+    res.ok = status < 400
+    return res
+
+
+class UpstreamClientTestCase(unittest.TestCase):
+    def setUp(self):
+        """Build a client that retries without sleeping."""
+        self.client = UpstreamClient(
+            "test", "https://example.test", params={"key": "abc"},
+            retries=2, backoff=0, breaker=CircuitBreaker(threshold=2, reset_timeout=60))
+
+    def test_retries_then_succeeds(self):
+        """5xx responses are retried and the first good response returned."""
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=[fake_response(503), fake_response(200)]) as get:
+            res = self.client.get("/address", params={"location": "x"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(get.call_args.kwargs['params'], {"key": "abc", "location": "x"})
+        self.assertEqual(get.call_args.kwargs['timeout'], self.client.timeout)
+
+    def test_post_body(self):
+        with mock.patch.object(self.client.session, 'request',
+                               return_value=fake_response(200)) as request:
+            self.client.post("/batch", json={"locations": ["a", "b"]})
+        self.assertEqual(request.call_args.args, ("POST", "https://example.test/batch"))
+        self.assertEqual(request.call_args.kwargs['json'], {"locations": ["a", "b"]})
+        self.assertEqual(request.call_args.kwargs['params'], {"key": "abc"})
+
+    def test_client_errors_not_retried(self):
+        with mock.patch.object(self.client.session, 'request',
+                               return_value=fake_response(404)) as get:
+            self.assertFalse(self.client.get("/x").ok)
+        self.assertEqual(get.call_count, 1)
+
+    def test_retry_after_is_honoured(self):
+        """A Retry-After delay is a floor; jitter only lengthens it."""
+        res = fake_response(429)
+        res.headers = {"Retry-After": "4"}
+        with mock.patch("upstream.time.sleep") as sleep:
+            for _ in range(20):
+                self.assertTrue(self.client._sleep_before_retry(0, res))
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertTrue(all(4 <= delay <= 4.5 for delay in delays))
+
+    def test_long_retry_after_gives_up(self):
+        """A Retry-After past max_retry_after fails the call instead of sleeping."""
+        res = fake_response(503)
+        res.headers = {"Retry-After": "600"}
+        with mock.patch.object(self.client.session, 'request', return_value=res) as request, \
+                mock.patch("upstream.time.sleep") as sleep:
+            with self.assertRaises(UpstreamError):
+                self.client.get("/x")
+        self.assertEqual(request.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_breaker_opens_after_failures(self):
+        """Repeated failures open the circuit so later calls fail fast."""
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=requests.ConnectionError("down")) as get:
+            for _ in range(2):
+                with self.assertRaises(UpstreamError):
+                    self.client.get("/x")
+            with self.assertRaises(CircuitOpenError):
+                self.client.get("/x")
+        self.assertEqual(get.call_count, 6)
+        self.assertEqual(self.client.breaker.state, "open")
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        """Build a single-flight group and a slow upstream call."""
+        self.flights = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow_lookup(self, value):
+        self.calls += 1
+        self.release.wait(5)
+        if value is None:
+            raise UpstreamError("down")
+        return {"value": value}
+
+    def run_concurrently(self, key, value, callers=5):
+        with ThreadPoolExecutor(callers) as pool:
+            futures = [pool.submit(self.flights.do, key, self.slow_lookup, value)
+                       for _ in range(callers)]
+            # Let every caller join the flight before the call finishes.
+            while self.calls == 0:
+                time.sleep(0.001)
+            threading.Timer(0.1, self.release.set).start()
+            return futures
+
+    def test_concurrent_callers_share_one_call(self):
+        futures = self.run_concurrently(("realty_mole", "90210"), "x")
+        self.assertEqual([f.result() for f in futures], [{"value": "x"}] * 5)
+        self.assertEqual(self.calls, 1)
+        # Once the call is done the next caller starts a new one.
+        self.flights.do(("realty_mole", "90210"), self.slow_lookup, "y")
+        self.assertEqual(self.calls, 2)
+
+    def test_errors_are_shared(self):
+        futures = self.run_concurrently(("mapquest", "1 main st"), None)
+        for future in futures:
+            with self.assertRaises(UpstreamError):
+                future.result()
+        self.assertEqual(self.calls, 1)
+
+    def test_lock_held_around_call(self):
+        held = []
+        self.flights.lock = lambda key: contextlib.nullcontext(held.append(key))
+        self.release.set()
+        self.flights.do(("mapquest", "a"), self.slow_lookup, "a")
+        self.assertEqual(held, [("mapquest", "a")])
+
+
+if __name__ == '__main__':
+    unittest.main()
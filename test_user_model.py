@@ -1,11 +1,13 @@
-from app import app
+from app import create_app
 import os
 from unittest import TestCase
 from sqlalchemy import exc
 
 from models import User, Location, State, City, connect_db, db
 
-os.environ['DATABASE_URL'] = "postgresql:///movein-test"
+app = create_app("testing", SQLALCHEMY_DATABASE_URI=os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///movein-test"))
+app.app_context().push()
 
 db.create_all()
 
@@ -0,0 +1,64 @@
+-- Brings a database created before the Location coordinates and the
+-- uniqueness constraints up to date with models.py. New tables (geocodes,
+-- rental_cache, jobs, ...) are created by db.create_all(); it does not
+-- alter tables that already exist, which is what this file is for.
+--
+-- Postgres; safe to run more than once:
+--     psql movein -f upgrade.sql
+
+BEGIN;
+
+-- Coordinates stored on Location.
+
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION;
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION;
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS geocode_provider TEXT;
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS geocoded_at TIMESTAMP WITHOUT TIME ZONE;
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS geohash VARCHAR(12) COLLATE "C";
+-- Geohash range scans need byte order; this also rebuilds the index if the
+-- column was added with the database's default collation.
+ALTER TABLE locations ALTER COLUMN geohash TYPE VARCHAR(12) COLLATE "C";
+CREATE INDEX IF NOT EXISTS ix_locations_geohash ON locations (geohash);
+CREATE INDEX IF NOT EXISTS ix_locations_user_id ON locations (user_id);
+
+-- Duplicates would stop the unique constraints below from being added.
+-- Rows pointing at a duplicate are moved to the oldest copy first.
+
+UPDATE locations SET city_id = keep.id
+FROM cities AS dup
+JOIN (SELECT min(id) AS id, name, state_id FROM cities GROUP BY name, state_id) AS keep
+    ON keep.name = dup.name AND keep.state_id = dup.state_id
+WHERE locations.city_id = dup.id AND dup.id <> keep.id;
+
+DELETE FROM cities
+WHERE id NOT IN (SELECT min(id) FROM cities GROUP BY name, state_id);
+
+UPDATE favorites SET location_id = keep.id
+FROM locations AS dup
+JOIN (SELECT min(id) AS id, street_address FROM locations GROUP BY street_address) AS keep
+    ON keep.street_address = dup.street_address
+WHERE favorites.location_id = dup.id AND dup.id <> keep.id;
+
+DELETE FROM locations
+WHERE id NOT IN (SELECT min(id) FROM locations GROUP BY street_address);
+
+DELETE FROM favorites
+WHERE id NOT IN (SELECT min(id) FROM favorites GROUP BY user_id, location_id);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_cities_name_state_id') THEN
+        ALTER TABLE cities
+            ADD CONSTRAINT uq_cities_name_state_id UNIQUE (name, state_id);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'locations_street_address_key') THEN
+        ALTER TABLE locations
+            ADD CONSTRAINT locations_street_address_key UNIQUE (street_address);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_favorites_user_location') THEN
+        ALTER TABLE favorites
+            ADD CONSTRAINT uq_favorites_user_location UNIQUE (user_id, location_id);
+    END IF;
+END $$;
+
+COMMIT;
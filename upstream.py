@@ -0,0 +1,272 @@
+"""Pooled HTTP clients for the MapQuest and Realty Mole APIs."""
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """An upstream provider could not be reached or kept failing."""
+
+
+class CircuitOpenError(UpstreamError):
+    """The provider's circuit breaker is open; the call was not attempted."""
+
+
+class QuotaExceededError(UpstreamError):
+    """The provider's call budget is spent; the call was not attempted."""
+
+
+class CircuitBreaker:
+    """Stop calling a provider after `threshold` consecutive failures.
+
+    After `reset_timeout` seconds one trial call is let through; success
+    closes the circuit again, failure re-opens it.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open":
+                return False
+            if self.state == "half-open":
+                # Let a single trial call through; others fail fast meanwhile.
+                self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Share one in-flight call among concurrent callers with the same key.
+
+    Keys are (provider, normalized key) tuples. The first caller for a key
+    runs the function; callers arriving while it runs wait for it and get
+    its result, or its exception. If `lock` is set, it is called with the
+    key and must return a context manager; the first caller holds it while
+    calling, so that callers in other processes take turns and can find
+    each other's results in a shared cache.
+    """
+
+    def __init__(self, lock=None):
+        self.lock = lock
+        self._calls = {}
+        self._mutex = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._mutex:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.upstream_coalesced.inc(provider=key[0])
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.lock is None:
+                call.result = func(*args)
+            else:
+                with self.lock(key):
+                    call.result = func(*args)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._mutex:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class UpstreamClient:
+    """A keep-alive `requests.Session` for one provider.
+
+    Every request gets connect/read timeouts. Connection errors and
+    RETRY_STATUSES responses are retried with jittered exponential backoff,
+    and repeated failures trip the circuit breaker. A Retry-After longer
+    than `max_retry_after` seconds ends the retries rather than holding the
+    calling thread. If `budget` is set (see
+    quota.QuotaBudget), every attempt takes a call from it and reports the
+    provider's rate-limit headers back. The session is opened on first use,
+    so forked workers never share one.
+    """
+
+    def __init__(
+        self,
+        name,
+        base_url,
+        headers=None,
+        params=None,
+        pool_size=10,
+        connect_timeout=3.05,
+        read_timeout=10,
+        retries=2,
+        backoff=0.5,
+        max_retry_after=5,
+        breaker=None,
+        budget=None,
+    ):
+        self.name = name
+        self.base_url = base_url
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget
+        self._session = None
+        self._lock = threading.Lock()
+        self.configure(
+            headers=headers,
+            params=params,
+            pool_size=pool_size,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries=retries,
+            backoff=backoff,
+            max_retry_after=max_retry_after,
+        )
+
+    def configure(
+        self,
+        headers=None,
+        params=None,
+        pool_size=10,
+        connect_timeout=3.05,
+        read_timeout=10,
+        retries=2,
+        backoff=0.5,
+        max_retry_after=5,
+    ):
+        """Set credentials and connection options; the session is rebuilt on next use."""
+
+        self.headers = headers or {}
+        self.params = params or {}
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self._session = None
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def _sleep_before_retry(self, attempt, res=None):
+        """Wait before the next attempt; return False if it is not worth waiting for."""
+
+        retry_after = res.headers.get("Retry-After") if res is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+            if delay > self.max_retry_after:
+                return False
+            # Never earlier than the provider asked; jitter only adds to it.
+            time.sleep(delay + random.uniform(0, max(delay * 0.1, self.backoff)))
+        else:
+            time.sleep(random.uniform(0, self.backoff * 2**attempt))
+        return True
+
+    def get(self, path="", params=None, **kwargs):
+        """GET base_url + path and return the response.
+
+        Raises CircuitOpenError if the provider is marked down,
+        QuotaExceededError if the call budget is spent, and UpstreamError if
+        every attempt failed.
+        """
+
+        return self.request("GET", path, params, **kwargs)
+
+    def post(self, path="", params=None, **kwargs):
+        """POST to base_url + path, e.g. with json=body; see `get()`."""
+
+        return self.request("POST", path, params, **kwargs)
+
+    def request(self, method, path="", params=None, **kwargs):
+
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+        merged = {**self.params, **(params or {})}
+        kwargs.setdefault("timeout", self.timeout)
+        res = None
+        for attempt in range(self.retries + 1):
+            if self.budget is not None:
+                self.budget.acquire()
+            start = time.perf_counter()
+            res = error = None
+            try:
+                res = self.session.request(
+                    method, f"{self.base_url}{path}", params=merged, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = exc
+            if res is not None and self.budget is not None:
+                self.budget.record(res)
+            metrics.upstream_latency.observe(
+                time.perf_counter() - start,
+                provider=self.name,
+                status=res.status_code if res is not None else "error",
+            )
+            if res is not None and res.status_code not in RETRY_STATUSES:
+                self.breaker.record_success()
+                return res
+
+            if self.budget is not None and self.budget.spent():
+                # Waiting out Retry-After would only end in acquire() refusing.
+                raise QuotaExceededError(f"{self.name} quota is spent")
+            if attempt < self.retries and not self._sleep_before_retry(attempt, res):
+                break
+
+        self.breaker.record_failure()
+        if res is not None:
+            raise UpstreamError(f"{self.name} returned {res.status_code}")
+        raise UpstreamError(f"{self.name} request failed: {error}") from error